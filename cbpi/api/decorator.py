@@ -59,10 +59,11 @@ def request_mapping(
         return composed(on_http_request(path, name), validate_json_body)
 
 
-def on_event(topic):
+def on_event(topic, coalesce=False):
     def real_decorator(func):
         func.eventbus = True
         func.topic = topic
+        func.coalesce = coalesce
         func.c = None
         return func
 
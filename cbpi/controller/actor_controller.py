@@ -34,13 +34,7 @@ class ActorController(BasicController):
                 except:
                     await item.instance.on(power)
                 # await self.push_udpate()
-                self.cbpi.ws.send(
-                    dict(
-                        topic=self.update_key,
-                        data=list(map(lambda item: item.to_dict(), self.data)),
-                    ),
-                    self.sorting,
-                )
+                self.push_item_update(item)
                 self.cbpi.push_update(
                     "cbpi/actorupdate/{}".format(id), item.to_dict(), True
                 )
@@ -58,13 +52,7 @@ class ActorController(BasicController):
             if item.instance.state is True:
                 await item.instance.off()
                 # await self.push_udpate()
-                self.cbpi.ws.send(
-                    dict(
-                        topic=self.update_key,
-                        data=list(map(lambda item: item.to_dict(), self.data)),
-                    ),
-                    self.sorting,
-                )
+                self.push_item_update(item)
                 self.cbpi.push_update("cbpi/actorupdate/{}".format(id), item.to_dict())
             return True
         except Exception as e:
@@ -76,13 +64,7 @@ class ActorController(BasicController):
             item = self.find_by_id(id)
             instance = item.get("instance")
             await instance.toggle()
-            self.cbpi.ws.send(
-                dict(
-                    topic=self.update_key,
-                    data=list(map(lambda item: item.to_dict(), self.data)),
-                ),
-                self.sorting,
-            )
+            self.push_item_update(item)
             self.cbpi.push_update("cbpi/actorupdate/{}".format(id), item.to_dict())
         except Exception as e:
             logging.error("Failed to toggle Actor {} {}".format(id, e))
@@ -120,13 +102,7 @@ class ActorController(BasicController):
                 item.output = round(output)
 
             # await self.push_udpate()
-            self.cbpi.ws.send(
-                dict(
-                    topic=self.update_key,
-                    data=list(map(lambda item: item.to_dict(), self.data)),
-                ),
-                self.sorting,
-            )
+            self.push_item_update(item)
             self.cbpi.push_update("cbpi/actorupdate/{}".format(id), item.to_dict())
         except Exception as e:
             logging.error("Failed to update Actor {} {}".format(id, e))
@@ -136,25 +112,14 @@ class ActorController(BasicController):
             item = self.find_by_id(id)
             item.timer = round(timer)
             # await self.push_udpate()
-            self.cbpi.ws.send(
-                dict(
-                    topic=self.update_key,
-                    data=list(map(lambda item: item.to_dict(), self.data)),
-                )
-            )
+            self.push_item_update(item)
             self.cbpi.push_update("cbpi/actorupdate/{}".format(id), item.to_dict())
         except Exception as e:
             logging.error("Failed to update Actor {} {}".format(id, e))
 
     async def ws_actor_update(self):
         try:
-            self.cbpi.ws.send(
-                dict(
-                    topic=self.update_key,
-                    data=list(map(lambda x: x.to_dict(), self.data)),
-                ),
-                self.sorting,
-            )
+            self.cbpi.ws.send(self.get_snapshot(), self.sorting)
             return True
         except Exception as e:
             logging.error("Failed to update Actors {}".format(e))
@@ -7,6 +7,7 @@ import sys
 
 import shortuuid
 from cbpi.api.dataclasses import Actor, Fermenter, NotificationType, Props
+from cbpi.utils.id_index import IdIndex
 from tabulate import tabulate
 
 
@@ -23,11 +24,18 @@ class BasicController:
         self.types = {}
         self.logger = logging.getLogger(__name__)
         self.data = []
+        # id -> position in self.data
+        self._index = IdIndex()
         self.autostart = True
+        # incremented for every patch sent to websocket clients in delta mode
+        self.revision = 0
+        # id -> to_dict() of the item as last sent
+        self._published = {}
         self.path = self.cbpi.config_folder.get_file_path(file)
         self.cbpi.app.on_cleanup.append(self.shutdown)
 
     async def init(self):
+        self.cbpi.ws.add_versioned(self)
         await self.load()
 
     def create(self, data):
@@ -47,6 +55,7 @@ class BasicController:
 
                 for i in data["data"]:
                     self.data.append(self.create(i))
+                self._index.rebuild(self.data)
 
                 if self.autostart is True:
                     for item in self.data:
@@ -66,6 +75,7 @@ class BasicController:
 
                 for i in data["data"]:
                     self.data.append(self.create(i))
+                self._index.rebuild(self.data)
 
                 if self.autostart is True:
                     for item in self.data:
@@ -81,24 +91,67 @@ class BasicController:
         await self.push_udpate()
 
     async def push_udpate(self):
-        self.cbpi.ws.send(
-            dict(
-                topic=self.update_key,
-                data=list(map(lambda item: item.to_dict(), self.data)),
-            ),
-            self.sorting,
-        )
+        changes = self.diff()
+        self.cbpi.ws.send_changes(self, changes)
         # self.cbpi.push_update("cbpi/{}".format(self.update_key), list(map(lambda item: item.to_dict(), self.data)))
-        for item in self.data:
-            self.cbpi.push_update(
-                "cbpi/{}/{}".format(self.update_key, item.id), item.to_dict()
-            )
+        # only changed items are published, the messages are retained
+        for id, fields, revision in changes:
+            if fields is not None:
+                self.cbpi.push_update(
+                    "cbpi/{}/{}".format(self.update_key, id),
+                    self._published[id],
+                    retain=True,
+                )
+
+    def push_item_update(self, item):
+        """
+        Send the changes of a single item to the websocket clients
+        """
+        self.cbpi.ws.send_changes(self, self.diff([item]))
+
+    def diff(self, items=None):
+        """
+        Compare items with the state last sent and take a new revision for every changed item
+        :param items: items to check, all items if None. Removed items are only detected for None
+        :return: list of (id, changed fields or None if removed, revision)
+        """
+        changes = []
+        for item in self.data if items is None else items:
+            current = item.to_dict()
+            last = self._published.get(item.id)
+            if last is None:
+                fields = current
+            else:
+                fields = {
+                    key: value for key, value in current.items() if last.get(key) != value
+                }
+            if len(fields) > 0:
+                self._published[item.id] = current
+                self.revision += 1
+                changes.append((item.id, fields, self.revision))
+        if items is None:
+            ids = set(item.id for item in self.data)
+            for id in [id for id in self._published if id not in ids]:
+                del self._published[id]
+                self.revision += 1
+                changes.append((id, None, self.revision))
+        return changes
+
+    def get_snapshot(self):
+        """
+        Full list of items with the current revision
+        """
+        return dict(
+            topic=self.update_key,
+            data=list(map(lambda item: item.to_dict(), self.data)),
+            revision=self.revision,
+        )
 
     def find_by_id(self, id):
-        return next((item for item in self.data if item.id == id), None)
+        return self._index.get(self.data, id)
 
     def get_index_by_id(self, id):
-        return next((i for i, item in enumerate(self.data) if item.id == id), None)
+        return self._index.position(self.data, id)
 
     async def shutdown(self, app):
         logging.info("{} Shutdown ".format(self.name))
@@ -166,6 +219,7 @@ class BasicController:
         logging.info("{} Add".format(self.name))
         item.id = shortuuid.uuid()
         self.data.append(item)
+        self._index.rebuild(self.data)
         if self.autostart is True:
             await self.start(item.id)
         await self.save()
@@ -180,6 +234,7 @@ class BasicController:
                 lambda old_item: item if old_item.id == item.id else old_item, self.data
             )
         )
+        self._index.rebuild(self.data)
         if self.autostart is True:
             await self.start(item.id)
         await self.save()
@@ -189,6 +244,7 @@ class BasicController:
         logging.info("{} Delete".format(self.name))
         await self.stop(id)
         self.data = list(filter(lambda x: x.id != id, self.data))
+        self._index.rebuild(self.data)
         await self.save()
 
     async def call_action(self, id, action, parameter) -> None:
@@ -15,6 +15,7 @@ import shortuuid
 import yaml
 from cbpi.api.dataclasses import Fermenter, FermenterStep, Props, Step
 from cbpi.controller.basic_controller2 import BasicController
+from cbpi.utils.id_index import IdIndex
 from tabulate import tabulate
 
 from ..api.step import (CBPiFermentationStep, CBPiStep, StepMove, StepResult,
@@ -29,6 +30,8 @@ class FermentationController:
         self.logger = logging.getLogger(__name__)
         self.path = self.cbpi.config_folder.get_file_path("fermenter_data.json")
         self.data = []
+        # id -> position in self.data
+        self._index = IdIndex()
         self.types = {}
         self.steptypes = {}
         self.cbpi.app.on_cleanup.append(self.shutdown)
@@ -83,6 +86,7 @@ class FermentationController:
 
                 for i in data["data"]:
                     self.data.append(self._create(i))
+                self._index.rebuild(self.data)
         except:
             logging.warning("Invalid fermenter_data.json file - Creating empty file")
             os.remove(self.path)
@@ -91,6 +95,7 @@ class FermentationController:
             json.dump(data, open(destfile, "w"), indent=4, sort_keys=True)
             for i in data["data"]:
                 self.data.append(self._create(i))
+            self._index.rebuild(self.data)
 
     def _create_step(self, fermenter, item):
         id = item.get("id")
@@ -175,7 +180,7 @@ class FermentationController:
             return
 
     def _find_by_id(self, id):
-        return next((item for item in self.data if item.id == id), None)
+        return self._index.get(self.data, id)
 
     async def get_all(self):
         return list(map(lambda x: x.to_dict(), self.data))
@@ -247,6 +252,7 @@ class FermentationController:
     async def create(self, data: Fermenter):
         data.id = shortuuid.uuid()
         self.data.append(data)
+        self._index.rebuild(self.data)
         self.save()
         self.push_update()
         return data
@@ -271,6 +277,7 @@ class FermentationController:
         self.data = list(
             map(lambda old: _update(old, item) if old.id == item.id else old, self.data)
         )
+        self._index.rebuild(self.data)
         self.save()
         self.push_update()
         return item
@@ -300,6 +307,7 @@ class FermentationController:
     async def delete(self, id: str):
         item = self._find_by_id(id)
         self.data = list(filter(lambda item: item.id != id, self.data))
+        self._index.rebuild(self.data)
         self.save()
         self.push_update()
 
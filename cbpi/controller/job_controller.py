@@ -1,6 +1,10 @@
 import asyncio
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from aiohttp import web
+from cbpi.api.exceptions import CBPiException
 from cbpi.job.aiohttp import get_scheduler_from_app, setup
 
 logger = logging.getLogger(__name__)
@@ -10,9 +14,19 @@ class JobController(object):
 
     def __init__(self, cbpi):
         self.cbpi = cbpi
+        self.query_executor = None
+        self.query_pending = 0
+        self.query_workers = int(cbpi.static_config.get("query_workers", 1))
+        self.query_queue_size = int(cbpi.static_config.get("query_queue_size", 8))
+        self.query_timeout = float(cbpi.static_config.get("query_timeout", 60))
+        # seconds a client is asked to wait when all query slots are taken
+        self.query_retry_after = int(cbpi.static_config.get("query_retry_after", 5))
+        self.query_slots = None
 
     async def init(self):
         await setup(self.cbpi.app, self.cbpi)
+        self.query_slots = asyncio.Semaphore(self.query_workers)
+        self.cbpi.app.on_cleanup.append(self.shutdown_query_executor)
 
     def register_background_task(self, obj):
         """
@@ -54,3 +68,102 @@ class JobController(object):
     async def start_job(self, method, name, type):
         scheduler = get_scheduler_from_app(self.cbpi.app)
         return await scheduler.spawn(method, name, type)
+
+    def get_query_executor(self):
+        """
+        The process pool for cpu bound queries is started on first use.
+        Falls back to a thread pool where processes are not available.
+        """
+        if self.query_executor is None:
+            try:
+                self.query_executor = ProcessPoolExecutor(
+                    max_workers=self.query_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            except Exception as e:
+                logger.warning("Query process pool not available: {}".format(e))
+                self.query_executor = ThreadPoolExecutor(max_workers=self.query_workers)
+        return self.query_executor
+
+    async def shutdown_query_executor(self, app):
+        if self.query_executor is not None:
+            self.query_executor.shutdown(wait=False, cancel_futures=True)
+            self.query_executor = None
+
+    async def _wait_disconnect(self, request):
+        while request.transport is not None and not request.transport.is_closing():
+            await asyncio.sleep(0.5)
+
+    def _query_done(self, job):
+        self.query_slots.release()
+        self.query_pending -= 1
+
+    async def _run_query(self, method, args, request, jobs):
+        loop = asyncio.get_running_loop()
+        await self.query_slots.acquire()
+        try:
+            job = self.get_query_executor().submit(method, *args)
+        except Exception:
+            self.query_slots.release()
+            raise
+        jobs.append(job)
+
+        def done(job):
+            # a query that already runs in a worker is finished there even after a timeout or
+            # disconnect, its slot is only free again when the worker is
+            try:
+                loop.call_soon_threadsafe(self._query_done, job)
+            except RuntimeError:
+                pass  # loop closed on shutdown
+
+        job.add_done_callback(done)
+        query = asyncio.wrap_future(job)
+        waiters = [query]
+        if request is not None:
+            waiters.append(asyncio.ensure_future(self._wait_disconnect(request)))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # the result of a running query is dropped, a waiting one is not started at all
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.cancel()
+        if query.cancelled():
+            logger.info("Client disconnected, query {} cancelled".format(method.__name__))
+            raise asyncio.CancelledError()
+        return query.result()
+
+    async def run_query(self, method, *args, timeout=None, request=None):
+        """
+        Run a cpu bound function outside of the event loop. The function and its arguments
+        have to be picklable. At most query_workers queries run at the same time and at most
+        query_queue_size wait for a free worker. Queries which timed out or lost their client
+        count until the worker is done with them.
+
+        :param method: module level function
+        :param args: arguments for the function
+        :param timeout: seconds until the query is cancelled, default from static config query_timeout
+        :param request: web request, the query is cancelled if its client disconnects
+        :return: result of the function
+        :raises web.HTTPServiceUnavailable: if the queue is full, with a Retry-After header
+        """
+        if self.query_pending >= self.query_workers + self.query_queue_size:
+            raise web.HTTPServiceUnavailable(
+                headers={"Retry-After": str(self.query_retry_after)},
+                text="Too many queries pending. Please try again later",
+            )
+        timeout = self.query_timeout if timeout is None else timeout
+        self.query_pending += 1
+        jobs = []
+        try:
+            return await asyncio.wait_for(
+                self._run_query(method, args, request, jobs), timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            raise CBPiException(
+                "Query {} timed out after {} s".format(method.__name__, timeout)
+            )
+        finally:
+            if len(jobs) == 0:
+                # never handed to a worker, otherwise released by _query_done
+                self.query_pending -= 1
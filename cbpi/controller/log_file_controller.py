@@ -7,13 +7,16 @@ import os
 import zipfile
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from time import localtime, strftime
+from time import localtime, strftime, time
 
+import numpy as np
 import pandas as pd
 import shortuuid
 from cbpi.api import *
 from cbpi.api.base import CBPiBase
 from cbpi.api.config import ConfigType
+from cbpi.utils import binlog, log_cache, log_query, rollup, sqlite_log
+from cbpi.utils.write_behind import WriteBehindQueue
 from urllib3 import PoolManager, Timeout
 
 
@@ -28,9 +31,38 @@ class LogController:
         self.logger = logging.getLogger(__name__)
         self.configuration = False
         self.datalogger = {}
+        self.binarylogger = {}
+        self.rollups = {}
+        # closed rollup buckets are written by the writer thread of this queue
+        self.rollup_queue = None
+        # resampled series of recent queries, invalidated per sensor by log_data
+        self.cache = log_cache.SeriesCache(
+            int(float(self.cbpi.static_config.get("log_cache_mb", 16)) * 1024 * 1024)
+        )
+        self.log_versions = {}
         self.logsFolderPath = self.cbpi.config_folder.logsFolderPath
         self.logger.info("Log folder path  : " + self.logsFolderPath)
         self.sensor_data_listeners = {}
+        self.write_queues = []
+        self.cbpi.app.on_cleanup.append(self.shutdown)
+
+    async def shutdown(self, app):
+        for writer in self.rollups.values():
+            writer.close()
+        if self.rollup_queue is not None:
+            await self.rollup_queue.close()
+
+    def add_write_queue(self, queue) -> None:
+        """
+        Register the write-behind queue of a log target. Queued samples are written before
+        logs are read from disk.
+        :param queue: cbpi.utils.write_behind.WriteBehindQueue
+        """
+        self.write_queues.append(queue)
+
+    async def flush_writes(self) -> None:
+        for queue in self.write_queues:
+            await queue.flush()
 
     def add_sensor_data_listener(self, method):
         listener_id = shortuuid.uuid()
@@ -43,13 +75,69 @@ class LogController:
         except:
             self.logger.error("Failed to remove listener {}".format(listener_id))
 
-    async def _call_sensor_data_listeners(self, sensor_id, value, formatted_time, name):
-        for listener_id, method in self.sensor_data_listeners.items():
-            asyncio.create_task(
-                method(self.cbpi, sensor_id, value, formatted_time, name)
+    def _notify_sensor_data_listeners(self, sensor_id, value, formatted_time, name):
+        # plain functions are called directly, only coroutine listeners get a task
+        for listener_id, method in list(self.sensor_data_listeners.items()):
+            if asyncio.iscoroutinefunction(method):
+                asyncio.create_task(
+                    method(self.cbpi, sensor_id, value, formatted_time, name)
+                )
+            else:
+                try:
+                    method(self.cbpi, sensor_id, value, formatted_time, name)
+                except Exception as e:
+                    logging.error(
+                        "sensor logging listener {} exception: {}".format(listener_id, e)
+                    )
+
+    def local_logging(self) -> bool:
+        """
+        :return: True if one of the log targets writing to the logs folder is switched on
+        """
+        return (
+            self.cbpi.config.get("CSVLOGFILES", "Yes") == "Yes"
+            or self.cbpi.config.get("BINARYLOGFILES", "No") == "Yes"
+            or self.cbpi.config.get("SQLITELOGFILES", "No") == "Yes"
+        )
+
+    def _get_rollup_queue(self):
+        if self.rollup_queue is None:
+            self.rollup_queue = WriteBehindQueue(
+                rollup.write_batch,
+                max_items=1000,
+                interval=float(self.cbpi.config.get("SENSOR_LOG_FLUSH_INTERVAL", 5)),
+                name="rollup-log",
+            )
+            self.rollup_queue.start()
+            self.add_write_queue(self.rollup_queue)
+        return self.rollup_queue
+
+    def _update_rollups(self, id, value):
+        # rollups summarize the local logs, they are kept under the same switches
+        if self.cbpi.config.get("SENSOR_LOG_ROLLUPS", "Yes") == "No" or not self.local_logging():
+            return
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        if id not in self.rollups:
+            # same size limit per tier file as the raw logs of a sensor in total
+            max_bytes = int(self.cbpi.config.get("SENSOR_LOG_MAX_BYTES", 100000))
+            backup_count = int(self.cbpi.config.get("SENSOR_LOG_BACKUP_COUNT", 3))
+            self.rollups[id] = rollup.RollupWriter(
+                self.logsFolderPath,
+                id,
+                max_bytes=max_bytes * (backup_count + 1),
+                queue=self._get_rollup_queue(),
             )
+        try:
+            self.rollups[id].add(time(), value)
+        except Exception as e:
+            logging.error("sensor rollup exception: {}".format(e))
 
     def log_data(self, id: str, value: str) -> None:
+        self.log_versions[id] = self.log_versions.get(id, 0) + 1
+        self._update_rollups(id, value)
         # all plugin targets:
         if self.sensor_data_listeners:  # true if there are listners
             try:
@@ -57,19 +145,163 @@ class LogController:
                 if sensor is not None:
                     name = sensor.name.replace(" ", "_")
                     formatted_time = strftime("%Y-%m-%d %H:%M:%S", localtime())
-                    asyncio.create_task(
-                        self._call_sensor_data_listeners(
-                            id, value, formatted_time, name
-                        )
+                    self._notify_sensor_data_listeners(
+                        id, value, formatted_time, name
                     )
             except Exception as e:
                 logging.error("sensor logging listener exception: {}".format(e))
 
-    async def get_data(self, names, sample_rate="60s"):
+    def resolve_window(self, start=None, end=None):
+        """
+        :param start: epoch seconds, negative values are relative to now, None for no lower bound
+        :param end: epoch seconds, negative values are relative to now, None for no upper bound
+        :return: tuple of absolute (start, end) epoch seconds
+        """
+        now = time()
+        if start is not None and start < 0:
+            start = now + start
+        if end is not None and end < 0:
+            end = now + end
+        return start, end
+
+    def pending_rollups(self, ids):
+        """
+        Open rollup buckets of the sensors. They are not on disk yet and are handed to the query.
+        :param ids: sensor ids
+        :return: dict of sensor id -> {tier: structured array}
+        """
+        result = {}
+        for id in ids:
+            writer = self.rollups.get(id)
+            if writer is not None:
+                result[id] = {tier: writer.pending(tier) for tier in writer.tiers}
+        return result
+
+    async def get_rollup(
+        self, ids, resolution=60, start=None, end=None, limit=None, request=None
+    ) -> dict:
+        """
+        Min / max / mean / count per bucket from the coarsest tier that satisfies the resolution
+        :param ids: list of sensor ids
+        :param resolution: requested resolution in seconds
+        :param start: epoch seconds of the first bucket, negative values are relative to now
+        :param end: epoch seconds of the last bucket, negative values are relative to now
+        :param limit: max number of newest buckets per sensor
+        :param request: web request, the query is cancelled if its client disconnects
+        :return: dict with resolution, time, min, max, mean and count lists per sensor id
+        """
+        start, end = self.resolve_window(start, end)
+        await self.flush_writes()
+        return await self.cbpi.job.run_query(
+            log_query.query_rollup,
+            self.logsFolderPath,
+            ids,
+            resolution,
+            start,
+            end,
+            limit,
+            self.pending_rollups(ids),
+            request=request,
+        )
+
+    async def get_series(self, ids, sample_rate, start=None, end=None, request=None) -> dict:
+        """
+        Resampled series of the sensors, answered from the cache where possible.
+        Closed buckets stay valid. A sensor written since its entry was cached is only read
+        again from its trailing bucket on. An entry of a window with an absolute end is final
+        once it was read after the end of the window, an entry read before is read again from
+        its trailing bucket on when the window has closed. Windows with an end relative to now
+        slide over data that is already written, they are not cached.
+        :param ids: sensor ids
+        :param sample_rate: rate for resampling the data
+        :param start: epoch seconds of the first sample, negative values are relative to now
+        :param end: epoch seconds of the last sample, negative values are relative to now
+        :param request: web request, the query is cancelled if its client disconnects
+        :return: dict of sensor id -> log_cache.SeriesEntry
+        """
+        abs_start, abs_end = self.resolve_window(start, end)
+        rate = pd.Timedelta(sample_rate).total_seconds()
+        cached = end is None or end >= 0
+        read_at = time()
+        # writes can not change a window that ended before the current bucket
+        closed = abs_end is not None and abs_end < read_at - rate
+        versions = {id: self.log_versions.get(id, 0) for id in ids}
+        entries = {}
+        missing = []
+        stale = {}
+        for id in ids:
+            entry = self.cache.get((id, sample_rate, start, end)) if cached else None
+            if entry is None or len(entry.index) == 0:
+                missing.append(id)
+                continue
+            entries[id] = entry
+            final = abs_end is not None and entry.read_at > abs_end + rate
+            if not final and (closed or entry.version != versions[id]):
+                stale[id] = float(binlog.from_local_naive(entry.index[-1:])[0])
+
+        if len(missing) > 0 or len(stale) > 0:
+            await self.flush_writes()
+
+        if len(missing) > 0:
+            series = await self.cbpi.job.run_query(
+                log_query.read_series,
+                self.logsFolderPath,
+                missing,
+                sample_rate,
+                abs_start,
+                abs_end,
+                self.pending_rollups(missing),
+                request=request,
+            )
+            for id, (index, values) in series.items():
+                entries[id] = log_cache.SeriesEntry(index, values, versions[id], read_at)
+                if cached:
+                    self.cache.put((id, sample_rate, start, end), entries[id])
+
+        if len(stale) > 0:
+            series = await self.cbpi.job.run_query(
+                log_query.read_series,
+                self.logsFolderPath,
+                list(stale),
+                sample_rate,
+                stale,
+                abs_end,
+                self.pending_rollups(stale),
+                request=request,
+            )
+            for id, (index, values) in series.items():
+                entries[id].splice(index, values, versions[id], read_at)
+                self.cache.resize((id, sample_rate, start, end))
+
+        if cached and start is not None and start < 0:
+            # the window slides, buckets that fell out of it are dropped
+            first = binlog.to_local_naive(np.array([abs_start]))[0]
+            for id, entry in entries.items():
+                entry.trim(first, rate)
+                self.cache.resize((id, sample_rate, start, end))
+        return {id: entries[id] for id in ids if id in entries}
+
+    async def get_data(
+        self,
+        names,
+        sample_rate="60s",
+        start=None,
+        end=None,
+        limit=None,
+        downsample=None,
+        width=None,
+        request=None,
+    ):
         logging.info("Start Log for {}".format(names))
         """
         :param names: name as string or list of names as string
         :param sample_rate: rate for resampling the data
+        :param start: epoch seconds of the first sample, negative values are relative to now
+        :param end: epoch seconds of the last sample, negative values are relative to now
+        :param limit: max number of newest rows per sensor
+        :param downsample: nth (default), lttb or minmax
+        :param width: chart width in pixel, max number of points per sensor
+        :param request: web request, the query is cancelled if its client disconnects
         :return:
         """
         # make string to array
@@ -78,91 +310,74 @@ class LogController:
 
         # remove duplicates
         names = set(names)
-        timestamp_format = "%Y-%m-%d %H:%M:%S"
-
-        result = None
 
-        for name in names:
-            # get all log names
-            all_filenames = glob.glob(
-                os.path.join(self.logsFolderPath, f"sensor_{name}.log*")
+        if sample_rate is None:
+            await self.flush_writes()
+            start, end = self.resolve_window(start, end)
+            data = await self.cbpi.job.run_query(
+                log_query.query_data,
+                self.logsFolderPath,
+                names,
+                sample_rate,
+                start,
+                end,
+                limit,
+                None,
+                downsample,
+                width,
+                request=request,
             )
-            # concat all logs
-            df = pd.concat(
-                [
-                    pd.read_csv(
-                        f, parse_dates=True, names=["DateTime", name], header=None
-                    )
-                    for f in all_filenames
-                ]
-            )
-            logging.info("Read all files for {}".format(names))
-            df["DateTime"] = pd.to_datetime(df["DateTime"], format=timestamp_format)
-            df.set_index("DateTime", inplace=True)
-
-            # resample if rate provided
-            if sample_rate is not None:
-                df = df[name].resample(sample_rate).max()
-            logging.info("Sampled now for {}".format(names))
-            df = df.dropna()
-            # take every nth row so that total number of rows does not exceed max_rows * 2
-            max_rows = 500
-            total_rows = df.shape[0]
-            if (total_rows > 0) and (total_rows > max_rows):
-                nth = int(total_rows / max_rows)
-                if nth > 1:
-                    df = df.iloc[::nth]
-
-            if result is None:
-                result = df
-            else:
-                result = pd.merge(
-                    result, df, how="outer", left_index=True, right_index=True
-                )
-
-        data = {"time": df.index.tolist()}
-
-        if len(names) > 1:
-            for name in names:
-                data[name] = (
-                    result[name].interpolate(limit_direction="both", limit=10).tolist()
-                )
         else:
-            data[name] = result.interpolate().tolist()
+            series = await self.get_series(names, sample_rate, start, end, request)
+            data = await self.cbpi.job.run_query(
+                log_query.format_data,
+                {id: (entry.index, entry.values) for id, entry in series.items()},
+                names,
+                limit,
+                downsample,
+                width,
+                request=request,
+            )
 
         logging.info("Send Log for {}".format(names))
 
         return data
 
-    async def get_data2(self, ids) -> dict:
-        timestamp_format = "%Y-%m-%d %H:%M:%S"
+    async def get_data2(
+        self,
+        ids,
+        start=None,
+        end=None,
+        limit=None,
+        downsample=None,
+        width=None,
+        request=None,
+    ) -> dict:
+        """
+        :param ids: list of sensor ids
+        :param start: epoch seconds of the first sample, negative values are relative to now
+        :param end: epoch seconds of the last sample, negative values are relative to now
+        :param limit: max number of newest rows per sensor
+        :param downsample: nth, lttb or minmax, default all rows
+        :param width: chart width in pixel, max number of points per sensor
+        :param request: web request, the query is cancelled if its client disconnects
+        :return: dict with time and value list per sensor id
+        """
+        series = await self.get_series(ids, "60s", start, end, request)
+        if downsample is not None:
+            return await self.cbpi.job.run_query(
+                log_query.format_data2,
+                {id: (entry.index, entry.values) for id, entry in series.items()},
+                limit,
+                downsample,
+                width,
+                request=request,
+            )
+        # the cached lists are sliced, no dataframe is built
         result = dict()
-        for id in ids:
-            try:
-                all_filenames = glob.glob(
-                    os.path.join(self.logsFolderPath, f"sensor_{id}.log*")
-                )
-                df = pd.concat(
-                    [
-                        pd.read_csv(
-                            f,
-                            parse_dates=["DateTime"],
-                            names=["DateTime", "Values"],
-                            header=None,
-                        )
-                        for f in all_filenames
-                    ]
-                )
-                df["DateTime"] = pd.to_datetime(df["DateTime"], format=timestamp_format)
-                df.set_index("DateTime", inplace=True)
-                df = df.resample("60s").max()
-                df = df.dropna()
-                result[id] = {
-                    "time": df.index.astype(str).tolist(),
-                    "value": df.Values.tolist(),
-                }
-            except:
-                pass
+        for id, entry in series.items():
+            first = max(0, len(entry.time) - limit) if limit else 0
+            result[id] = {"time": entry.time[first:], "value": entry.value[first:]}
         return result
 
     def get_logfile_names(self, name: str) -> list:
@@ -177,23 +392,50 @@ class LogController:
             for x in glob.glob(os.path.join(self.logsFolderPath, f"sensor_{name}.log*"))
         ]
 
-    def clear_log(self, name: str) -> str:
+    async def clear_log(self, name: str) -> str:
+        logging.info(f"Deleting logfiles for sensor {name}.")
+        # queued samples would otherwise recreate the files once they are deleted
+        await self.flush_writes()
+        # no await until the files are gone, a logger opened meanwhile would keep writing
+        # to a deleted file
         all_filenames = glob.glob(
             os.path.join(self.logsFolderPath, f"sensor_{name}.log*")
         )
 
-        logging.info(f"Deleting logfiles for sensor {name}.")
-
         if name in self.datalogger:
-            self.datalogger[name].removeHandler(self.datalogger[name].handlers[0])
+            self.datalogger[name].close()
             del self.datalogger[name]
 
+        if name in self.binarylogger:
+            self.binarylogger[name].close()
+            del self.binarylogger[name]
+        try:
+            binlog.remove_segments(self.logsFolderPath, name)
+        except Exception as e:
+            logging.warning(e)
+
+        if name in self.rollups:
+            del self.rollups[name]
+        self.cache.remove(name)
+        try:
+            rollup.remove_rollups(self.logsFolderPath, name)
+        except Exception as e:
+            logging.warning(e)
+
         for f in all_filenames:
             try:
                 os.remove(f)
             except Exception as e:
                 logging.warning(e)
 
+        try:
+            # the delete may wait for the sqlite writer, it runs off the event loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, sqlite_log.remove, self.logsFolderPath, name
+            )
+        except Exception as e:
+            logging.warning(e)
+
     def get_all_zip_file_names(self, name: str) -> list:
         """
         Return a list of all zip file names
@@ -239,3 +481,28 @@ class LogController:
             zip.write(os.path.join(f))
         zip.close()
         return os.path.basename(file_name)
+
+    async def get_zip_files(self, name: str, folder: str, request=None) -> list:
+        """
+        The csv logs are sent as they are. If the sensor has a binary or sqlite log, the samples
+        of all stores are exported into one csv file instead, the csv logs miss the samples
+        written while the csv target was off.
+        :param name: sensor name
+        :param folder: folder for the export, removed by the caller once the zip is sent
+        :param request: web request, the export is cancelled if its client disconnects
+        :return: list of (path, name in the archive) for a streamed zip
+        :raises CBPiException: if the sensor has no log data
+        """
+        await self.flush_writes()
+        path = os.path.join(folder, f"sensor_{name}.csv")
+        count = await self.cbpi.job.run_query(
+            log_query.export_csv, self.logsFolderPath, name, path, request=request
+        )
+        if count > 0:
+            return [(path, os.path.basename(path))]
+        all_filenames = sorted(
+            glob.glob(os.path.join(self.logsFolderPath, f"sensor_{name}.log*"))
+        )
+        if len(all_filenames) == 0:
+            raise CBPiException("No log data for sensor {}".format(name))
+        return [(f, os.path.basename(f)) for f in all_filenames]
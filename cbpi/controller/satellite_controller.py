@@ -1,12 +1,19 @@
 import asyncio
 import json
 import logging
+import random
+import time
 from contextlib import AsyncExitStack, asynccontextmanager
 from re import M
 
 import shortuuid
 import aiomqtt
 from cbpi import __version__
+from cbpi.utils import json_encode
+from cbpi.utils.mqtt_dispatcher import MQTTDispatcher
+from cbpi.utils.mqtt_payload import PayloadDecoder
+from cbpi.utils.mqtt_publisher import MQTTPublisher
+from cbpi.utils.topic_trie import TopicTrie
 
 
 
@@ -25,7 +32,18 @@ class SatelliteController:
         self.username = cbpi.static_config.get("mqtt_username", None)
         self.password = cbpi.static_config.get("mqtt_password", None)
         self.client = None
-        self.topic_filters = [
+        self.connected = False
+        # reconnect delay in seconds, doubled after every failed attempt
+        self.min_backoff = float(cbpi.static_config.get("mqtt_reconnect_min", 1))
+        self.max_backoff = float(cbpi.static_config.get("mqtt_reconnect_max", 60))
+        self.backoff = self.min_backoff
+        self.connects = 0
+        self.disconnects = 0
+        self.connected_since = None
+        self.last_error = None
+        # only the registered filters are subscribed at the broker
+        self.topic_filters = TopicTrie()
+        for topic, method in [
             ("cbpi/actor/+/on", self._actor_on),
             ("cbpi/actor/+/off", self._actor_off),
             ("cbpi/actor/+/power", self._actor_power),
@@ -34,8 +52,25 @@ class SatelliteController:
             ("cbpi/updatekettle", self._kettleupdate),
             ("cbpi/updatesensor", self._sensorupdate),
             ("cbpi/updatefermenter", self._fermenterupdate),
-        ]
+        ]:
+            self.topic_filters.add(topic, method)
         self.tasks = set()
+        # shared JSON decoding for handlers reading values from the same topic
+        self.payloads = PayloadDecoder(self)
+        # handlers run concurrently, in order per topic and all commands of one actor in order
+        self.dispatcher = MQTTDispatcher(
+            max_concurrency=int(cbpi.static_config.get("mqtt_dispatch_concurrency", 8)),
+            max_pending=int(cbpi.static_config.get("mqtt_dispatch_queue_size", 1000)),
+            order_key=self.order_key,
+        )
+        # all publishes go through one queue, mqtt_topic_qos maps topic filters to a QoS,
+        # the most specific filter matching a topic wins regardless of the order
+        self.publisher = MQTTPublisher(
+            self._send,
+            max_size=int(cbpi.static_config.get("mqtt_publish_queue_size", 1000)),
+            qos=int(cbpi.static_config.get("mqtt_qos", 1)),
+            topic_qos=cbpi.static_config.get("mqtt_topic_qos", None),
+        )
 
     def remove_key(self, d, key):
         r = dict(d)
@@ -52,13 +87,14 @@ class SatelliteController:
             will=aiomqtt.Will(topic="cbpi/disconnect", payload="CBPi Server Disconnected"),
             identifier=self.client_id,
         )
+        self.publisher.start()
+        self.cbpi.app.on_cleanup.append(self.shutdown)
         try:
             ## Listen for mqtt messages in an (unawaited) asyncio task
             task = asyncio.create_task(self.listen())
             ## Save a reference to the task so it doesn't get garbage collected
             self.tasks.add(task)
             task.add_done_callback(self.tasks.discard)
-            self.logger.info("MQTT Connected to {}:{}".format(self.host, self.port))
         except asyncio.CancelledError as e:
             self.logger.error("MQTT Connection failed: {}".format(e))
 
@@ -66,31 +102,94 @@ class SatelliteController:
         while True:
             try:
                 async with self.client as client:
-                    await client.subscribe("#")
+                    self.connected = True
+                    self.connects += 1
+                    self.connected_since = time.time()
+                    self.backoff = self.min_backoff
+                    self.logger.info("MQTT Connected to {}:{}".format(self.host, self.port))
+                    # a new session has no subscriptions, all filters are subscribed again
+                    filters = self.topic_filters.filters()
+                    if len(filters) > 0:
+                        await client.subscribe([(topic, 0) for topic in filters])
+                    self.publisher.resume()
                     async for message in client.messages:
-                        for topic_filter in self.topic_filters:
-                            topic = topic_filter[0]
-                            method = topic_filter[1]
-                            if message.topic.matches(topic):
-                                await method(message)
+                        await self.dispatch(message)
             except asyncio.CancelledError:
                 # Cancel
                 self.logger.warning("MQTT Listening Cancelled")
                 break
-            except Exception as e:
-                self.logger.error("MQTT General Exception: {}".format(e))
-                break
             except aiomqtt.MqttError as e:
+                self.last_error = str(e)
                 self.logger.error("MQTT Exception: {}".format(e))
+            except Exception as e:
+                self.last_error = str(e)
+                self.logger.error("MQTT General Exception: {}".format(e))
+            finally:
+                if self.connected:
+                    self.disconnects += 1
+                self.connected = False
+                self.connected_since = None
+
+            # jitter keeps several clients from reconnecting at the same moment
+            delay = random.uniform(self.backoff / 2, self.backoff)
+            self.logger.info("MQTT reconnect in {:.1f}s".format(delay))
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            await asyncio.sleep(delay)
+
+    def order_key(self, method, topic):
+        """
+        :return: queue key of the dispatcher, cbpi/actor/<id>/... commands share one per actor
+        """
+        if method in (self._actor_on, self._actor_off, self._actor_power, self._actor_output):
+            return ("actor", topic.split("/")[2])
+        return (method, topic)
 
-            await asyncio.sleep(5)
+    async def dispatch(self, message):
+        await self.dispatcher.dispatch(
+            self.topic_filters.match(message.topic.value), message
+        )
+
+    def get_stats(self):
+        return dict(
+            connection=dict(
+                connected=self.connected,
+                connected_since=self.connected_since,
+                connects=self.connects,
+                disconnects=self.disconnects,
+                backoff=self.backoff,
+                last_error=self.last_error,
+            ),
+            publish=self.publisher.get_stats(),
+            dispatch=self.dispatcher.get_stats(),
+            payloads=self.payloads.get_stats(),
+        )
 
-    async def publish(self, topic, message, retain=False):
-        if self.client is not None and self.client._connected:
+    async def shutdown(self, app):
+        try:
+            await asyncio.wait_for(self.publisher.close(), timeout=5)
+        except asyncio.TimeoutError:
+            self.logger.warning("MQTT publishes left unsent on shutdown")
+        await self.dispatcher.close()
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def publish(self, topic, message, retain=False, qos=None):
+        self.publisher.put(topic, message, retain, qos)
+
+    def push(self, topic, data, retain=False, qos=None):
+        """
+        Publish data encoded as JSON
+        """
+        self.publisher.put(topic, json_encode(data), retain, qos)
+
+    async def _send(self, topic, payload, qos, retain):
+        if self.client is not None and self.connected:
             try:
-                await self.client.publish(topic, message, qos=1, retain=retain)
+                await self.client.publish(topic, payload, qos=qos, retain=retain)
+                return True
             except aiomqtt.MqttError as e:
                 self.logger.warning("Failed to push data via mqtt: {}".format(e))
+        return False
 
     async def _actor_on(self, message):
         try:
@@ -185,9 +284,33 @@ class SatelliteController:
             self.logger.warning("Failed to send sensorupdate via mqtt: {}".format(e))
 
     def subscribe(self, topic, method):
-        self.topic_filters.append((topic, method))
+        if self.topic_filters.add(topic, method):
+            self._update_subscription(topic, True)
         return True
 
     def unsubscribe(self, topic, method):
-        self.topic_filters.remove((topic, method))
+        if self.topic_filters.remove(topic, method):
+            self._update_subscription(topic, False)
         return True
+
+    def _update_subscription(self, topic, subscribe):
+        # while disconnected all filters are subscribed on the next connect
+        if self.client is None or self.connected is False:
+            return
+
+        async def update():
+            try:
+                if subscribe:
+                    await self.client.subscribe(topic)
+                else:
+                    await self.client.unsubscribe(topic)
+            except aiomqtt.MqttError as e:
+                self.logger.warning(
+                    "Failed to {} mqtt topic {}: {}".format(
+                        "subscribe" if subscribe else "unsubscribe", topic, e
+                    )
+                )
+
+        task = asyncio.create_task(update())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
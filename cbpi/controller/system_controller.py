@@ -1,4 +1,3 @@
-import glob
 import importlib
 import json
 import logging
@@ -16,6 +15,7 @@ from cbpi.api import *
 from cbpi.api.base import CBPiBase
 from cbpi.api.config import ConfigType
 from cbpi.api.dataclasses import NotificationAction, NotificationType
+from cbpi.utils.zip_stream import folder_files
 from tabulate import tabulate
 from voluptuous.schema_builder import message
 
@@ -51,23 +51,14 @@ class SystemController:
         os.system("systemctl poweroff")
         pass
 
-    async def backupConfig(self):
-        files = glob.glob("*cbpi4_config*.zip")
-        for f in files:
-            try:
-                os.remove(f)
-            except Exception as e:
-                logging.error("Cannot remove old config backup: {}".format(e))
-
-        try:
-            current_date = date.today()
-            current_date = str(current_date).replace("-", "_")
-            output_filename = current_date + "_cbpi4_config"
-        except:
-            output_filename = "cbpi4_config"
-        dir_name = pathlib.Path(self.cbpi.config_folder.get_file_path(""))
-        shutil.make_archive(output_filename, "zip", dir_name)
-        return output_filename + ".zip"
+    def get_backup_files(self):
+        """
+        Config backup to be streamed as zip
+        :return: tuple of archive file name and list of (path, name in the archive)
+        """
+        current_date = str(date.today()).replace("-", "_")
+        dir_name = self.cbpi.config_folder.get_file_path("")
+        return current_date + "_cbpi4_config.zip", folder_files(dir_name)
 
     async def plugins_list(self):
         result = []
@@ -7,7 +7,6 @@ try:
     from asyncio import WindowsSelectorEventLoopPolicy, set_event_loop_policy
 except ImportError:
     pass
-import json
 import logging
 import os
 from os import urandom
@@ -253,10 +252,7 @@ class CraftBeerPi:
     def push_update(self, topic, data, retain=False) -> None:
 
         if self.satellite is not None:
-            background_tasks = set()
-            task = asyncio.create_task(self.satellite.publish(topic=topic, message=json.dumps(data), retain=retain))
-            background_tasks.add(task)
-            task.add_done_callback(background_tasks.discard)
+            self.satellite.push(topic, data, retain)
 
     async def call_initializer(self, app):
         self.initializer = sorted(self.initializer, key=lambda k: k['order'])
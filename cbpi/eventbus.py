@@ -1,27 +1,84 @@
 import asyncio
+import bisect
 import inspect
 import logging
+import time
 
 from cbpi.api import *
+from cbpi.utils import topic_trie
 
 
 class CBPiEventBus(object):
 
-    class Node(object):
-        __slots__ = "_children", "_content"
-
-        def __init__(self):
-            self._children = {}
-            self._content = None
+    Node = topic_trie.Node
 
     class Content(object):
-        def __init__(self, parent, topic, method, once, supports_future=False):
+        def __init__(
+            self, parent, topic, method, once, supports_future=False, coalesce=False
+        ):
             self.parent = parent
             self.method = method
             self.name = method.__name__
             self.once = once
             self.topic = topic
             self.supports_future = supports_future
+            self.is_coroutine = inspect.iscoroutinefunction(method)
+            self.key = "%s.%s" % (method.__module__, self.name)
+            # coalescing handlers get one slot per topic, a newer event replaces a waiting one
+            self.coalesce = coalesce
+            self.mailbox = {}
+            self.running = False
+
+    class TopicStats(object):
+        __slots__ = "fires", "fanout", "max_fanout", "timeouts"
+
+        def __init__(self):
+            self.fires = 0
+            self.fanout = 0
+            self.max_fanout = 0
+            self.timeouts = 0
+
+        def to_dict(self):
+            return dict(
+                fires=self.fires,
+                avg_fanout=self.fanout / self.fires if self.fires > 0 else 0,
+                max_fanout=self.max_fanout,
+                timeouts=self.timeouts,
+            )
+
+    class HandlerStats(object):
+        __slots__ = "calls", "errors", "timeouts", "dropped", "total", "max", "histogram"
+
+        # upper bounds in seconds of the latency histogram, the last bucket holds everything slower
+        BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0)
+
+        def __init__(self):
+            self.calls = 0
+            self.errors = 0
+            self.timeouts = 0
+            self.dropped = 0
+            self.total = 0.0
+            self.max = 0.0
+            self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+        def add(self, duration):
+            self.calls += 1
+            self.total += duration
+            if duration > self.max:
+                self.max = duration
+            self.histogram[bisect.bisect_left(self.BUCKETS, duration)] += 1
+
+        def to_dict(self):
+            return dict(
+                calls=self.calls,
+                errors=self.errors,
+                timeouts=self.timeouts,
+                dropped=self.dropped,
+                total=self.total,
+                avg=self.total / self.calls if self.calls > 0 else 0,
+                max=self.max,
+                histogram=self.histogram,
+            )
 
     class Result:
 
@@ -47,7 +104,15 @@ class CBPiEventBus(object):
                 raise CBPiException("Event Key %s not found." % key)
             return (r.result, r.timeout)
 
-    def register(self, topic, method, once=False):
+    def register(self, topic, method, once=False, coalesce=False):
+        """
+        :param topic: topic, may contain + and # wildcards
+        :param method: coroutine function called with the event data and topic
+        :param once: unregister after the first event
+        :param coalesce: deliver only the latest event per topic. The handler runs one event at
+                         a time and events arriving meanwhile replace each other instead of
+                         queueing up as tasks. Replaced events are counted as dropped.
+        """
 
         if method in self.registry:
             raise RuntimeError(
@@ -58,10 +123,10 @@ class CBPiEventBus(object):
 
         node = self._root
         for sym in topic.split("/"):
-            node = node._children.setdefault(sym, self.Node())
+            node = node.children.setdefault(sym, self.Node())
 
-        if not isinstance(node._content, list):
-            node._content = []
+        if not isinstance(node.values, list):
+            node.values = []
 
         sig = inspect.signature(method)
 
@@ -69,18 +134,20 @@ class CBPiEventBus(object):
             supports_future = True
         else:
             supports_future = False
-        c = self.Content(node, topic, method, once, supports_future)
-        node._content.append(c)
+        c = self.Content(node, topic, method, once, supports_future, coalesce)
+        c.stats = self.handler_stats.setdefault(c.key, self.HandlerStats())
+        node.values.append(c)
         self.registry[method] = c
+        self._invalidate(topic)
 
     def get_callbacks(self, key):
         try:
             node = self._root
             for sym in key.split("/"):
-                node = node._children[sym]
-            if node._content is None:
+                node = node.children[sym]
+            if node.values is None:
                 raise KeyError(key)
-            return node._content
+            return node.values
         except KeyError:
             raise KeyError(key)
 
@@ -89,19 +156,29 @@ class CBPiEventBus(object):
         if method in self.registry:
             content = self.registry[method]
             clean_idx = None
-            for idx, content_obj in enumerate(content.parent._content):
+            for idx, content_obj in enumerate(content.parent.values):
                 if method == content_obj.method:
                     clean_idx = idx
                     break
             if clean_idx is not None:
-                del content.parent._content[clean_idx]
+                del content.parent.values[clean_idx]
+            self._invalidate(content.topic)
 
-    def __init__(self, loop, cbpi):
+    def __init__(self, loop, cbpi, cache_size=1024, stats_size=1024):
         self.logger = logging.getLogger(__name__)
         self.cbpi = cbpi
         self._root = self.Node()
         self.registry = {}
         self.docs = {}
+        # concrete topic -> flat tuple of handlers, oldest topics are dropped beyond cache_size
+        self.cache_size = cache_size
+        self._dispatch_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # stats per concrete topic, the oldest topics are dropped beyond stats_size
+        self.stats_size = stats_size
+        self.topic_stats = {}
+        self.handler_stats = {}
         if loop is not None:
             self.loop = loop
         else:
@@ -125,32 +202,52 @@ class CBPiEventBus(object):
             if len(futures) > 0:
                 await asyncio.wait(futures.values())
 
-        for e in self.iter_match(topic):
-            content_array = e
-            keep_idx = []
-            for idx, content_obj in enumerate(content_array):
-
-                if inspect.iscoroutinefunction(content_obj.method):
-                    if content_obj.supports_future is True:
-                        fut = self.loop.create_future()
-                        futures[
-                            "%s.%s" % (content_obj.method.__module__, content_obj.name)
-                        ] = fut
-                        self.loop.create_task(
-                            content_obj.method(**kwargs, topic=topic, future=fut)
+        handlers = self.match(topic)
+        stats = self.topic_stats.get(topic)
+        if stats is None:
+            if len(self.topic_stats) >= self.stats_size:
+                del self.topic_stats[next(iter(self.topic_stats))]
+            stats = self.topic_stats[topic] = self.TopicStats()
+        stats.fires += 1
+        stats.fanout += len(handlers)
+        if len(handlers) > stats.max_fanout:
+            stats.max_fanout = len(handlers)
+
+        once = None
+        for content_obj in handlers:
+            if content_obj.coalesce and content_obj.is_coroutine:
+                fut = None
+                if content_obj.supports_future is True:
+                    fut = self.loop.create_future()
+                    futures[content_obj.key] = fut
+                self._post(content_obj, topic, kwargs, fut)
+            elif content_obj.is_coroutine:
+                if content_obj.supports_future is True:
+                    fut = self.loop.create_future()
+                    futures[content_obj.key] = fut
+                    self.loop.create_task(
+                        self._call(
+                            content_obj,
+                            content_obj.method(**kwargs, topic=topic, future=fut),
                         )
+                    )
 
-                    else:
-                        self.loop.create_task(content_obj.method(**kwargs, topic=topic))
                 else:
-                    # only asnyc
-                    pass
-                if content_obj.once is False:
-                    keep_idx.append(idx)
-
-            # FILTER only elements with are required
-            if len(keep_idx) < len(e):
-                e[0].parent._content = [e[0].parent._content[i] for i in keep_idx]
+                    self.loop.create_task(
+                        self._call(content_obj, content_obj.method(**kwargs, topic=topic))
+                    )
+            else:
+                # only asnyc
+                pass
+            if content_obj.once is True:
+                once = [content_obj] if once is None else once + [content_obj]
+
+        # remove handlers which are only called once
+        if once is not None:
+            for content_obj in once:
+                parent = content_obj.parent
+                parent.values = [c for c in parent.values if c is not content_obj]
+                self._invalidate(content_obj.topic)
 
         if timeout is not None:
             try:
@@ -158,13 +255,84 @@ class CBPiEventBus(object):
                 is_timedout = False
             except asyncio.TimeoutError:
                 is_timedout = True
+                stats.timeouts += 1
+                for key, fut in futures.items():
+                    if not fut.done():
+                        self.handler_stats[key].timeouts += 1
             return self.ResultContainer(futures, is_timedout)
 
+    def _post(self, content_obj, topic, kwargs, fut):
+        replaced = content_obj.mailbox.pop(topic, None)
+        if replaced is not None:
+            content_obj.stats.dropped += 1
+            if replaced[1] is not None and not replaced[1].done():
+                replaced[1].set_result(None)
+        content_obj.mailbox[topic] = (kwargs, fut)
+        if not content_obj.running:
+            content_obj.running = True
+            self.loop.create_task(self._drain(content_obj))
+
+    async def _drain(self, content_obj):
+        try:
+            while len(content_obj.mailbox) > 0:
+                topic = next(iter(content_obj.mailbox))
+                kwargs, fut = content_obj.mailbox.pop(topic)
+                if fut is None:
+                    coro = content_obj.method(**kwargs, topic=topic)
+                else:
+                    coro = content_obj.method(**kwargs, topic=topic, future=fut)
+                try:
+                    await self._call(content_obj, coro)
+                except Exception as e:
+                    self.logger.error(
+                        "Event handler {} failed: {}".format(content_obj.key, e)
+                    )
+        finally:
+            content_obj.running = False
+
+    async def _call(self, content_obj, coro):
+        # wall time from the start of the handler task until it returns
+        start = time.perf_counter()
+        try:
+            return await coro
+        except Exception:
+            content_obj.stats.errors += 1
+            raise
+        finally:
+            content_obj.stats.add(time.perf_counter() - start)
+
+    def get_stats(self):
+        """
+        Fire counts and fan-out per topic, call counts, latency histograms and timeouts per handler
+        :return: dict
+        """
+        return dict(
+            dispatch_cache=dict(
+                size=len(self._dispatch_cache),
+                max_size=self.cache_size,
+                hits=self.cache_hits,
+                misses=self.cache_misses,
+            ),
+            buckets=list(self.HandlerStats.BUCKETS),
+            topics={
+                topic: stats.to_dict()
+                for topic, stats in sorted(
+                    self.topic_stats.items(), key=lambda i: i[1].fires, reverse=True
+                )
+            },
+            handlers={
+                key: stats.to_dict()
+                for key, stats in sorted(
+                    self.handler_stats.items(), key=lambda i: i[1].total, reverse=True
+                )
+            },
+        )
+
     def dump(self):
         def rec(node, i=0):
             result = []
-            if node._content is not None:
-                for c in node._content:
+            if node.values is not None:
+                for c in node.values:
 
                     result.append(
                         dict(
@@ -173,41 +341,50 @@ class CBPiEventBus(object):
                             method=c.method.__name__,
                             path=c.method.__module__,
                             once=c.once,
+                            coalesce=c.coalesce,
                         )
                     )
 
-            if node._children is not None:
-                for c in node._children:
-                    result = result + rec(node._children[c], i + 1)
+            if node.children is not None:
+                for c in node.children:
+                    result = result + rec(node.children[c], i + 1)
             return result
 
         result = rec(self._root)
 
         return result
 
-    def iter_match(self, topic):
-
-        lst = topic.split("/")
-        normal = not topic.startswith("$")
+    def match(self, topic):
+        """
+        All handlers for a concrete topic in the order iter_match finds them
+        :param topic: topic as fired
+        :return: tuple of Content
+        """
+        handlers = self._dispatch_cache.get(topic)
+        if handlers is not None:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            handlers = tuple(c for content in self.iter_match(topic) for c in content)
+            if self.cache_size > 0:
+                if len(self._dispatch_cache) >= self.cache_size:
+                    del self._dispatch_cache[next(iter(self._dispatch_cache))]
+                self._dispatch_cache[topic] = handlers
+        return handlers
+
+    def _invalidate(self, pattern):
+        # only cached topics below the changed pattern are dropped
+        if len(self._dispatch_cache) == 0:
+            return
+        for topic in [t for t in self._dispatch_cache if topic_trie.filter_matches(pattern, t)]:
+            del self._dispatch_cache[topic]
 
-        def rec(node, i=0):
-            if i == len(lst):
-                if node._content is not None:
-                    yield node._content
-            else:
-                part = lst[i]
-                if part in node._children:
-                    for content in rec(node._children[part], i + 1):
-                        yield content
-                if "+" in node._children and (normal or i > 0):
-                    for content in rec(node._children["+"], i + 1):
-                        yield content
-            if "#" in node._children and (normal or i > 0):
-                content = node._children["#"]._content
-                if content is not None:
-                    yield content
-
-        return rec(self._root)
+    def iter_match(self, topic):
+        """
+        :param topic: topic as fired
+        :return: generator of the handler lists of all registered topics matching topic
+        """
+        return topic_trie.iter_match(self._root, topic)
 
     def register_object(self, obj):
 
@@ -223,4 +400,8 @@ class CBPiEventBus(object):
                     doc["topic"] = method.__getattribute__("topic")
                 except:
                     pass
-            self.register(method.__getattribute__("topic"), method)
+            self.register(
+                method.__getattribute__("topic"),
+                method,
+                coalesce=getattr(method, "coalesce", False),
+            )
@@ -54,6 +54,9 @@ class ConfigUpdate(CBPiExtension):
             "current_dashboard_number", None
         )
         logfiles = self.cbpi.config.get("CSVLOGFILES", None)
+        binarylogfiles = self.cbpi.config.get("BINARYLOGFILES", None)
+        sqlitelogfiles = self.cbpi.config.get("SQLITELOGFILES", None)
+        sensorlogrollups = self.cbpi.config.get("SENSOR_LOG_ROLLUPS", None)
         influxdb = self.cbpi.config.get("INFLUXDB", None)
         influxdbaddr = self.cbpi.config.get("INFLUXDBADDR", None)
         influxdbname = self.cbpi.config.get("INFLUXDBNAME", None)
@@ -66,6 +69,8 @@ class ConfigUpdate(CBPiExtension):
         PRESSURE_UNIT = self.cbpi.config.get("PRESSURE_UNIT", None)
         SENSOR_LOG_BACKUP_COUNT = self.cbpi.config.get("SENSOR_LOG_BACKUP_COUNT", None)
         SENSOR_LOG_MAX_BYTES = self.cbpi.config.get("SENSOR_LOG_MAX_BYTES", None)
+        SENSOR_LOG_FLUSH_INTERVAL = self.cbpi.config.get("SENSOR_LOG_FLUSH_INTERVAL", None)
+        SENSOR_LOG_FSYNC = self.cbpi.config.get("SENSOR_LOG_FSYNC", None)
         slow_pipe_animation = self.cbpi.config.get("slow_pipe_animation", None)
         NOTIFY_ON_ERROR = self.cbpi.config.get("NOTIFY_ON_ERROR", None)
         PLAY_BUZZER = self.cbpi.config.get("PLAY_BUZZER", None)
@@ -566,6 +571,60 @@ class ConfigUpdate(CBPiExtension):
                 except:
                     logger.warning("Unable to update config")
 
+        ## Check if binary logfiles is on config
+        if binarylogfiles is None:
+            logger.info("INIT binary logfiles")
+            try:
+                await self.cbpi.config.add(
+                    "BINARYLOGFILES",
+                    "No",
+                    type=ConfigType.SELECT,
+                    description="Write sensor data to binary logfiles for faster charts (enabling requires restart)",
+                    source="craftbeerpi",
+                    options=[
+                        {"label": "Yes", "value": "Yes"},
+                        {"label": "No", "value": "No"},
+                    ],
+                )
+            except:
+                logger.warning("Unable to update config")
+
+        ## Check if sqlite logfiles is on config
+        if sqlitelogfiles is None:
+            logger.info("INIT SQLite logfiles")
+            try:
+                await self.cbpi.config.add(
+                    "SQLITELOGFILES",
+                    "No",
+                    type=ConfigType.SELECT,
+                    description="Write sensor data to a SQLite database in the logs folder (enabling requires restart)",
+                    source="craftbeerpi",
+                    options=[
+                        {"label": "Yes", "value": "Yes"},
+                        {"label": "No", "value": "No"},
+                    ],
+                )
+            except:
+                logger.warning("Unable to update config")
+
+        ## Check if sensor log rollups is on config
+        if sensorlogrollups is None:
+            logger.info("INIT sensor log rollups")
+            try:
+                await self.cbpi.config.add(
+                    "SENSOR_LOG_ROLLUPS",
+                    "Yes",
+                    type=ConfigType.SELECT,
+                    description="Keep 1 min / 15 min / 1 h min/max/mean rollups of sensor data for long term charts. Each rollup file is limited to the total size of the raw sensor logs",
+                    source="craftbeerpi",
+                    options=[
+                        {"label": "Yes", "value": "Yes"},
+                        {"label": "No", "value": "No"},
+                    ],
+                )
+            except:
+                logger.warning("Unable to update config")
+
         ## Check if influxdb is on config
         if influxdb is None:
             logger.info("INIT Influxdb")
@@ -810,6 +869,38 @@ class ConfigUpdate(CBPiExtension):
             except:
                 logger.warning("Unable to update database")
 
+        # check if SENSOR_LOG_FLUSH_INTERVAL exists in config
+        if SENSOR_LOG_FLUSH_INTERVAL is None:
+            logger.info("INIT SENSOR_LOG_FLUSH_INTERVAL")
+            try:
+                await self.cbpi.config.add(
+                    "SENSOR_LOG_FLUSH_INTERVAL",
+                    5,
+                    type=ConfigType.NUMBER,
+                    description="Max. seconds until sensor data is written to the csv logs (requires restart)",
+                    source="craftbeerpi",
+                )
+            except:
+                logger.warning("Unable to update database")
+
+        # check if SENSOR_LOG_FSYNC exists in config
+        if SENSOR_LOG_FSYNC is None:
+            logger.info("INIT SENSOR_LOG_FSYNC")
+            try:
+                await self.cbpi.config.add(
+                    "SENSOR_LOG_FSYNC",
+                    "No",
+                    type=ConfigType.SELECT,
+                    description="Force every batch of csv sensor logs to disk (safer on power loss, more sd card writes)",
+                    source="craftbeerpi",
+                    options=[
+                        {"label": "Yes", "value": "Yes"},
+                        {"label": "No", "value": "No"},
+                    ],
+                )
+            except:
+                logger.warning("Unable to update database")
+
         # Check if slow_pipe_animation is in config
         if slow_pipe_animation is None:
             logger.info("INIT slow_pipe_animation")
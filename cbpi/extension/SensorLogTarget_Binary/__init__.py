@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+
+import numpy as np
+from cbpi.api import *
+from cbpi.utils.binlog import RECORD_DTYPE, SegmentWriter
+from cbpi.utils.write_behind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+
+
+class SensorLogTargetBinary(CBPiExtension):
+
+    def __init__(self, cbpi):  # called from cbpi on start
+        self.cbpi = cbpi
+        self.logfiles = self.cbpi.config.get("BINARYLOGFILES", "No")
+        if self.logfiles == "No":
+            return  # never run()
+        # one append per sensor and batch, see WriteBehindQueue
+        self.queue = WriteBehindQueue(
+            self.write_batch,
+            max_items=1000,
+            interval=float(self.cbpi.config.get("SENSOR_LOG_FLUSH_INTERVAL", 5)),
+            name="binary-log",
+        )
+        self.cbpi.app.on_cleanup.append(self.shutdown)
+        self._task = asyncio.create_task(self.run())  # one time run() only
+
+    async def run(self):  # called by __init__ once on start if binary logging is enabled
+        self.queue.start()
+        self.cbpi.log.add_write_queue(self.queue)
+        self.listener_ID = self.cbpi.log.add_sensor_data_listener(
+            self.log_data_to_binary
+        )
+        logger.info("Binary sensor log target listener ID: {}".format(self.listener_ID))
+
+    async def shutdown(self, app):
+        await self.queue.close()
+        for writer in list(self.cbpi.log.binarylogger.values()):
+            writer.close()
+
+    def log_data_to_binary(
+        self, cbpi, id: str, value: str, formatted_time, name
+    ):  # called by log_data() hook from the log file controller
+        self.logfiles = self.cbpi.config.get("BINARYLOGFILES", "No")
+        if self.logfiles == "No":
+            # listener stays subscribed so logging can be switched back on without a restart (see CSV target)
+            return
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        self.queue.put((id, int(time.time()), value))
+
+    def write_batch(self, batch):  # called on the writer thread of the queue
+        records = {}
+        for id, ts, value in batch:
+            records.setdefault(id, []).append((ts, value))
+        for id, sensor_records in records.items():
+            writer = self.get_writer(id)
+            if writer is None:
+                continue
+            try:
+                writer.write(np.array(sensor_records, dtype=RECORD_DTYPE))
+            except Exception as e:
+                logger.error("Error writing binary log file for %s: %s", id, e)
+
+    def get_writer(self, id):
+        if id in self.cbpi.log.binarylogger:
+            return self.cbpi.log.binarylogger[id]
+        max_bytes = int(self.cbpi.config.get("SENSOR_LOG_MAX_BYTES", 100000))
+        backup_count = int(self.cbpi.config.get("SENSOR_LOG_BACKUP_COUNT", 3))
+        try:
+            writer = SegmentWriter(
+                self.cbpi.log.logsFolderPath, id, max_bytes, backup_count
+            )
+        except Exception as e:
+            logger.error("Error creating binary log file for %s: %s", id, e)
+            return None
+        self.cbpi.log.binarylogger[id] = writer
+        return writer
+
+
+def setup(cbpi):
+    cbpi.plugin.register("SensorLogTargetBinary", SensorLogTargetBinary)
@@ -10,16 +10,85 @@ except:
     module_pwd = False
 import shutil
 import random
-from logging.handlers import RotatingFileHandler
+import threading
 from unittest.mock import MagicMock, patch
 
 import urllib3
 from cbpi.api import *
 from cbpi.api.config import ConfigType
+from cbpi.utils.write_behind import WriteBehindQueue
 
 logger = logging.getLogger(__name__)
 
 
+class CSVLogFile:
+    """
+    Sensor csv log with the file names and rotation of a RotatingFileHandler.
+    Lines are written in batches and the size is tracked instead of checked per line.
+    """
+
+    def __init__(self, path, max_bytes, backup_count):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.file = None
+        self._open()
+
+    def _open(self):
+        self.file = open(self.path, "a")
+        self.size = self.file.tell()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "%s.%d" % (self.path, i)
+            dst = "%s.%d" % (self.path, i + 1)
+            if os.path.exists(src):
+                if os.path.exists(dst):
+                    os.remove(dst)
+                os.rename(src, dst)
+        dst = self.path + ".1"
+        if os.path.exists(dst):
+            os.remove(dst)
+        if os.path.exists(self.path):
+            os.rename(self.path, dst)
+        self._open()
+
+    def write(self, lines, fsync=False) -> None:
+        """
+        :param lines: list of lines without line break
+        :param fsync: force the lines to disk
+        """
+        with self.lock:
+            if self.file is None:
+                self._open()
+            chunk = []
+            for line in lines:
+                line = line + "\n"
+                if (
+                    self.max_bytes > 0
+                    and self.backup_count > 0
+                    and self.size + len(line) >= self.max_bytes
+                    and self.size > 0
+                ):
+                    self.file.write("".join(chunk))
+                    chunk = []
+                    self._rotate()
+                chunk.append(line)
+                self.size += len(line)
+            self.file.write("".join(chunk))
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
 class SensorLogTargetCSV(CBPiExtension):
 
     def __init__(self, cbpi):  # called from cbpi on start
@@ -27,13 +96,28 @@ class SensorLogTargetCSV(CBPiExtension):
         self.logfiles = self.cbpi.config.get("CSVLOGFILES", "Yes")
         if self.logfiles == "No":
             return  # never run()
+        # one write per log file and batch, see WriteBehindQueue
+        self.queue = WriteBehindQueue(
+            self.write_batch,
+            max_items=1000,
+            interval=float(self.cbpi.config.get("SENSOR_LOG_FLUSH_INTERVAL", 5)),
+            name="csv-log",
+        )
+        self.cbpi.app.on_cleanup.append(self.shutdown)
         self._task = asyncio.create_task(self.run())  # one time run() only
 
     async def run(self):  # called by __init__ once on start if CSV is enabled
+        self.queue.start()
+        self.cbpi.log.add_write_queue(self.queue)
         self.listener_ID = self.cbpi.log.add_sensor_data_listener(self.log_data_to_CSV)
         logger.info("CSV sensor log target listener ID: {}".format(self.listener_ID))
 
-    async def log_data_to_CSV(
+    async def shutdown(self, app):
+        await self.queue.close()
+        for log_file in list(self.cbpi.log.datalogger.values()):
+            log_file.close()
+
+    def log_data_to_CSV(
         self, cbpi, id: str, value: str, formatted_time, name
     ):  # called by log_data() hook from the log file controller
         self.logfiles = self.cbpi.config.get("CSVLOGFILES", "Yes")
@@ -42,42 +126,46 @@ class SensorLogTargetCSV(CBPiExtension):
             # as long as cbpi was STARTED with CSVLOGFILES set to Yes this function is still subscribed, so changes can be made on the fly.
             # but after initially enabling this logging target a restart is required.
             return
-        if id not in self.cbpi.log.datalogger:
-            max_bytes = int(self.cbpi.config.get("SENSOR_LOG_MAX_BYTES", 100000))
-            backup_count = int(self.cbpi.config.get("SENSOR_LOG_BACKUP_COUNT", 3))
+        self.queue.put((id, "%s,%s" % (formatted_time, str(value))))
 
-            data_logger = logging.getLogger("cbpi.sensor.%s" % id)
-            data_logger.propagate = False
-            data_logger.setLevel(logging.DEBUG)
+    def write_batch(self, batch):  # called on the writer thread of the queue
+        lines = {}
+        for id, line in batch:
+            lines.setdefault(id, []).append(line)
+        fsync = self.cbpi.config.get("SENSOR_LOG_FSYNC", "No") == "Yes"
+        for id, sensor_lines in lines.items():
+            log_file = self.get_log_file(id)
+            if log_file is None:
+                continue
             try:
-                handler = RotatingFileHandler(
-                    os.path.join(self.cbpi.log.logsFolderPath, f"sensor_{id}.log"),
-                    maxBytes=max_bytes,
-                    backupCount=backup_count,
-                )
+                log_file.write(sensor_lines, fsync)
             except Exception as e:
-                logger.error("Error creating log file handler: %s", e)
-                try:
-                    logger.warning(
-                        "Trying to set rights for cbpi user on the log folder and file"
-                        )
-                    user = pwd.getpwuid(os.getuid()).pw_name
-                    file= os.path.join(self.cbpi.log.logsFolderPath, f"sensor_{id}.log")
-                    shutil.os.system(f'sudo chown {user}:{user} {file}')
-
-                    handler = RotatingFileHandler(
-                        os.path.join(self.cbpi.log.logsFolderPath, f"sensor_{id}.log"),
-                        maxBytes=max_bytes,
-                        backupCount=backup_count,
+                logger.error("Error writing log file for %s: %s", id, e)
+
+    def get_log_file(self, id):
+        if id in self.cbpi.log.datalogger:
+            return self.cbpi.log.datalogger[id]
+        max_bytes = int(self.cbpi.config.get("SENSOR_LOG_MAX_BYTES", 100000))
+        backup_count = int(self.cbpi.config.get("SENSOR_LOG_BACKUP_COUNT", 3))
+        file = os.path.join(self.cbpi.log.logsFolderPath, f"sensor_{id}.log")
+        try:
+            log_file = CSVLogFile(file, max_bytes, backup_count)
+        except Exception as e:
+            logger.error("Error creating log file handler: %s", e)
+            try:
+                logger.warning(
+                    "Trying to set rights for cbpi user on the log folder and file"
                     )
-                except Exception as e:
-                    logger.error("Error creating log file handler after trying to set rights: %s", e)
-                    return
+                user = pwd.getpwuid(os.getuid()).pw_name
+                shutil.os.system(f'sudo chown {user}:{user} {file}')
 
-            data_logger.addHandler(handler)
-            self.cbpi.log.datalogger[id] = data_logger
+                log_file = CSVLogFile(file, max_bytes, backup_count)
+            except Exception as e:
+                logger.error("Error creating log file handler after trying to set rights: %s", e)
+                return None
 
-        self.cbpi.log.datalogger[id].info("%s,%s" % (formatted_time, str(value)))
+        self.cbpi.log.datalogger[id] = log_file
+        return log_file
 
 
 def setup(cbpi):
@@ -2,18 +2,277 @@
 import asyncio
 import base64
 import logging
+import math
 import os
 import random
+import time
 from unittest.mock import MagicMock, patch
 
-import urllib3
+import aiohttp
 from cbpi.api import *
 from cbpi.api.config import ConfigType
-from urllib3 import PoolManager, Retry, Timeout
 
 logger = logging.getLogger(__name__)
 
 
+def _escape(value, special=",= "):
+    # tag keys and values of the line protocol
+    value = str(value)
+    for c in special:
+        value = value.replace(c, "\\" + c)
+    return value
+
+
+def format_line(measurement, name, id, value, timestamp):
+    """
+    :return: line protocol for a sensor value or None if the value is not a finite number
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(value):
+        return None
+    return "%s,source=%s,itemID=%s value=%r %d" % (
+        _escape(measurement, ", "),
+        _escape(name),
+        _escape(id),
+        value,
+        timestamp,
+    )
+
+
+def epoch_seconds(formatted_time):
+    """
+    :param formatted_time: local time as passed to the sensor data listeners
+    :return: epoch seconds
+    """
+    return int(time.mktime(time.strptime(formatted_time, "%Y-%m-%d %H:%M:%S")))
+
+
+class InfluxDBShipper:
+    """
+    Ships line protocol to InfluxDB in the background. Lines are collected in memory and
+    posted in batches over one long lived http session once batch_size lines are queued or
+    the oldest line is max_age seconds old. While InfluxDB is unavailable the shipper backs
+    off exponentially and batches go to a bounded spool folder, which is replayed oldest
+    first once InfluxDB is back.
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        spool_folder,
+        batch_size=500,
+        max_age=10.0,
+        max_spool_bytes=5 * 1024 * 1024,
+        backoff=2.0,
+        max_backoff=300.0,
+        timeout=10.0,
+    ):
+        """
+        :param endpoint: function returning (url, headers) for a write
+        :param spool_folder: folder for batches that could not be sent
+        :param batch_size: number of lines which trigger a post
+        :param max_age: max seconds a line waits before it is posted
+        :param max_spool_bytes: the oldest spooled batches are dropped beyond this size
+        :param backoff: seconds to wait after the first failed post, doubled per failure
+        :param max_backoff: max seconds between two attempts
+        :param timeout: seconds until a post is given up
+        """
+        self.endpoint = endpoint
+        self.spool_folder = spool_folder
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_spool_bytes = max_spool_bytes
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.lines = []
+        self.failures = 0
+        self.retry_at = 0
+        self.sent = 0
+        self.spooled = 0
+        self.dropped = 0
+        self.session = None
+        self._seq = 0
+        # leading lines of the current post which were sent or dropped as malformed
+        self._done = 0
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+        os.makedirs(self.spool_folder, exist_ok=True)
+        # spooled batches of a previous run are replayed
+        self.spool = sorted(
+            os.path.join(self.spool_folder, f)
+            for f in os.listdir(self.spool_folder)
+            if f.endswith(".lp")
+        )
+
+    def start(self) -> None:
+        if self._task is None:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def put(self, line) -> None:
+        self.lines.append(line)
+        if len(self.lines) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.max_age)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._closing:
+                break
+            try:
+                await self.ship()
+            except Exception as e:
+                logger.error("InfluxDB shipper error: {}".format(e))
+
+    def _take(self):
+        batch, self.lines = self.lines, []
+        return batch
+
+    async def ship(self) -> None:
+        """
+        Replay the spool and post the queued lines unless InfluxDB is backing off
+        """
+        if time.monotonic() < self.retry_at:
+            # keep memory bounded while InfluxDB is unavailable
+            if len(self.lines) >= self.batch_size:
+                self._spool(self._take())
+            return
+        while len(self.spool) > 0:
+            path = self.spool[0]
+            try:
+                with open(path) as file:
+                    body = file.read()
+            except OSError as e:
+                logger.warning("InfluxDB spool file {} unreadable: {}".format(path, e))
+                body = None
+            if body is not None:
+                lines = body.split("\n")
+                unsent = await self._post(lines)
+                if len(unsent) > 0:
+                    if len(unsent) < len(lines):
+                        self._rewrite_spooled(path, unsent)
+                    return
+            self._remove_spooled(path)
+        if len(self.lines) > 0:
+            unsent = await self._post(self._take())
+            if len(unsent) > 0:
+                self._spool(unsent)
+
+    async def _write(self, lines):
+        url, headers = self.endpoint()
+        async with self.session.post(
+            url, data="\n".join(lines).encode(), headers=headers
+        ) as resp:
+            if resp.status == 400:
+                await self._rejected(lines, await resp.text())
+            elif resp.status >= 300:
+                raise Exception(f"InfluxDB Status code {resp.status}")
+            else:
+                self.sent += len(lines)
+                self._done += len(lines)
+
+    async def _rejected(self, lines, reason):
+        # malformed lines will never be accepted and retrying would block the spool. The whole
+        # batch is refused for one bad line, so the halves are sent again until it is found.
+        if len(lines) == 1:
+            logger.error("InfluxDB rejected {}: {}".format(lines[0], reason))
+            self.dropped += 1
+            self._done += 1
+            return
+        # the halves are sent in order, if one fails only the lines from there on are unsent
+        half = len(lines) // 2
+        await self._write(lines[:half])
+        await self._write(lines[half:])
+
+    async def _post(self, lines) -> list:
+        """
+        :param lines: line protocol
+        :return: lines which were not sent, empty if all were sent or dropped as malformed
+        """
+        self._done = 0
+        try:
+            await self._write(lines)
+            self.failures = 0
+            self.retry_at = 0
+            return []
+        except Exception as e:
+            self.failures += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+            delay = delay * random.uniform(0.75, 1.0)
+            self.retry_at = time.monotonic() + delay
+            logger.error(
+                "InfluxDB write Error #{}: {}. Next attempt in {:.0f} s".format(
+                    self.failures, e, delay
+                )
+            )
+            return lines[self._done :]
+
+    def _spool(self, batch) -> None:
+        self._seq += 1
+        path = os.path.join(
+            self.spool_folder, "%d_%06d.lp" % (time.time() * 1000, self._seq % 1000000)
+        )
+        try:
+            with open(path, "w") as file:
+                file.write("\n".join(batch))
+            self.spool.append(path)
+            self.spooled += len(batch)
+        except OSError as e:
+            logger.error("InfluxDB spool write error: {}".format(e))
+            self.dropped += len(batch)
+            return
+        size = sum(os.path.getsize(f) for f in self.spool if os.path.exists(f))
+        while size > self.max_spool_bytes and len(self.spool) > 1:
+            oldest = self.spool[0]
+            size -= os.path.getsize(oldest) if os.path.exists(oldest) else 0
+            with open(oldest) as file:
+                self.dropped += file.read().count("\n") + 1
+            self._remove_spooled(oldest)
+            logger.warning("InfluxDB spool full, dropped {}".format(oldest))
+
+    def _rewrite_spooled(self, path, lines) -> None:
+        # the sent part of a spooled batch is not replayed again
+        try:
+            with open(path, "w") as file:
+                file.write("\n".join(lines))
+        except OSError as e:
+            logger.error("InfluxDB spool write error: {}".format(e))
+
+    def _remove_spooled(self, path) -> None:
+        self.spool.remove(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    async def close(self) -> None:
+        """
+        Stop shipping. Lines still queued are spooled and sent after the next start.
+        """
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if len(self.lines) > 0:
+            self._spool(self._take())
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
 class SensorLogTargetInfluxDB(CBPiExtension):
 
     def __init__(self, cbpi):  # called from cbpi on start
@@ -21,12 +280,15 @@ class SensorLogTargetInfluxDB(CBPiExtension):
         self.influxdb = self.cbpi.config.get("INFLUXDB", "No")
         if self.influxdb == "No":
             return  # never run()
+        self.shipper = InfluxDBShipper(
+            self.get_endpoint,
+            os.path.join(self.cbpi.log.logsFolderPath, "influxdb_spool"),
+        )
+        self.cbpi.app.on_cleanup.append(self.shutdown)
         self._task = asyncio.create_task(self.run())  # one time run() only
-        self.counter = 0
-        self.max_retries = 2
-        self.send = True
 
     async def run(self):  # called by __init__ once on start if influx is enabled
+        self.shipper.start()
         self.listener_ID = self.cbpi.log.add_sensor_data_listener(
             self.log_data_to_InfluxDB
         )
@@ -34,7 +296,44 @@ class SensorLogTargetInfluxDB(CBPiExtension):
             "InfluxDB sensor log target listener ID: {}".format(self.listener_ID)
         )
 
-    async def log_data_to_InfluxDB(
+    async def shutdown(self, app):
+        await self.shipper.close()
+
+    def get_endpoint(self):
+        """
+        :return: tuple of write url and headers from the current InfluxDB settings
+        """
+        self.influxdbcloud = self.cbpi.config.get("INFLUXDBCLOUD", "No")
+        self.influxdbaddr = self.cbpi.config.get("INFLUXDBADDR", None)
+        self.influxdbname = self.cbpi.config.get("INFLUXDBNAME", None)
+        self.influxdbuser = self.cbpi.config.get("INFLUXDBUSER", None)
+        self.influxdbpwd = self.cbpi.config.get("INFLUXDBPWD", None)
+        if self.influxdbcloud == "Yes":
+            url = (
+                self.influxdbaddr
+                + "/api/v2/write?org="
+                + self.influxdbuser
+                + "&bucket="
+                + self.influxdbname
+                + "&precision=s"
+            )
+            header = {
+                "User-Agent": "CraftBeerPi",
+                "Authorization": "Token {}".format(self.influxdbpwd),
+            }
+        else:
+            base64string = base64.b64encode(
+                ("%s:%s" % (self.influxdbuser, self.influxdbpwd)).encode()
+            )
+            url = self.influxdbaddr + "/write?db=" + self.influxdbname + "&precision=s"
+            header = {
+                "User-Agent": "CraftBeerPi",
+                "Content-Type": "application/x-www-form-urlencoded",
+                "Authorization": "Basic %s" % base64string.decode("utf-8"),
+            }
+        return url, header
+
+    def log_data_to_InfluxDB(
         self, cbpi, id: str, value: str, timestamp, name
     ):  # called by log_data() hook from the log file controller
         self.influxdb = self.cbpi.config.get("INFLUXDB", "No")
@@ -43,101 +342,19 @@ class SensorLogTargetInfluxDB(CBPiExtension):
             # as long as cbpi was STARTED with INFLUXDB set to Yes this function is still subscribed, so changes can be made on the fly.
             # but after initially enabling this logging target a restart is required.
             return
-        self.influxdbcloud = self.cbpi.config.get("INFLUXDBCLOUD", "No")
-        self.influxdbaddr = self.cbpi.config.get("INFLUXDBADDR", None)
-        self.influxdbname = self.cbpi.config.get("INFLUXDBNAME", None)
-        self.influxdbuser = self.cbpi.config.get("INFLUXDBUSER", None)
-        self.influxdbpwd = self.cbpi.config.get("INFLUXDBPWD", None)
         self.influxdbmeasurement = self.cbpi.config.get(
             "INFLUXDBMEASUREMENT", "measurement"
         )
-        timeout = Timeout(connect=2.0, read=None)
+        # the sample time is sent along, batches may be posted much later
         try:
-            sensor = self.cbpi.sensor.find_by_id(id)
-            if sensor is not None:
-                itemname = sensor.name.replace(" ", "_")
-                out = (
-                    str(self.influxdbmeasurement)
-                    + ",source="
-                    + itemname
-                    + ",itemID="
-                    + str(id)
-                    + " value="
-                    + str(value)
-                )
-        except Exception as e:
-            logging.error("InfluxDB ID Error: {}".format(e))
-
-        if self.influxdbcloud == "Yes" and self.send == True:
-            if self.counter <= self.max_retries:
-                self.influxdburl = (
-                    self.influxdbaddr
-                    + "/api/v2/write?org="
-                    + self.influxdbuser
-                    + "&bucket="
-                    + self.influxdbname
-                    + "&precision=s"
-                )
-                try:
-                    header = {
-                        "User-Agent": id,
-                        "Authorization": "Token {}".format(self.influxdbpwd),
-                    }
-                    http = PoolManager(timeout=timeout)
-                    req = http.request(
-                        "POST",
-                        self.influxdburl,
-                        body=out.encode(),
-                        headers=header,
-                        retries=Retry(2),
-                    )
-                    if req.status != 204:
-                        raise Exception(f"InfluxDB Status code {req.status}")
-                except Exception as e:
-                    self.counter += 1
-                    logging.error(
-                        "InfluxDB cloud write Error #{}: {}".format(self.counter, e)
-                    )
-            else:
-                logging.warning("Waiting 3 Minutes before connecting to INFLUXDB again")
-                self.send = False
-                await asyncio.sleep(180)
-                self.counter = 0
-                self.send = True
-
-        elif self.influxdbcloud == "No" and self.send == True:
-            if self.counter <= self.max_retries:
-                self.base64string = base64.b64encode(
-                    ("%s:%s" % (self.influxdbuser, self.influxdbpwd)).encode()
-                )
-                self.influxdburl = self.influxdbaddr + "/write?db=" + self.influxdbname
-                try:
-                    header = {
-                        "User-Agent": id,
-                        "Content-Type": "application/x-www-form-urlencoded",
-                        "Authorization": "Basic %s" % self.base64string.decode("utf-8"),
-                    }
-                    http = PoolManager(timeout=timeout)
-                    req = http.request(
-                        "POST",
-                        self.influxdburl,
-                        body=out.encode(),
-                        headers=header,
-                        retries=Retry(2),
-                    )
-                    if req.status != 204:
-                        raise Exception(f"InfluxDB Status code {req.status}")
-                except Exception as e:
-                    self.counter += 1
-                    logging.error(
-                        "InfluxDB write Error #{}: {}".format(self.counter, e)
-                    )
-            else:
-                logging.warning("Waiting 3 Minutes before connecting to INFLUXDB again")
-                self.send = False
-                await asyncio.sleep(180)
-                self.counter = 0
-                self.send = True
+            ts = epoch_seconds(timestamp)
+        except (TypeError, ValueError):
+            ts = int(time.time())
+        line = format_line(self.influxdbmeasurement, name, id, value, ts)
+        if line is None:
+            logger.debug("InfluxDB skipped non numeric value {} of {}".format(value, id))
+            return
+        self.shipper.put(line)
 
 
 def setup(cbpi):
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+
+from cbpi.api import *
+from cbpi.utils import sqlite_log
+from cbpi.utils.write_behind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+
+
+class SensorLogTargetSQLite(CBPiExtension):
+
+    def __init__(self, cbpi):  # called from cbpi on start
+        self.cbpi = cbpi
+        self.logfiles = self.cbpi.config.get("SQLITELOGFILES", "No")
+        if self.logfiles == "No":
+            return  # never run()
+        self.connection = None
+        # one transaction per batch, see WriteBehindQueue
+        self.queue = WriteBehindQueue(
+            self.write_batch,
+            max_items=1000,
+            interval=float(self.cbpi.config.get("SENSOR_LOG_FLUSH_INTERVAL", 5)),
+            name="sqlite-log",
+        )
+        self.cbpi.app.on_cleanup.append(self.shutdown)
+        self._task = asyncio.create_task(self.run())  # one time run() only
+
+    async def run(self):  # called by __init__ once on start if sqlite logging is enabled
+        self.queue.start()
+        self.cbpi.log.add_write_queue(self.queue)
+        self.listener_ID = self.cbpi.log.add_sensor_data_listener(
+            self.log_data_to_sqlite
+        )
+        logger.info("SQLite sensor log target listener ID: {}".format(self.listener_ID))
+
+    async def shutdown(self, app):
+        await self.queue.close()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def log_data_to_sqlite(
+        self, cbpi, id: str, value: str, formatted_time, name
+    ):  # called by log_data() hook from the log file controller
+        self.logfiles = self.cbpi.config.get("SQLITELOGFILES", "No")
+        if self.logfiles == "No":
+            # listener stays subscribed so logging can be switched back on without a restart (see CSV target)
+            return
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        self.queue.put((id, int(time.time()), value))
+
+    def write_batch(self, rows):  # called on the writer thread of the queue
+        if self.connection is None:
+            self.connection = sqlite_log.connect(
+                sqlite_log.db_path(self.cbpi.log.logsFolderPath), create=True
+            )
+            if self.cbpi.config.get("SENSOR_LOG_FSYNC", "No") == "Yes":
+                self.connection.execute("PRAGMA synchronous=FULL")
+        sqlite_log.insert(self.connection, rows)
+
+
+def setup(cbpi):
+    cbpi.plugin.register("SensorLogTargetSQLite", SensorLogTargetSQLite)
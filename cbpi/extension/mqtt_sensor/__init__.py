@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import asyncio
-import json
 import logging
 import time
 from datetime import datetime
@@ -8,6 +7,7 @@ from datetime import datetime
 from cbpi.api import *
 from cbpi.api import CBPiSensor, Property, parameters
 from cbpi.api.dataclasses import NotificationAction, NotificationType
+from cbpi.utils.mqtt_payload import compile_path, decode, extract
 
 
 @parameters(
@@ -53,9 +53,10 @@ class MQTTSensor(CBPiSensor):
         super(MQTTSensor, self).__init__(cbpi, id, props)
         self.Topic = self.props.get("Topic", None)
         self.payload_text = self.props.get("PayloadDictionary", None)
-        if self.payload_text != None:
-            self.payload_text = self.payload_text.split(".")
-        self.subscribed = self.cbpi.satellite.subscribe(self.Topic, self.on_message)
+        # the payload of a topic is decoded once for all sensors reading from it
+        self.subscribed = self.cbpi.satellite.payloads.subscribe(
+            self.Topic, self.payload_text, self.on_value
+        )
         self.value: float = 999
         self.timeout = int(self.props.get("Timeout", 60))
         self.temprange = float(self.props.get("TempRange", 0))
@@ -102,12 +103,12 @@ class MQTTSensor(CBPiSensor):
         pass
 
     async def on_message(self, message):
-        try:
-            val = json.loads(message.payload.decode())
-            if self.payload_text is not None:
-                for key in self.payload_text:
-                    val = val.get(key, None)
+        await self.on_value(
+            extract(decode(message.payload), compile_path(self.payload_text))
+        )
 
+    async def on_value(self, val):
+        try:
             if isinstance(val, (int, float, str)):
                 self.value = float(val)
                 self.push_update(self.value)
@@ -187,7 +188,9 @@ class MQTTSensor(CBPiSensor):
         return dict(value=self.value)
 
     async def on_stop(self):
-        self.subscribed = self.cbpi.satellite.unsubscribe(self.Topic, self.on_message)
+        self.subscribed = self.cbpi.satellite.payloads.unsubscribe(
+            self.Topic, self.payload_text, self.on_value
+        )
 
 
 @parameters(
@@ -238,9 +241,10 @@ class MQTTSensorOffset(CBPiSensor):
         self.Topic = self.props.get("Topic", None)
         self.offset = float(self.props.get("Offset", 0))
         self.payload_text = self.props.get("PayloadDictionary", None)
-        if self.payload_text != None:
-            self.payload_text = self.payload_text.split(".")
-        self.subscribed = self.cbpi.satellite.subscribe(self.Topic, self.on_message)
+        # the payload of a topic is decoded once for all sensors reading from it
+        self.subscribed = self.cbpi.satellite.payloads.subscribe(
+            self.Topic, self.payload_text, self.on_value
+        )
         self.value: float = 999
         self.timeout = int(self.props.get("Timeout", 60))
         self.temprange = float(self.props.get("TempRange", 0))
@@ -287,12 +291,12 @@ class MQTTSensorOffset(CBPiSensor):
         pass
 
     async def on_message(self, message):
-        val = json.loads(message.payload.decode())
-        try:
-            if self.payload_text is not None:
-                for key in self.payload_text:
-                    val = val.get(key, None)
+        await self.on_value(
+            extract(decode(message.payload), compile_path(self.payload_text))
+        )
 
+    async def on_value(self, val):
+        try:
             if isinstance(val, (int, float, str)):
                 self.value = float(val) + self.offset
                 self.push_update(self.value)
@@ -372,7 +376,9 @@ class MQTTSensorOffset(CBPiSensor):
         return dict(value=self.value)
 
     async def on_stop(self):
-        self.subscribed = self.cbpi.satellite.unsubscribe(self.Topic, self.on_message)
+        self.subscribed = self.cbpi.satellite.payloads.unsubscribe(
+            self.Topic, self.payload_text, self.on_value
+        )
 
 
 def setup(cbpi):
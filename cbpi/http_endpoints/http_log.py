@@ -1,11 +1,17 @@
+import asyncio
 import json
 import logging
+import math
 import os
+import tempfile
+from datetime import datetime
 
 from aiohttp import web
 from cbpi.api import request_mapping
+from cbpi.utils import downsample
 from cbpi.utils.encoder import ComplexEncoder
 from cbpi.utils.utils import json_dumps
+from cbpi.utils.zip_stream import CHUNK_SIZE, stream_zip
 
 
 class LogHttpEndpoints:
@@ -14,6 +20,60 @@ class LogHttpEndpoints:
         self.cbpi = cbpi
         self.cbpi.register(self, url_prefix="/log")
 
+    def _parse_time(self, value):
+        try:
+            result = float(value)
+        except ValueError:
+            # ISO datetime, naive values are local time as in the csv logs
+            return datetime.fromisoformat(value).timestamp()
+        if not math.isfinite(result):
+            raise ValueError("{} is not a finite time".format(value))
+        return result
+
+    def get_window(self, request):
+        """
+        Read the optional start, end and limit query parameters of the log endpoints.
+        start and end are epoch seconds (negative values are relative to now) or ISO datetimes.
+        :param request: web request
+        :return: dict with start, end and limit
+        """
+        try:
+            start = request.query.get("start")
+            end = request.query.get("end")
+            limit = request.query.get("limit")
+            window = dict(
+                start=self._parse_time(start) if start else None,
+                end=self._parse_time(end) if end else None,
+                limit=int(limit) if limit else None,
+            )
+        except ValueError as e:
+            raise web.HTTPBadRequest(text="Invalid log window: {}".format(e))
+        if window["limit"] is not None and window["limit"] < 1:
+            raise web.HTTPBadRequest(text="Invalid limit: {}".format(window["limit"]))
+        return window
+
+    def get_downsampling(self, request):
+        """
+        Read the optional downsample and width query parameters of the chart endpoints.
+        :param request: web request
+        :return: dict with downsample and width
+        """
+        mode = request.query.get("downsample")
+        if mode is not None and mode not in downsample.MODES:
+            raise web.HTTPBadRequest(
+                text="Invalid downsample mode: {}. Use one of {}".format(
+                    mode, ", ".join(downsample.MODES)
+                )
+            )
+        try:
+            width = request.query.get("width")
+            width = int(width) if width else None
+        except ValueError as e:
+            raise web.HTTPBadRequest(text="Invalid width: {}".format(e))
+        if width is not None and width < 3:
+            raise web.HTTPBadRequest(text="Invalid width: {}".format(width))
+        return dict(downsample=mode, width=width)
+
     @request_mapping(path="/{name}/zip", method="POST", auth_required=False)
     async def create_zip_names(self, request):
         """
@@ -36,10 +96,50 @@ class LogHttpEndpoints:
         """
 
         log_name = request.match_info["name"]
-        data = self.cbpi.log.zip_log_data(log_name)
+        await self.cbpi.log.flush_writes()
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, self.cbpi.log.zip_log_data, log_name
+        )
 
         return web.json_response(dict(filename=data), dumps=json_dumps)
 
+    @request_mapping(path="/{name}/zip/stream", method="GET", auth_required=False)
+    async def stream_zip_names(self, request):
+        """
+        ---
+        description: Download the log files of a sensor as zip, compressed while it is sent
+        tags:
+        - Log
+        parameters:
+        - name: "name"
+          in: "path"
+          description: "Sensor ID"
+          required: true
+          type: "integer"
+          format: "int64"
+        produces:
+        - application/zip
+        responses:
+            "200":
+                description: successful operation.
+            "500":
+                description: sensor has no log data
+        """
+        log_name = request.match_info["name"]
+        with tempfile.TemporaryDirectory() as folder:
+            files = await self.cbpi.log.get_zip_files(log_name, folder, request)
+            formatted_time = datetime.now().strftime("%Y-%m-%d-%H_%M_%S")
+            response = web.StreamResponse(
+                status=200,
+                reason="OK",
+                headers={
+                    "Content-Type": "application/zip",
+                    "Content-Disposition": 'attachment; filename="%s-sensor-%s.zip"'
+                    % (formatted_time, log_name),
+                },
+            )
+            return await stream_zip(request, response, files)
+
     @request_mapping(path="/{name}/zip", method="DELETE", auth_required=False)
     async def clear_zip_names(self, request):
         """
@@ -91,8 +191,11 @@ class LogHttpEndpoints:
         with open(
             os.path.join(self.cbpi.logsFolderPath, "%s.zip" % log_name), "rb"
         ) as file:
-            for line in file.readlines():
-                await response.write(line)
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                await response.write(chunk)
 
         await response.write_eof()
         return response
@@ -161,6 +264,31 @@ class LogHttpEndpoints:
           required: true
           type: "integer"
           format: "int64"
+        - name: "start"
+          in: "query"
+          description: "Start of the window. Epoch seconds (negative: relative to now) or ISO datetime"
+          required: false
+          type: "string"
+        - name: "end"
+          in: "query"
+          description: "End of the window. Epoch seconds (negative: relative to now) or ISO datetime"
+          required: false
+          type: "string"
+        - name: "limit"
+          in: "query"
+          description: "Max number of newest rows per sensor"
+          required: false
+          type: "integer"
+        - name: "downsample"
+          in: "query"
+          description: "Downsampling mode: nth, lttb (largest triangle three buckets) or minmax"
+          required: false
+          type: "string"
+        - name: "width"
+          in: "query"
+          description: "Chart width in pixel, max number of points per sensor (default 1000)"
+          required: false
+          type: "integer"
         produces:
         - application/json
         responses:
@@ -168,7 +296,12 @@ class LogHttpEndpoints:
                 description: successful operation.
         """
         log_name = request.match_info["name"]
-        data = await self.cbpi.log.get_data(log_name)
+        data = await self.cbpi.log.get_data(
+            log_name,
+            request=request,
+            **self.get_window(request),
+            **self.get_downsampling(request),
+        )
         return web.json_response(data, dumps=json_dumps)
 
     @request_mapping(path="/", method="POST", auth_required=False)
@@ -187,6 +320,82 @@ class LogHttpEndpoints:
             type: array
             items:
               type: string
+        - name: "start"
+          in: "query"
+          description: "Start of the window. Epoch seconds (negative: relative to now) or ISO datetime"
+          required: false
+          type: "string"
+        - name: "end"
+          in: "query"
+          description: "End of the window. Epoch seconds (negative: relative to now) or ISO datetime"
+          required: false
+          type: "string"
+        - name: "limit"
+          in: "query"
+          description: "Max number of newest rows per sensor"
+          required: false
+          type: "integer"
+        - name: "downsample"
+          in: "query"
+          description: "Downsampling mode: nth, lttb (largest triangle three buckets) or minmax"
+          required: false
+          type: "string"
+        - name: "width"
+          in: "query"
+          description: "Chart width in pixel, max number of points per sensor (default 1000)"
+          required: false
+          type: "integer"
+        produces:
+        - application/json
+        responses:
+            "200":
+                description: successful operation.
+        """
+        data = await request.json()
+        values = await self.cbpi.log.get_data2(
+            data,
+            request=request,
+            **self.get_window(request),
+            **self.get_downsampling(request),
+        )
+        return web.json_response(values, dumps=json_dumps)
+
+    @request_mapping(path="/rollup", method="POST", auth_required=False)
+    async def get_rollup(self, request):
+        """
+        ---
+        description: Get min / max / mean / count rollups for sensors
+        tags:
+        - Log
+        parameters:
+        - in: body
+          name: body
+          description: Sensor Ids
+          required: true
+          schema:
+            type: array
+            items:
+              type: string
+        - name: "resolution"
+          in: "query"
+          description: "Requested resolution in seconds. Served from the coarsest tier (60, 900 or 3600) that satisfies it"
+          required: false
+          type: "integer"
+        - name: "start"
+          in: "query"
+          description: "Start of the window. Epoch seconds (negative: relative to now) or ISO datetime"
+          required: false
+          type: "string"
+        - name: "end"
+          in: "query"
+          description: "End of the window. Epoch seconds (negative: relative to now) or ISO datetime"
+          required: false
+          type: "string"
+        - name: "limit"
+          in: "query"
+          description: "Max number of newest buckets per sensor"
+          required: false
+          type: "integer"
         produces:
         - application/json
         responses:
@@ -194,7 +403,13 @@ class LogHttpEndpoints:
                 description: successful operation.
         """
         data = await request.json()
-        values = await self.cbpi.log.get_data2(data)
+        try:
+            resolution = int(request.query.get("resolution", 60))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text="Invalid resolution: {}".format(e))
+        values = await self.cbpi.log.get_rollup(
+            data, resolution=resolution, request=request, **self.get_window(request)
+        )
         return web.json_response(values, dumps=json_dumps)
 
     @request_mapping(path="/{name}", method="DELETE", auth_required=False)
@@ -216,7 +431,7 @@ class LogHttpEndpoints:
                 description: successful operation.
         """
         log_name = request.match_info["name"]
-        self.cbpi.log.clear_log(log_name)
+        await self.cbpi.log.clear_log(log_name)
         return web.Response(status=204)
 
     @request_mapping(path="/logs", method="POST", auth_required=False)
@@ -235,6 +450,31 @@ class LogHttpEndpoints:
             type: array
             items:
               type: string
+        - name: "start"
+          in: "query"
+          description: "Start of the window. Epoch seconds (negative: relative to now) or ISO datetime"
+          required: false
+          type: "string"
+        - name: "end"
+          in: "query"
+          description: "End of the window. Epoch seconds (negative: relative to now) or ISO datetime"
+          required: false
+          type: "string"
+        - name: "limit"
+          in: "query"
+          description: "Max number of newest rows per sensor"
+          required: false
+          type: "integer"
+        - name: "downsample"
+          in: "query"
+          description: "Downsampling mode: nth, lttb (largest triangle three buckets) or minmax"
+          required: false
+          type: "string"
+        - name: "width"
+          in: "query"
+          description: "Chart width in pixel, max number of points per sensor (default 1000)"
+          required: false
+          type: "integer"
         produces:
         - application/json
         responses:
@@ -243,7 +483,12 @@ class LogHttpEndpoints:
         """
         data = await request.json()
 
-        result = await self.cbpi.log.get_data(data)
+        result = await self.cbpi.log.get_data(
+            data,
+            request=request,
+            **self.get_window(request),
+            **self.get_downsampling(request),
+        )
         # print("JSON")
         # print(json.dumps(result, cls=ComplexEncoder))
         # print("JSON----")
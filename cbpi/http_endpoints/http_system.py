@@ -10,6 +10,7 @@ from cbpi.api import request_mapping
 from cbpi.controller.system_controller import SystemController
 from cbpi.job.aiohttp import get_scheduler_from_app
 from cbpi.utils import json_dumps
+from cbpi.utils.zip_stream import CHUNK_SIZE, stream_zip
 
 
 class SystemHttpEndpoints:
@@ -102,6 +103,53 @@ class SystemHttpEndpoints:
         data = self.cbpi.bus.dump()
         return web.json_response(data=data)
 
+    @request_mapping(
+        "/events/stats", method="GET", name="get_event_stats", auth_required=False
+    )
+    async def get_event_stats(self, request):
+        """
+        ---
+        description: Event bus statistics. Fire count, fan-out and timeouts per topic. Calls, errors, timeouts and execution time (seconds) per handler with a histogram over the bucket upper bounds
+        tags:
+        - System
+        responses:
+            "200":
+                description: successful operation
+        """
+        return web.json_response(data=self.cbpi.bus.get_stats())
+
+    @request_mapping(
+        "/mqtt/stats", method="GET", name="get_mqtt_stats", auth_required=False
+    )
+    async def get_mqtt_stats(self, request):
+        """
+        ---
+        description: MQTT statistics. Queued messages and calls, errors, execution time and longest wait (seconds) per message handler
+        tags:
+        - System
+        responses:
+            "200":
+                description: successful operation
+        """
+        if self.cbpi.satellite is None:
+            return web.json_response(data={})
+        return web.json_response(data=self.cbpi.satellite.get_stats())
+
+    @request_mapping(
+        "/ws/clients", method="GET", name="get_ws_clients", auth_required=False
+    )
+    async def get_ws_clients(self, request):
+        """
+        ---
+        description: Connected websocket clients with the depth of their outbound queue, the time (seconds) the queue is full and the number of coalesced and dropped messages
+        tags:
+        - System
+        responses:
+            "200":
+                description: successful operation
+        """
+        return web.json_response(data=self.cbpi.ws.get_clients())
+
     @request_mapping("/jobs", method="GET", name="get_jobs", auth_required=False)
     async def get_all_jobs(self, request):
         scheduler = get_scheduler_from_app(self.cbpi.app)
@@ -158,22 +206,17 @@ class SystemHttpEndpoints:
                 content:  # Response body
                 application/zip:  # Media type
         """
-        filename = await self.controller.backupConfig()
-        # filename = "cbpi4_config.zip"
-        file_name = pathlib.Path(os.path.join(".", filename))
-
+        # the archive is compressed in a worker thread while it is sent, nothing is written to disk
+        filename, files = self.controller.get_backup_files()
         response = web.StreamResponse(
             status=200,
             reason="OK",
-            headers={"Content-Type": "application/zip"},
+            headers={
+                "Content-Type": "application/zip",
+                "Content-Disposition": 'attachment; filename="%s"' % filename,
+            },
         )
-        await response.prepare(request)
-        with open(file_name, "rb") as file:
-            for line in file.readlines():
-                await response.write(line)
-
-        await response.write_eof()
-        return response
+        return await stream_zip(request, response, files)
 
     @request_mapping(
         "/log/{logtime}/", method="GET", name="BackupConfig", auth_required=False
@@ -219,8 +262,11 @@ class SystemHttpEndpoints:
             )
             await response.prepare(request)
             with open(file_name, "rb") as file:
-                for line in file.readlines():
-                    await response.write(line)
+                while True:
+                    chunk = file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await response.write(chunk)
 
             await response.write_eof()
             os.remove(file_name)
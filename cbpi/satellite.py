@@ -4,7 +4,7 @@ from collections import defaultdict
 
 import aiohttp
 from aiohttp import web
-from cbpi.utils import json_dumps
+from cbpi.websocket import ENCODINGS, PROTOCOLS, decode, get_compress, get_encoding
 from voluptuous import Schema
 
 
@@ -12,7 +12,8 @@ class CBPiSatellite:
     def __init__(self, cbpi) -> None:
         self.cbpi = cbpi
         self._callbacks = defaultdict(set)
-        self._clients = weakref.WeakSet()
+        # ws -> encoding
+        self._clients = weakref.WeakKeyDictionary()
         self.logger = logging.getLogger(__name__)
         self.cbpi.app.add_routes([web.get("/satellite", self.websocket_handler)])
         self.cbpi.bus.register_object(self)
@@ -27,18 +28,25 @@ class CBPiSatellite:
 
     def send(self, data):
         self.logger.debug("broadcast to ws clients. Data: %s" % data)
-        for ws in self._clients:
+        frames = {}
+        for ws, encoding in list(self._clients.items()):
+            encode, opcode = ENCODINGS[encoding]
+            frame = frames.get(encoding)
+            if frame is None:
+                frame = frames[encoding] = encode(data)
 
-            async def send_data(ws, data):
-                await ws.send_json(data=data, dumps=json_dumps)
+            async def send_data(ws, frame, opcode):
+                await ws.send_frame(frame, opcode)
 
-            self.cbpi.app.loop.create_task(send_data(ws, data))
+            self.cbpi.app.loop.create_task(send_data(ws, frame, opcode))
 
     async def websocket_handler(self, request):
 
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(protocols=PROTOCOLS, compress=get_compress(self.cbpi))
         await ws.prepare(request)
-        self._clients.add(ws)
+        encoding = get_encoding(request, ws)
+        encode, opcode = ENCODINGS[encoding]
+        self._clients[ws] = encoding
         try:
             peername = request.transport.get_extra_info("peername")
             if peername is not None:
@@ -55,11 +63,13 @@ class CBPiSatellite:
             pass
 
         try:
-            await ws.send_json(data=dict(topic="connection/success"))
+            await ws.send_frame(encode(dict(topic="connection/success")), opcode)
             async for msg in ws:
-                if msg.type == aiohttp.WSMsgType.TEXT:
+                if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
 
-                    msg_obj = msg.json()
+                    msg_obj = decode(msg)
+                    if msg_obj is None:
+                        continue
                     schema = Schema({"topic": str, "data": dict})
                     schema(msg_obj)
 
@@ -81,7 +91,7 @@ class CBPiSatellite:
             self.logger.error("%s - Received Data %s" % (str(e), msg.data))
 
         finally:
-            self._clients.discard(ws)
+            self._clients.pop(ws, None)
 
         self.logger.info("Web Socket Close")
 
@@ -0,0 +1,248 @@
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+__all__ = [
+    "RECORD_DTYPE",
+    "SegmentWriter",
+    "list_segments",
+    "read_index",
+    "read_segment",
+    "read_window",
+    "from_local_naive",
+    "remove_segments",
+    "to_local_naive",
+]
+
+# one record per reading: epoch seconds (UTC) and the sensor value
+RECORD_DTYPE = np.dtype([("ts", "<i8"), ("value", "<f8")])
+
+
+def _segment_prefix(folder, id):
+    return os.path.join(folder, f"sensor_{id}.bin.")
+
+
+def list_segments(folder, id) -> list:
+    """
+    List all binary log segments of a sensor, oldest first
+    :param folder: logs folder
+    :param id: sensor id
+    :return: list of file paths
+    """
+    prefix = _segment_prefix(folder, id)
+    segments = []
+    for f in glob.glob(glob.escape(prefix) + "*"):
+        seq = f[len(prefix) :]
+        if seq.isdigit():
+            segments.append((int(seq), f))
+    return [f for _, f in sorted(segments)]
+
+
+def read_segment(path):
+    """
+    Map a segment file into memory. Trailing bytes of a partially written record are ignored.
+    :param path: segment file
+    :return: structured numpy array with RECORD_DTYPE or None if the segment is empty
+    """
+    rows = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    if rows == 0:
+        return None
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(rows,))
+
+
+def _index_path(path):
+    return path + ".idx"
+
+
+def write_index(path):
+    """
+    Write the sidecar index of a closed segment with its first and last timestamp and row count
+    :param path: segment file
+    :return: index as dict or None if the segment is empty
+    """
+    data = read_segment(path)
+    if data is None:
+        return None
+    index = dict(first=int(data["ts"][0]), last=int(data["ts"][-1]), rows=len(data))
+    with open(_index_path(path), "w") as file:
+        json.dump(index, file)
+    return index
+
+
+def read_index(path, closed=True):
+    """
+    Get first and last timestamp and row count of a segment. Closed segments are described
+    by their sidecar index, which is created on first use if missing. The segment that is still
+    written to is looked up directly.
+    :param path: segment file
+    :param closed: False for the active segment
+    :return: index as dict or None if the segment is empty
+    """
+    if closed:
+        try:
+            with open(_index_path(path)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return write_index(path)
+    data = read_segment(path)
+    if data is None:
+        return None
+    return dict(first=int(data["ts"][0]), last=int(data["ts"][-1]), rows=len(data))
+
+
+def read_window(folder, id, start=None, end=None):
+    """
+    Read all records of a sensor with start <= ts <= end. Segments outside of the window
+    are skipped by their index and the slice inside a segment is found by binary search.
+    :param folder: logs folder
+    :param id: sensor id
+    :param start: epoch seconds or None for no lower bound
+    :param end: epoch seconds or None for no upper bound
+    :return: tuple of (timestamps, values) as numpy arrays
+    """
+    segments = list_segments(folder, id)
+    parts = []
+    for i, f in enumerate(segments):
+        index = read_index(f, closed=i < len(segments) - 1)
+        if index is None:
+            continue
+        if start is not None and index["last"] < start:
+            continue
+        if end is not None and index["first"] > end:
+            continue
+        data = read_segment(f)
+        if data is None:
+            continue
+        lo = 0 if start is None else np.searchsorted(data["ts"], start, side="left")
+        hi = len(data) if end is None else np.searchsorted(data["ts"], end, side="right")
+        if hi > lo:
+            parts.append(data[lo:hi])
+    if len(parts) == 0:
+        return np.empty(0, dtype="<i8"), np.empty(0, dtype="<f8")
+    data = np.concatenate(parts)
+    return data["ts"], data["value"]
+
+
+def remove_segment(path) -> None:
+    os.remove(path)
+    if os.path.exists(_index_path(path)):
+        os.remove(_index_path(path))
+
+
+def remove_segments(folder, id) -> None:
+    for f in list_segments(folder, id):
+        remove_segment(f)
+
+
+def _utc_offsets(ts):
+    # the utc offset is looked up once per hour instead of once per timestamp
+    hours, inverse = np.unique(ts // 3600, return_inverse=True)
+    return np.array(
+        [time.localtime(int(h) * 3600).tm_gmtoff for h in hours], dtype="<i8"
+    )[inverse]
+
+
+def to_local_naive(ts):
+    """
+    Convert epoch seconds to naive local time (datetime64[s]) as written to the csv logs.
+    :param ts: numpy array of epoch seconds
+    :return: numpy array of datetime64[s]
+    """
+    ts = np.asarray(ts, dtype="<i8")
+    if ts.size == 0:
+        return ts.astype("datetime64[s]")
+    return (ts + _utc_offsets(ts)).astype("datetime64[s]")
+
+
+def from_local_naive(local):
+    """
+    Convert naive local times (e.g. parsed from the csv logs) to epoch seconds
+    :param local: numpy array of datetime64
+    :return: numpy array of epoch seconds
+    """
+    guess = np.asarray(local, dtype="datetime64[s]").astype("<i8")
+    if guess.size == 0:
+        return guess
+    return guess - _utc_offsets(guess - _utc_offsets(guess))
+
+
+class SegmentWriter:
+    """
+    Append only writer for the binary log segments of one sensor.
+    Segments are named sensor_<id>.bin.<seq>. A new segment is started once max_bytes
+    is reached and only the newest backup_count + 1 segments are kept. Closed segments
+    get a sidecar index sensor_<id>.bin.<seq>.idx.
+    """
+
+    def __init__(self, folder, id, max_bytes=100000, backup_count=3):
+        self.folder = folder
+        self.id = id
+        self.max_bytes = max(int(max_bytes), RECORD_DTYPE.itemsize)
+        self.backup_count = int(backup_count)
+        self.file = None
+        self.size = 0
+        self.seq = 0
+        segments = list_segments(folder, id)
+        if len(segments) > 0:
+            last = segments[-1]
+            self.seq = int(last[len(_segment_prefix(folder, id)) :])
+            self._open(last)
+        else:
+            self._open(self._segment_path(self.seq))
+
+    def _segment_path(self, seq):
+        return "%s%06d" % (_segment_prefix(self.folder, self.id), seq)
+
+    def _open(self, path):
+        self.path = path
+        if os.path.exists(_index_path(path)):
+            # the segment is written to again, its index would get stale
+            os.remove(_index_path(path))
+        self.file = open(path, "ab")
+        # cut a partially written record from a previous crash
+        size = self.file.tell()
+        rest = size % RECORD_DTYPE.itemsize
+        if rest != 0:
+            self.file.truncate(size - rest)
+            self.file.seek(size - rest)
+        self.size = self.file.tell()
+
+    def rollover(self):
+        self.close()
+        write_index(self.path)
+        self.seq += 1
+        self._open(self._segment_path(self.seq))
+        segments = list_segments(self.folder, self.id)
+        for f in segments[: max(0, len(segments) - self.backup_count - 1)]:
+            try:
+                remove_segment(f)
+            except OSError:
+                pass
+
+    def append(self, ts, value) -> None:
+        record = np.array([(int(ts), float(value))], dtype=RECORD_DTYPE)
+        self.write(record)
+
+    def write(self, records) -> None:
+        """
+        Write a structured array of records, split over segments where it does not fit
+        :param records: numpy array with RECORD_DTYPE
+        """
+        if self.file is None:
+            self._open(self._segment_path(self.seq))
+        while len(records) > 0:
+            if self.size > 0 and self.size + RECORD_DTYPE.itemsize > self.max_bytes:
+                self.rollover()
+            count = max(1, (self.max_bytes - self.size) // RECORD_DTYPE.itemsize)
+            chunk, records = records[:count], records[count:]
+            self.file.write(chunk.tobytes())
+            self.size += chunk.nbytes
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,101 @@
+import numpy as np
+
+__all__ = ["MODES", "lttb", "minmax", "nth", "select"]
+
+MODES = ("nth", "lttb", "minmax")
+
+
+def nth(n, threshold):
+    """
+    Take every nth point so that the result does not exceed threshold * 2 points
+    :param n: number of points
+    :param threshold: target number of points
+    :return: indices of the selected points
+    """
+    step = int(n / threshold) if threshold > 0 else 1
+    if step > 1:
+        return np.arange(0, n, step)
+    return np.arange(n)
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Keeps the first and the last point and
+    from every bucket in between the point that forms the largest triangle with the point
+    selected in the previous bucket and the average of the next bucket.
+    :param x: numpy array of x values (e.g. epoch seconds)
+    :param y: numpy array of y values without NaN
+    :param threshold: number of points to return
+    :return: indices of the selected points
+    """
+    x = np.asarray(x, dtype="<f8")
+    y = np.asarray(y, dtype="<f8")
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # threshold - 2 buckets between the first and the last point
+    edges = np.floor(np.linspace(1, n - 1, threshold - 1)).astype(np.int64)
+    cx = np.concatenate(([0.0], np.cumsum(x)))
+    cy = np.concatenate(([0.0], np.cumsum(y)))
+    size = edges[1:] - edges[:-1]
+    mean_x = (cx[edges[1:]] - cx[edges[:-1]]) / size
+    mean_y = (cy[edges[1:]] - cy[edges[:-1]]) / size
+    # the last bucket is compared against the last point
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+
+    result = np.empty(threshold, dtype=np.int64)
+    result[0] = 0
+    result[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs(
+            (x[a] - next_x[i]) * (y[lo:hi] - y[a])
+            - (x[a] - x[lo:hi]) * (next_y[i] - y[a])
+        )
+        a = lo + int(np.argmax(area))
+        result[i + 1] = a
+    return result
+
+
+def minmax(y, threshold):
+    """
+    Keep the minimum and the maximum of every bucket, so short spikes are never dropped
+    :param y: numpy array of y values without NaN
+    :param threshold: number of points to return (two per bucket)
+    :return: sorted indices of the selected points
+    """
+    y = np.asarray(y, dtype="<f8")
+    n = len(y)
+    buckets = threshold // 2
+    if threshold >= n or buckets < 1:
+        return np.arange(n)
+    edges = np.floor(np.linspace(0, n, buckets + 1)).astype(np.int64)
+    starts = edges[:-1]
+    # a bucket is a row of a padded matrix, so min and max are found without a python loop
+    width = int((edges[1:] - starts).max())
+    positions = starts[:, None] + np.arange(width)[None, :]
+    valid = positions < edges[1:, None]
+    positions = np.minimum(positions, n - 1)
+    values = y[positions]
+    low = starts + np.argmin(np.where(valid, values, np.inf), axis=1)
+    high = starts + np.argmax(np.where(valid, values, -np.inf), axis=1)
+    return np.unique(np.concatenate((low, high, [0, n - 1])))
+
+
+def select(x, y, mode, threshold):
+    """
+    :param x: numpy array of x values
+    :param y: numpy array of y values without NaN
+    :param mode: one of MODES
+    :param threshold: target number of points
+    :return: indices of the selected points
+    """
+    if mode == "lttb":
+        return lttb(x, y, threshold)
+    if mode == "minmax":
+        return minmax(y, threshold)
+    # every nth point yields up to twice the requested rows
+    return nth(len(y), threshold // 2)
@@ -0,0 +1,44 @@
+__all__ = ["IdIndex"]
+
+
+class IdIndex:
+    """
+    id -> position index of a list of items with an id attribute, the list itself keeps the
+    order for presentation. The index is rebuilt when another list is passed or the length
+    changed. A hit is checked against the list and a miss rebuilds the index once, so items
+    moved, replaced or appended in place are found as well.
+    """
+
+    def __init__(self):
+        self._source = None
+        self._length = -1
+        self._positions = {}
+
+    def rebuild(self, data):
+        positions = {}
+        # the first item wins for duplicate ids like with a linear scan
+        for i in range(len(data) - 1, -1, -1):
+            positions[data[i].id] = i
+        self._positions = positions
+        self._source = data
+        self._length = len(data)
+
+    def position(self, data, id):
+        """
+        :return: position of the item with id in data or None
+        """
+        rebuilt = data is not self._source or len(data) != self._length
+        if rebuilt:
+            self.rebuild(data)
+        i = self._positions.get(id)
+        if (i is None and not rebuilt) or (i is not None and data[i].id != id):
+            self.rebuild(data)
+            i = self._positions.get(id)
+        return i
+
+    def get(self, data, id):
+        """
+        :return: item with id in data or None
+        """
+        i = self.position(data, id)
+        return None if i is None else data[i]
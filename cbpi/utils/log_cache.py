@@ -0,0 +1,122 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["SeriesCache", "SeriesEntry"]
+
+
+def _format_time(index):
+    return pd.DatetimeIndex(index).astype(str).tolist()
+
+
+class SeriesEntry:
+    """
+    Resampled buckets of one sensor for one window. The bucket times (naive local time) and
+    values are kept as numpy arrays for queries and as lists for the json response.
+    read_at is the epoch time the data was read at, samples logged later are not included.
+    """
+
+    def __init__(self, index, values, version, read_at):
+        self.index = np.asarray(index, dtype="datetime64[s]")
+        self.values = np.asarray(values, dtype="<f8")
+        self.time = _format_time(self.index)
+        self.value = self.values.tolist()
+        self.version = version
+        self.read_at = read_at
+
+    @property
+    def nbytes(self):
+        # python lists hold a pointer plus a str (~75 bytes) or float (24 bytes) object per row
+        return self.index.nbytes + self.values.nbytes + len(self.index) * 115
+
+    def splice(self, index, values, version, read_at):
+        """
+        Replace the trailing bucket and everything after it with freshly read buckets
+        :param index: bucket times starting at the trailing bucket
+        :param values: bucket values
+        :param version: write version of the sensor the tail was read at
+        :param read_at: epoch time the tail was read at
+        """
+        index = np.asarray(index, dtype="datetime64[s]")
+        keep = len(self.index)
+        if len(index) > 0:
+            keep = int(np.searchsorted(self.index, index[0], side="left"))
+        self.index = np.concatenate((self.index[:keep], index))
+        self.values = np.concatenate((self.values[:keep], np.asarray(values, dtype="<f8")))
+        del self.time[keep:]
+        del self.value[keep:]
+        self.time.extend(_format_time(index))
+        self.value.extend(np.asarray(values, dtype="<f8").tolist())
+        self.version = version
+        self.read_at = read_at
+
+    def trim(self, first, rate):
+        """
+        Drop buckets that ended before the start of a sliding window
+        :param first: naive local time of the window start
+        :param rate: bucket size in seconds
+        """
+        last_dropped = np.datetime64(first, "s") - np.timedelta64(int(rate), "s")
+        drop = int(np.searchsorted(self.index, last_dropped, side="right"))
+        if drop > 0:
+            self.index = self.index[drop:]
+            self.values = self.values[drop:]
+            del self.time[:drop]
+            del self.value[:drop]
+
+
+class SeriesCache:
+    """
+    LRU cache of resampled sensor series keyed by (sensor id, sample rate, start, end).
+    Entries are evicted, least recently used first, once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry) -> None:
+        if self.max_bytes <= 0:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        entry.size = entry.nbytes
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes and len(self.entries) > 0:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def resize(self, key) -> None:
+        """
+        Update the accounted size of an entry after it was spliced or trimmed
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.put(key, entry)
+
+    def remove(self, id) -> None:
+        """
+        Drop all entries of a sensor
+        :param id: sensor id
+        """
+        for key in [key for key in self.entries if key[0] == id]:
+            self.size -= self.entries.pop(key).size
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
@@ -0,0 +1,455 @@
+"""
+Sensor log queries. All functions only take plain, picklable arguments so they can run
+in the query process pool of the JobController instead of on the event loop.
+Open rollup buckets only exist in the main process and are passed in as ``pending``:
+a dict of sensor id -> {tier: structured array with zero or one row}.
+The caller flushes the queues of the log targets first, see WriteBehindQueue.
+"""
+import datetime
+import glob
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from cbpi.utils import binlog, downsample, rollup, sqlite_log
+
+logger = logging.getLogger(__name__)
+
+# points per series if the client does not send its chart width
+DEFAULT_WIDTH = 1000
+
+
+def _csv_files(folder, id):
+    return glob.glob(os.path.join(folder, f"sensor_{id}.log*"))
+
+
+def _read_csv(files):
+    df = pd.concat(
+        [pd.read_csv(f, names=["DateTime", "Values"], header=None) for f in files]
+    )
+    local = pd.to_datetime(df["DateTime"], format="%Y-%m-%d %H:%M:%S").values
+    return binlog.from_local_naive(local), df["Values"].values.astype("<f8")
+
+
+def _binlog_first(segments):
+    for i, f in enumerate(segments):
+        index = binlog.read_index(f, closed=i < len(segments) - 1)
+        if index is not None:
+            return index["first"]
+    return None
+
+
+def _window(ts, values, start=None, end=None, before=None):
+    mask = np.ones(len(ts), dtype=bool)
+    if start is not None:
+        mask &= ts >= start
+    if end is not None:
+        mask &= ts <= end
+    if before is not None:
+        mask &= ts < before
+    return ts[mask], values[mask]
+
+
+def _older(start, before):
+    # a store older than before is needed for the window
+    return before is None or start is None or start < before
+
+
+def read_raw(folder, id, start=None, end=None, connection=None):
+    """
+    Read the raw samples of a sensor. The sqlite log is queried through its index on
+    (sensor_id, ts). Binary segments written by the binary log target are mapped into memory
+    and only the segments overlapping the window are opened. The csv logs are parsed as a whole.
+    A store is only read for the part of the window before the first sample of a newer store,
+    so history written before switching the log target stays visible.
+    :param folder: logs folder
+    :param id: sensor id
+    :param start: absolute epoch seconds or None
+    :param end: absolute epoch seconds or None
+    :param connection: open sqlite connection to reuse
+    :return: tuple of (epoch seconds, values) as numpy arrays
+    """
+    # newest store first, before is the first sample of the newer stores
+    parts = []
+    before = sqlite_log.first_timestamp(folder, id, connection)
+    if before is not None:
+        parts.append(sqlite_log.read_window(folder, id, start, end, connection))
+
+    segments = binlog.list_segments(folder, id)
+    if len(segments) > 0 and _older(start, before):
+        parts.append(_window(*binlog.read_window(folder, id, start, end), before=before))
+        first = _binlog_first(segments)
+        if first is not None:
+            before = first if before is None else min(before, first)
+
+    files = _csv_files(folder, id)
+    if len(parts) == 0 or (len(files) > 0 and _older(start, before)):
+        # csv logs have no time index, the window is applied after parsing
+        parts.append(_window(*_read_csv(files), start, end, before))
+
+    parts.reverse()
+    return (
+        np.concatenate([ts for ts, values in parts]).astype("<i8", copy=False),
+        np.concatenate([values for ts, values in parts]).astype("<f8", copy=False),
+    )
+
+
+def export_csv(folder, id, path, chunk_size=10000):
+    """
+    Write the raw samples of all stores of a sensor into one file in the format of the csv log
+    target. Nothing is written if the sensor has neither a binary nor a sqlite log, its csv logs
+    can be used as they are.
+    :param folder: logs folder
+    :param id: sensor id
+    :param path: file to write
+    :param chunk_size: number of lines formatted at once
+    :return: number of samples written
+    """
+    with sqlite_log.reader(folder) as connection:
+        if (
+            len(binlog.list_segments(folder, id)) == 0
+            and sqlite_log.first_timestamp(folder, id, connection) is None
+        ):
+            return 0
+        ts, values = read_raw(folder, id, connection=connection)
+    local = np.char.replace(
+        np.datetime_as_string(binlog.to_local_naive(ts), unit="s"), "T", " "
+    )
+    with open(path, "w") as f:
+        for i in range(0, len(ts), chunk_size):
+            f.writelines(
+                "%s,%s\n" % (t, v)
+                for t, v in zip(local[i : i + chunk_size], values[i : i + chunk_size].tolist())
+            )
+    return len(ts)
+
+
+def read_log(folder, id, column="Values", start=None, end=None, connection=None):
+    """
+    :param folder: logs folder
+    :param id: sensor id
+    :param column: name of the value column
+    :param start: absolute epoch seconds or None
+    :param end: absolute epoch seconds or None
+    :param connection: open sqlite connection to reuse
+    :return: DataFrame with DateTime index (local time) and one value column
+    """
+    ts, values = read_raw(folder, id, start, end, connection)
+    index = pd.DatetimeIndex(binlog.to_local_naive(ts), name="DateTime")
+    return pd.DataFrame({column: values}, index=index)
+
+
+def _file_first(folder, id):
+    # oldest sample of the binary and csv logs
+    result = _binlog_first(binlog.list_segments(folder, id))
+    for f in _csv_files(folder, id):
+        try:
+            with open(f) as file:
+                line = file.readline()
+            ts = datetime.datetime.strptime(line.split(",")[0], "%Y-%m-%d %H:%M:%S")
+            ts = ts.timestamp()
+            result = ts if result is None else min(result, ts)
+        except Exception:
+            pass
+    return result
+
+
+def first_timestamp(folder, id, connection=None):
+    """
+    :param folder: logs folder
+    :param id: sensor id
+    :param connection: open sqlite connection to reuse
+    :return: epoch seconds of the oldest raw sample of all stores or None if there is no raw log
+    """
+    first = sqlite_log.first_timestamp(folder, id, connection)
+    older = _file_first(folder, id)
+    if first is None or (older is not None and older < first):
+        return older
+    return first
+
+
+def sqlite_covers(folder, id, start=None, connection=None):
+    """
+    :param folder: logs folder
+    :param id: sensor id
+    :param start: absolute epoch seconds or None
+    :param connection: open sqlite connection to reuse
+    :return: True if the sqlite log holds all raw samples of the window
+    """
+    first = sqlite_log.first_timestamp(folder, id, connection)
+    if first is None:
+        return False
+    if start is not None and start >= first:
+        return True
+    older = _file_first(folder, id)
+    return older is None or older >= first
+
+
+def _pending(pending, id, tier):
+    try:
+        return pending[id][tier]
+    except (KeyError, TypeError):
+        return np.empty(0, dtype=rollup.ROLLUP_DTYPE)
+
+
+def rollup_covers(folder, id, tier, start=None, pending=None, connection=None):
+    """
+    Rollups are only maintained since they were enabled. They can answer a query if
+    they go back as far as the raw logs do.
+    :param folder: logs folder
+    :param id: sensor id
+    :param tier: bucket size in seconds
+    :param start: absolute epoch seconds or None
+    :param pending: open rollup buckets
+    :param connection: open sqlite connection to reuse
+    :return: True if the rollups of the tier cover the window
+    """
+    first = rollup.first_timestamp(folder, id, tier)
+    if first is None:
+        open_bucket = _pending(pending, id, tier)
+        if len(open_bucket) == 0:
+            return False
+        first = int(open_bucket["ts"][0])
+    raw_first = first_timestamp(folder, id, connection)
+    if raw_first is None:
+        return True
+    return first <= max(raw_first, start if start is not None else raw_first)
+
+
+def read_rollup(folder, id, tier, start=None, end=None, pending=None):
+    """
+    Persisted rollup records of a sensor including the open bucket
+    :param folder: logs folder
+    :param id: sensor id
+    :param tier: bucket size in seconds
+    :param start: absolute epoch seconds or None
+    :param end: absolute epoch seconds or None
+    :param pending: open rollup buckets
+    :return: structured array with rollup.ROLLUP_DTYPE
+    """
+    records = rollup.read_rollup(folder, id, tier, start, end)
+    open_bucket = _pending(pending, id, tier)
+    if len(open_bucket) > 0 and (end is None or open_bucket["ts"][0] <= end):
+        records = rollup.merge(np.concatenate([records, open_bucket]))
+    return records
+
+
+def read_resampled(
+    folder, id, sample_rate, column="Values", start=None, end=None, pending=None, connection=None
+):
+    """
+    Max per sample_rate bucket, buckets start at multiples of sample_rate since the epoch.
+    Served from the coarsest rollup tier the rate is a multiple of. Otherwise the sqlite log
+    aggregates the buckets if it holds the whole window, other raw logs are bucketed here.
+    :param folder: logs folder
+    :param id: sensor id
+    :param sample_rate: pandas offset string, e.g. "60s"
+    :param column: name of the series
+    :param start: absolute epoch seconds or None
+    :param end: absolute epoch seconds or None
+    :param pending: open rollup buckets
+    :param connection: open sqlite connection to reuse
+    :return: Series with DateTime index (local time), empty buckets are left out
+    """
+    seconds = pd.Timedelta(sample_rate).total_seconds()
+    tier = rollup.select_tier(seconds, exact=True)
+    if tier is not None and rollup_covers(folder, id, tier, start, pending, connection):
+        records = read_rollup(folder, id, tier, start, end, pending)
+        if tier != seconds:
+            records = rollup.aggregate(records["ts"], records["max"], int(seconds))
+    elif sqlite_covers(folder, id, start, connection):
+        records = sqlite_log.read_buckets(folder, [id], seconds, start, end, connection=connection)[id]
+    else:
+        ts, values = read_raw(folder, id, start, end, connection)
+        keep = ~np.isnan(values)
+        records = rollup.aggregate(ts[keep], values[keep], max(1, int(seconds)))
+    # all paths use buckets aligned to the epoch like the rollups, not to local time
+    index = pd.DatetimeIndex(binlog.to_local_naive(records["ts"]), name="DateTime")
+    return pd.Series(records["max"], index=index, name=column)
+
+
+def reduce(df, mode="nth", width=None):
+    """
+    Reduce a series to about width points for a chart
+    :param df: Series with DateTime index and without NaN
+    :param mode: one of downsample.MODES
+    :param width: chart width in pixel, default DEFAULT_WIDTH
+    :return: Series
+    """
+    width = DEFAULT_WIDTH if width is None else width
+    if df.shape[0] <= width:
+        return df
+    x = df.index.values.astype("datetime64[s]").astype("<f8")
+    return df.iloc[downsample.select(x, df.values, mode, width)]
+
+
+def read_series(folder, ids, sample_rate="60s", start=None, end=None, pending=None):
+    """
+    Read the series of several sensors. Sensors without log are left out.
+    :param folder: logs folder
+    :param ids: list of sensor ids
+    :param sample_rate: rate for resampling the data, None for the raw samples
+    :param start: absolute epoch seconds, None or a dict of sensor id -> epoch seconds
+    :param end: absolute epoch seconds or None
+    :param pending: open rollup buckets
+    :return: dict of sensor id -> (datetime64[s] array of naive local time, values) without NaN
+    """
+    result = dict()
+    # one sqlite connection for all sensors of the query
+    with sqlite_log.reader(folder) as connection:
+        for id in ids:
+            first = start.get(id) if isinstance(start, dict) else start
+            try:
+                if sample_rate is not None:
+                    df = read_resampled(
+                        folder, id, sample_rate, start=first, end=end, pending=pending,
+                        connection=connection,
+                    )
+                else:
+                    df = read_log(folder, id, start=first, end=end, connection=connection)["Values"]
+            except Exception as e:
+                logger.warning("Failed to read log for {}: {}".format(id, e))
+                continue
+            df = df.dropna()
+            result[id] = (df.index.values.astype("datetime64[s]"), df.values.astype("<f8"))
+    return result
+
+
+def _series(series, id):
+    index, values = series[id]
+    return pd.Series(values, index=pd.DatetimeIndex(index, name="DateTime"), name=id)
+
+
+def format_data(series, names, limit=None, mode=None, width=None):
+    """
+    Merge the series of several sensors on a common time axis
+    :param series: dict of sensor id -> (time, values) as returned by read_series
+    :param names: sensor ids
+    :param limit: max number of newest rows per sensor
+    :param mode: downsampling mode (nth, lttb or minmax), default nth
+    :param width: max number of points per sensor, default DEFAULT_WIDTH
+    :return: dict with time list and one value list per sensor
+    """
+    result = None
+
+    for name in names:
+        if name not in series:
+            continue
+        df = _series(series, name)
+        if limit is not None:
+            df = df.iloc[-limit:]
+        df = reduce(df, mode or "nth", width)
+
+        if result is None:
+            result = df
+        else:
+            result = pd.merge(result, df, how="outer", left_index=True, right_index=True)
+
+    if result is None:
+        return {"time": []}
+
+    data = {"time": result.index.tolist()}
+
+    if isinstance(result, pd.DataFrame):
+        for name in result.columns:
+            data[name] = (
+                result[name].interpolate(limit_direction="both", limit=10).tolist()
+            )
+    else:
+        data[result.name] = result.interpolate().tolist()
+
+    return data
+
+
+def format_data2(series, limit=None, mode=None, width=None):
+    """
+    :param series: dict of sensor id -> (time, values) as returned by read_series
+    :param limit: max number of newest rows per sensor
+    :param mode: downsampling mode (nth, lttb or minmax), default all rows
+    :param width: max number of points per sensor, default DEFAULT_WIDTH
+    :return: dict with time and value list per sensor id
+    """
+    result = dict()
+    for id in series:
+        df = _series(series, id)
+        if limit is not None:
+            df = df.iloc[-limit:]
+        if mode is not None:
+            df = reduce(df, mode, width)
+        result[id] = {
+            "time": df.index.astype(str).tolist(),
+            "value": df.tolist(),
+        }
+    return result
+
+
+def query_data(
+    folder,
+    names,
+    sample_rate="60s",
+    start=None,
+    end=None,
+    limit=None,
+    pending=None,
+    mode=None,
+    width=None,
+):
+    """
+    Chart data for one or more sensors, merged on a common time axis
+    :param folder: logs folder
+    :param names: set of sensor ids
+    :param sample_rate: rate for resampling the data
+    :param start: absolute epoch seconds or None
+    :param end: absolute epoch seconds or None
+    :param limit: max number of newest rows per sensor
+    :param pending: open rollup buckets
+    :param mode: downsampling mode (nth, lttb or minmax), default nth
+    :param width: max number of points per sensor, default DEFAULT_WIDTH
+    :return: dict with time list and one value list per sensor
+    """
+    series = read_series(folder, names, sample_rate, start, end, pending)
+    logger.info("Read and sampled now for {}".format(names))
+    return format_data(series, names, limit, mode, width)
+
+
+def query_rollup(folder, ids, resolution=60, start=None, end=None, limit=None, pending=None):
+    """
+    Min / max / mean / count per bucket from the coarsest tier that satisfies the resolution
+    :param folder: logs folder
+    :param ids: list of sensor ids
+    :param resolution: requested resolution in seconds
+    :param start: absolute epoch seconds or None
+    :param end: absolute epoch seconds or None
+    :param limit: max number of newest buckets per sensor
+    :param pending: open rollup buckets
+    :return: dict with resolution, time, min, max, mean and count lists per sensor id
+    """
+    tier = rollup.select_tier(resolution) or rollup.TIERS[0]
+    result = dict()
+    # one sqlite connection for all sensors of the query
+    with sqlite_log.reader(folder) as connection:
+        for id in ids:
+            try:
+                if rollup_covers(folder, id, tier, start, pending, connection):
+                    records = read_rollup(folder, id, tier, start, end, pending)
+                elif sqlite_covers(folder, id, start, connection):
+                    records = sqlite_log.read_buckets(
+                        folder, [id], tier, start, end, limit, connection
+                    )[id]
+                else:
+                    ts, values = read_raw(folder, id, start, end, connection)
+                    records = rollup.aggregate(ts, values, tier)
+                if limit is not None:
+                    records = records[-limit:]
+                result[id] = {
+                    "resolution": tier,
+                    "time": pd.DatetimeIndex(binlog.to_local_naive(records["ts"])).astype(str).tolist(),
+                    "min": records["min"].tolist(),
+                    "max": records["max"].tolist(),
+                    "mean": records["mean"].tolist(),
+                    "count": records["count"].tolist(),
+                }
+            except Exception as e:
+                logger.warning("Failed to read rollup for {}: {}".format(id, e))
+    return result
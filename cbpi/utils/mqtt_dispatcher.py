@@ -0,0 +1,128 @@
+import asyncio
+import collections
+import logging
+import time
+
+from cbpi.eventbus import CBPiEventBus
+
+__all__ = ["MQTTDispatcher"]
+
+
+class HandlerStats(CBPiEventBus.HandlerStats):
+    __slots__ = ("max_wait",)
+
+    def __init__(self):
+        super().__init__()
+        # longest time in seconds a message waited for the handler
+        self.max_wait = 0.0
+
+    def to_dict(self):
+        return dict(super().to_dict(), max_wait=self.max_wait)
+
+
+class MQTTDispatcher:
+    """
+    Runs the handlers of incoming MQTT messages concurrently. Messages of one topic are
+    handled in order by each handler, at most max_concurrency handlers run at the same time.
+    order_key(method, topic) can put several handlers and topics into one ordered queue.
+    dispatch() waits while max_pending messages are queued so the broker client buffers
+    instead of this dispatcher.
+    """
+
+    def __init__(self, max_concurrency=8, max_pending=1000, order_key=None):
+        """
+        :param max_concurrency: max number of handlers running at the same time
+        :param max_pending: max number of queued messages
+        :param order_key: function (method, topic) -> queue key, default (method, topic)
+        """
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.logger = logging.getLogger(__name__)
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._pending = asyncio.Semaphore(max_pending)
+        self.order_key = order_key if order_key is not None else lambda method, topic: (method, topic)
+        # order key -> deque of (handler, message, queued), drained by one task
+        self._queues = {}
+        self._tasks = set()
+        self.handler_stats = {}
+
+    @staticmethod
+    def handler_key(method):
+        name = getattr(method, "__qualname__", method.__name__)
+        return "%s.%s" % (method.__module__, name)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def dispatch(self, methods, message):
+        """
+        :param methods: coroutine functions called with the message
+        :param message: aiomqtt message
+        """
+        topic = message.topic.value
+        for method in methods:
+            await self._pending.acquire()
+            key = self.order_key(method, topic)
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = collections.deque()
+                queue.append((method, message, time.perf_counter()))
+                task = asyncio.create_task(self._drain(key, queue))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            else:
+                queue.append((method, message, time.perf_counter()))
+
+    async def _drain(self, key, queue):
+        try:
+            while len(queue) > 0:
+                method, message, queued = queue.popleft()
+                stats = self.handler_stats.get(self.handler_key(method))
+                if stats is None:
+                    stats = self.handler_stats[self.handler_key(method)] = HandlerStats()
+                try:
+                    async with self._slots:
+                        start = time.perf_counter()
+                        try:
+                            await method(message)
+                        except Exception as e:
+                            stats.errors += 1
+                            self.logger.error(
+                                "MQTT handler {} failed for {}: {}".format(
+                                    self.handler_key(method), message.topic.value, e
+                                )
+                            )
+                        finally:
+                            stats.add(time.perf_counter() - start)
+                            wait = start - queued
+                            if wait > stats.max_wait:
+                                stats.max_wait = wait
+                finally:
+                    self._pending.release()
+        finally:
+            del self._queues[key]
+
+    async def join(self):
+        """
+        Wait until all queued messages are handled
+        """
+        while len(self._tasks) > 0:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def get_stats(self):
+        return dict(
+            pending=len(self),
+            max_pending=self.max_pending,
+            max_concurrency=self.max_concurrency,
+            handlers={
+                key: stats.to_dict()
+                for key, stats in sorted(
+                    self.handler_stats.items(), key=lambda i: i[1].total, reverse=True
+                )
+            },
+        )
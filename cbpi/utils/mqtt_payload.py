@@ -0,0 +1,125 @@
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = ["PayloadDecoder", "compile_path", "extract"]
+
+logger = logging.getLogger(__name__)
+
+
+def compile_path(path):
+    """
+    :param path: dot separated keys like "ENERGY.Power", numbers index lists. Empty for the whole payload
+    :return: tuple of keys
+    """
+    if path is None or str(path).strip() == "":
+        return ()
+    return tuple(str(path).split("."))
+
+
+def extract(value, path):
+    """
+    :param value: decoded payload
+    :param path: compiled path
+    :return: value at path, None if it does not exist
+    """
+    for key in path:
+        if isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return None
+    return value
+
+
+def decode(payload):
+    """
+    :param payload: bytes of a message
+    :return: decoded JSON, or the text if it is not JSON
+    """
+    try:
+        if orjson is not None:
+            return orjson.loads(payload)
+        return json.loads(payload)
+    except ValueError:
+        return payload.decode(errors="replace")
+
+
+class PayloadDecoder:
+    """
+    Decodes the payload of a topic once and hands the values at the subscribed paths to the
+    callbacks. Several sensors reading one device message share a single subscription.
+    """
+
+    class Route:
+        def __init__(self, decoder, topic):
+            self.decoder = decoder
+            self.topic = topic
+            # compiled path -> list of callbacks
+            self.paths = {}
+            self.messages = 0
+
+        async def on_message(self, message):
+            self.messages += 1
+            payload = decode(message.payload)
+            for path, callbacks in list(self.paths.items()):
+                value = extract(payload, path)
+                for callback in callbacks:
+                    try:
+                        await callback(value)
+                    except Exception as e:
+                        logger.error(
+                            "MQTT payload handler for {} failed: {}".format(self.topic, e)
+                        )
+
+    def __init__(self, satellite):
+        self.satellite = satellite
+        # topic filter -> Route
+        self.routes = {}
+
+    def subscribe(self, topic, path, callback):
+        """
+        :param topic: topic filter
+        :param path: see compile_path
+        :param callback: coroutine function called with the value at path, None if missing
+        :return: True
+        """
+        route = self.routes.get(topic)
+        if route is None:
+            route = self.routes[topic] = self.Route(self, topic)
+            self.satellite.subscribe(topic, route.on_message)
+        route.paths.setdefault(compile_path(path), []).append(callback)
+        return True
+
+    def unsubscribe(self, topic, path, callback):
+        """
+        :return: True
+        """
+        route = self.routes.get(topic)
+        if route is None:
+            return True
+        path = compile_path(path)
+        callbacks = route.paths.get(path, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+            if len(callbacks) == 0:
+                del route.paths[path]
+        if len(route.paths) == 0:
+            del self.routes[topic]
+            self.satellite.unsubscribe(topic, route.on_message)
+        return True
+
+    def get_stats(self):
+        return {
+            topic: dict(
+                messages=route.messages,
+                paths=len(route.paths),
+                callbacks=sum(len(c) for c in route.paths.values()),
+            )
+            for topic, route in self.routes.items()
+        }
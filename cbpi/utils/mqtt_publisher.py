@@ -0,0 +1,175 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from cbpi.utils.topic_trie import TopicTrie
+
+__all__ = ["MQTTPublisher"]
+
+
+class MQTTPublisher:
+    """
+    Single outbound queue for MQTT publishes, sent by one task.
+    A publish replaces a queued one of the same topic, retained publishes whose payload equals
+    the last one sent for the topic are skipped. Beyond max_size topics the oldest is dropped.
+    While offline the queue keeps the latest publish per topic and is sent after resume(),
+    together with the last retained publish of every topic.
+    """
+
+    def __init__(self, send, max_size=1000, qos=1, topic_qos=None, retry_interval=5.0):
+        """
+        :param send: coroutine function (topic, payload, qos, retain) returning True when sent
+                     and False when the client is offline
+        :param qos: default quality of service
+        :param topic_qos: dict topic filter -> quality of service, + and # wildcards allowed.
+                          The most specific matching filter wins, see specificity()
+        :param retry_interval: seconds between attempts while offline, resume() retries at once
+        """
+        self.send = send
+        self.max_size = max_size
+        self.qos = qos
+        self.retry_interval = retry_interval
+        self.logger = logging.getLogger(__name__)
+        self._qos = TopicTrie()
+        self._qos_filters = {}
+        for topic_filter, value in (topic_qos or {}).items():
+            self.set_qos(topic_filter, value)
+        # topic -> (payload, qos, retain)
+        self._queue = OrderedDict()
+        # topic -> (payload, qos) of the last retained publish sent
+        self._retained = {}
+        self._wakeup = asyncio.Event()
+        self._online = asyncio.Event()
+        self._online.set()
+        self._closing = False
+        self._task = None
+        self.published = 0
+        self.coalesced = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.errors = 0
+
+    @staticmethod
+    def specificity(topic_filter):
+        """
+        Sort key of topic filters, compared level by level from the left: a literal level
+        is more specific than +, which is more specific than #
+        """
+        return tuple(
+            0 if level == "#" else 1 if level == "+" else 2
+            for level in topic_filter.split("/")
+        )
+
+    def set_qos(self, topic_filter, qos):
+        entry = (self.specificity(topic_filter), int(qos))
+        previous = self._qos_filters.get(topic_filter)
+        if previous is not None:
+            self._qos.remove(topic_filter, previous)
+        self._qos_filters[topic_filter] = entry
+        self._qos.add(topic_filter, entry)
+
+    def get_qos(self, topic):
+        match = self._qos.match(topic)
+        return max(match)[1] if len(match) > 0 else self.qos
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def online(self):
+        return self._online.is_set()
+
+    def resume(self):
+        """
+        Connection is back, send the buffered publishes. The broker may have lost its retained
+        messages (restart without persistence) or another client may have replaced them, so
+        the last retained publish of every topic is sent again.
+        """
+        retained, self._retained = self._retained, {}
+        for topic, (payload, qos) in retained.items():
+            if topic not in self._queue:
+                self.put(topic, payload, retain=True, qos=qos)
+        self._online.set()
+
+    def put(self, topic, payload, retain=False, qos=None):
+        """
+        :param payload: bytes or str
+        :param qos: quality of service, by default the one configured for the topic
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if qos is None:
+            qos = self.get_qos(topic)
+        if retain and self._retained.get(topic, (None,))[0] == payload:
+            # a queued change is obsolete as well
+            if self._queue.pop(topic, None) is not None:
+                self.coalesced += 1
+            self.deduplicated += 1
+            return
+        if topic in self._queue:
+            self.coalesced += 1
+        elif len(self._queue) >= self.max_size:
+            self._queue.popitem(last=False)
+            self.dropped += 1
+        self._queue[topic] = (payload, qos, retain)
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if len(self._queue) == 0:
+                if self._closing:
+                    break
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            topic, (payload, qos, retain) = self._queue.popitem(last=False)
+            try:
+                sent = await self.send(topic, payload, qos, retain)
+            except Exception as e:
+                self.errors += 1
+                self.logger.warning("Failed to publish {} via mqtt: {}".format(topic, e))
+                continue
+            if sent:
+                self.published += 1
+                if retain:
+                    self._retained[topic] = (payload, qos)
+                continue
+            # offline, keep the publish unless a newer one for the topic arrived meanwhile
+            if topic not in self._queue:
+                if len(self._queue) >= self.max_size:
+                    self.dropped += 1
+                else:
+                    self._queue[topic] = (payload, qos, retain)
+                    self._queue.move_to_end(topic, last=False)
+            if self._closing:
+                break
+            self._online.clear()
+            try:
+                # retried now and then in case the connection came back unnoticed
+                await asyncio.wait_for(self._online.wait(), timeout=self.retry_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        """
+        Send the queued publishes and stop
+        """
+        self._closing = True
+        self._wakeup.set()
+        self._online.set()
+        if self._task is not None:
+            await self._task
+
+    def get_stats(self):
+        return dict(
+            queued=len(self._queue),
+            online=self.online,
+            published=self.published,
+            coalesced=self.coalesced,
+            deduplicated=self.deduplicated,
+            dropped=self.dropped,
+            errors=self.errors,
+        )
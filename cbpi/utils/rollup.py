@@ -0,0 +1,267 @@
+import math
+import os
+
+import numpy as np
+
+__all__ = [
+    "ROLLUP_DTYPE",
+    "TIERS",
+    "RollupWriter",
+    "aggregate",
+    "append",
+    "first_timestamp",
+    "merge",
+    "read_rollup",
+    "remove_rollups",
+    "select_tier",
+    "trim",
+    "write_batch",
+]
+
+# one record per closed time bucket, ts is the epoch second the bucket starts
+ROLLUP_DTYPE = np.dtype(
+    [
+        ("ts", "<i8"),
+        ("min", "<f8"),
+        ("max", "<f8"),
+        ("mean", "<f8"),
+        ("count", "<i8"),
+    ]
+)
+
+# bucket sizes in seconds: 1 min, 15 min, 1 h
+TIERS = (60, 900, 3600)
+
+
+def rollup_path(folder, id, tier):
+    return os.path.join(folder, f"sensor_{id}.r{tier}")
+
+
+def select_tier(resolution, exact=False):
+    """
+    Find the coarsest tier that still satisfies the requested resolution
+    :param resolution: requested resolution in seconds
+    :param exact: only return a tier the resolution is a multiple of
+    :return: tier in seconds or None if raw data is required
+    """
+    if resolution is None:
+        return None
+    result = None
+    for tier in TIERS:
+        if tier <= resolution and (not exact or resolution % tier == 0):
+            result = tier
+    return result
+
+
+def merge(records):
+    """
+    Combine records of the same bucket, e.g. a partial bucket written on shutdown and the
+    rest of it written after a restart
+    :param records: structured array with ROLLUP_DTYPE
+    :return: structured array sorted by unique ts
+    """
+    if len(records) < 2:
+        return records
+    if np.any(records["ts"][1:] < records["ts"][:-1]):
+        records = records[np.argsort(records["ts"], kind="stable")]
+    if np.all(records["ts"][1:] != records["ts"][:-1]):
+        return records
+    buckets, idx = np.unique(records["ts"], return_index=True)
+    count = np.add.reduceat(records["count"], idx)
+    result = np.empty(len(buckets), dtype=ROLLUP_DTYPE)
+    result["ts"] = buckets
+    result["min"] = np.minimum.reduceat(records["min"], idx)
+    result["max"] = np.maximum.reduceat(records["max"], idx)
+    result["mean"] = np.add.reduceat(records["mean"] * records["count"], idx) / count
+    result["count"] = count
+    return result
+
+
+def aggregate(ts, values, tier):
+    """
+    Build rollup records from raw samples
+    :param ts: epoch seconds
+    :param values: sensor values
+    :param tier: bucket size in seconds
+    :return: structured array with ROLLUP_DTYPE
+    """
+    buckets = np.asarray(ts, dtype="<i8") // tier * tier
+    values = np.asarray(values, dtype="<f8")
+    order = np.argsort(buckets, kind="stable")
+    buckets = buckets[order]
+    values = values[order]
+    if len(buckets) == 0:
+        return np.empty(0, dtype=ROLLUP_DTYPE)
+    unique, idx = np.unique(buckets, return_index=True)
+    count = np.diff(np.append(idx, len(buckets)))
+    result = np.empty(len(unique), dtype=ROLLUP_DTYPE)
+    result["ts"] = unique
+    result["min"] = np.minimum.reduceat(values, idx)
+    result["max"] = np.maximum.reduceat(values, idx)
+    result["mean"] = np.add.reduceat(values, idx) / count
+    result["count"] = count
+    return result
+
+
+def _map(path):
+    try:
+        rows = os.path.getsize(path) // ROLLUP_DTYPE.itemsize
+    except OSError:
+        return None
+    if rows == 0:
+        return None
+    return np.memmap(path, dtype=ROLLUP_DTYPE, mode="r", shape=(rows,))
+
+
+def first_timestamp(folder, id, tier):
+    data = _map(rollup_path(folder, id, tier))
+    if data is None:
+        return None
+    return int(data["ts"][0])
+
+
+def read_rollup(folder, id, tier, start=None, end=None):
+    """
+    Read the persisted rollup records of a sensor inside a window
+    :param folder: logs folder
+    :param id: sensor id
+    :param tier: bucket size in seconds
+    :param start: epoch seconds or None
+    :param end: epoch seconds or None
+    :return: structured array with ROLLUP_DTYPE
+    """
+    data = _map(rollup_path(folder, id, tier))
+    if data is None:
+        return np.empty(0, dtype=ROLLUP_DTYPE)
+    lo = 0
+    hi = len(data)
+    if start is not None:
+        # the bucket containing start is still part of the window
+        lo = np.searchsorted(data["ts"], int(start) // tier * tier, side="left")
+    if end is not None:
+        hi = np.searchsorted(data["ts"], end, side="right")
+    return merge(np.array(data[lo:hi]))
+
+
+def trim(path, max_bytes) -> None:
+    """
+    Drop the oldest buckets of a rollup file, the newest half of max_bytes is kept so the
+    file is not rewritten on every append
+    :param path: rollup file
+    :param max_bytes: size limit of the file
+    """
+    data = _map(path)
+    if data is None:
+        return
+    keep = max(1, max_bytes // 2 // ROLLUP_DTYPE.itemsize)
+    tail = np.array(data[-keep:])
+    del data
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as file:
+        file.write(tail.tobytes())
+    os.replace(tmp, path)
+
+
+def append(folder, id, tier, records, max_bytes=None) -> None:
+    """
+    Append closed buckets to a tier file and trim it once it grows beyond max_bytes
+    :param records: structured array with ROLLUP_DTYPE
+    :param max_bytes: size limit of the file, None for no limit
+    """
+    path = rollup_path(folder, id, tier)
+    with open(path, "ab") as file:
+        file.write(records.tobytes())
+        size = file.tell()
+    if max_bytes and size > max_bytes:
+        trim(path, max_bytes)
+
+
+def write_batch(batch) -> None:
+    """
+    Write function of the WriteBehindQueue of RollupWriter, one append per tier file
+    :param batch: list of (folder, id, tier, record, max_bytes)
+    """
+    files = {}
+    for folder, id, tier, record, max_bytes in batch:
+        files.setdefault((folder, id, tier, max_bytes), []).append(record)
+    for (folder, id, tier, max_bytes), records in files.items():
+        append(folder, id, tier, np.concatenate(records), max_bytes)
+
+
+def remove_rollups(folder, id) -> None:
+    for tier in TIERS:
+        path = rollup_path(folder, id, tier)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class RollupWriter:
+    """
+    Maintains min / max / mean / count per time bucket for all tiers of one sensor.
+    Only the open bucket of each tier is kept in memory, closed buckets are appended to
+    sensor_<id>.r<tier> next to the raw logs. A tier file growing beyond max_bytes loses its
+    oldest buckets.
+    """
+
+    def __init__(self, folder, id, tiers=TIERS, max_bytes=None, queue=None):
+        """
+        :param max_bytes: size limit per tier file, None for no limit
+        :param queue: WriteBehindQueue with write_batch which writes the closed buckets,
+            None to write them right away
+        """
+        self.folder = folder
+        self.id = id
+        self.tiers = tiers
+        self.max_bytes = max_bytes
+        self.queue = queue
+        self.buckets = {tier: None for tier in tiers}
+
+    def add(self, ts, value) -> None:
+        value = float(value)
+        if not math.isfinite(value):
+            return
+        ts = int(ts)
+        for tier in self.tiers:
+            start = ts // tier * tier
+            bucket = self.buckets[tier]
+            if bucket is None or bucket[0] != start:
+                if bucket is not None:
+                    self._write(tier, bucket)
+                self.buckets[tier] = [start, value, value, value, 1]
+            else:
+                bucket[1] = min(bucket[1], value)
+                bucket[2] = max(bucket[2], value)
+                bucket[3] += value
+                bucket[4] += 1
+
+    def _write(self, tier, bucket):
+        record = np.array(
+            [(bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4], bucket[4])],
+            dtype=ROLLUP_DTYPE,
+        )
+        if self.queue is not None:
+            self.queue.put((self.folder, self.id, tier, record, self.max_bytes))
+        else:
+            append(self.folder, self.id, tier, record, self.max_bytes)
+
+    def pending(self, tier):
+        """
+        :param tier: bucket size in seconds
+        :return: the open bucket as structured array with zero or one row
+        """
+        bucket = self.buckets.get(tier)
+        if bucket is None:
+            return np.empty(0, dtype=ROLLUP_DTYPE)
+        return np.array(
+            [(bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4], bucket[4])],
+            dtype=ROLLUP_DTYPE,
+        )
+
+    def close(self) -> None:
+        """
+        Persist the open buckets. A bucket continued after a restart is merged on read.
+        """
+        for tier, bucket in self.buckets.items():
+            if bucket is not None:
+                self._write(tier, bucket)
+        self.buckets = {tier: None for tier in self.tiers}
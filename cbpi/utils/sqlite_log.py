@@ -0,0 +1,183 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import numpy as np
+from cbpi.utils.rollup import ROLLUP_DTYPE
+
+__all__ = [
+    "DB_NAME",
+    "connect",
+    "db_path",
+    "first_timestamp",
+    "insert",
+    "read_buckets",
+    "read_window",
+    "reader",
+    "remove",
+]
+
+DB_NAME = "sensor_log.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sensor_log (
+    sensor_id TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sensor_log_id_ts ON sensor_log (sensor_id, ts);
+"""
+
+
+def db_path(folder):
+    return os.path.join(folder, DB_NAME)
+
+
+def connect(path, create=False):
+    """
+    Open the sensor log database in WAL mode, so readers never block the writer
+    :param path: database file
+    :param create: create the file and schema if missing
+    :return: sqlite3 connection or None if the database does not exist
+    """
+    if not create and not os.path.exists(path):
+        return None
+    connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    if create:
+        connection.executescript(SCHEMA)
+    return connection
+
+
+@contextmanager
+def reader(folder, connection=None):
+    """
+    :param folder: logs folder
+    :param connection: connection of the caller, kept open
+    :return: context with the given or a new connection, None if the database does not exist
+    """
+    if connection is not None:
+        yield connection
+        return
+    connection = connect(db_path(folder))
+    try:
+        yield connection
+    finally:
+        if connection is not None:
+            connection.close()
+
+
+def insert(connection, rows) -> None:
+    """
+    :param connection: connection returned by connect
+    :param rows: list of (sensor id, epoch seconds, value)
+    """
+    with connection:
+        connection.executemany(
+            "INSERT INTO sensor_log (sensor_id, ts, value) VALUES (?, ?, ?)", rows
+        )
+
+
+def _window(start, end):
+    return (
+        -(2**62) if start is None else int(np.ceil(start)),
+        2**62 if end is None else int(end),
+    )
+
+
+def first_timestamp(folder, id, connection=None):
+    """
+    :param folder: logs folder
+    :param id: sensor id
+    :param connection: open connection to reuse
+    :return: epoch seconds of the oldest sample of the sensor or None
+    """
+    with reader(folder, connection) as connection:
+        if connection is None:
+            return None
+        row = connection.execute(
+            "SELECT MIN(ts) FROM sensor_log WHERE sensor_id = ?", (id,)
+        ).fetchone()
+    return row[0]
+
+
+def read_window(folder, id, start=None, end=None, connection=None):
+    """
+    Raw samples of a sensor with start <= ts <= end
+    :param folder: logs folder
+    :param id: sensor id
+    :param start: epoch seconds or None
+    :param end: epoch seconds or None
+    :param connection: open connection to reuse
+    :return: tuple of (timestamps, values) as numpy arrays
+    """
+    with reader(folder, connection) as connection:
+        if connection is None:
+            return np.empty(0, dtype="<i8"), np.empty(0, dtype="<f8")
+        rows = connection.execute(
+            "SELECT ts, value FROM sensor_log WHERE sensor_id = ? AND ts BETWEEN ? AND ? ORDER BY ts",
+            (id, *_window(start, end)),
+        ).fetchall()
+    data = np.array(rows, dtype=[("ts", "<i8"), ("value", "<f8")])
+    return data["ts"], data["value"]
+
+
+BUCKET_QUERY = """
+SELECT sensor_id, bucket, min, max, mean, count FROM (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY sensor_id ORDER BY bucket DESC) AS newest
+    FROM (
+        SELECT sensor_id, ts - ts % :rate AS bucket, MIN(value) AS min, MAX(value) AS max,
+               AVG(value) AS mean, COUNT(*) AS count
+        FROM sensor_log
+        WHERE sensor_id IN ({ids}) AND ts BETWEEN :start AND :end
+        GROUP BY sensor_id, bucket
+    )
+)
+WHERE :limit IS NULL OR newest <= :limit
+ORDER BY sensor_id, bucket
+"""
+
+
+def read_buckets(folder, ids, rate, start=None, end=None, limit=None, connection=None):
+    """
+    Min / max / mean / count per time bucket, aggregated by sqlite
+    :param folder: logs folder
+    :param ids: list of sensor ids
+    :param rate: bucket size in seconds
+    :param start: epoch seconds or None
+    :param end: epoch seconds or None
+    :param limit: max number of newest buckets per sensor
+    :param connection: open connection to reuse
+    :return: dict of sensor id -> structured array with rollup.ROLLUP_DTYPE
+    """
+    result = {}
+    start, end = _window(start, end)
+    params = dict(rate=max(1, int(rate)), start=start, end=end, limit=limit)
+    names = []
+    for i, id in enumerate(ids):
+        params["id%d" % i] = id
+        names.append(":id%d" % i)
+    with reader(folder, connection) as connection:
+        if connection is None:
+            return result
+        rows = connection.execute(
+            BUCKET_QUERY.format(ids=", ".join(names)), params
+        ).fetchall()
+    buckets = {id: [] for id in ids}
+    for row in rows:
+        buckets[row[0]].append(row[1:])
+    for id, records in buckets.items():
+        result[id] = np.array(records, dtype=ROLLUP_DTYPE)
+    return result
+
+
+def remove(folder, id) -> None:
+    connection = connect(db_path(folder))
+    if connection is None:
+        return
+    try:
+        with connection:
+            connection.execute("DELETE FROM sensor_log WHERE sensor_id = ?", (id,))
+    finally:
+        connection.close()
@@ -0,0 +1,164 @@
+"""
+Topic filters with the MQTT + and # wildcards, shared by the event bus, the MQTT dispatch
+and the websocket subscriptions. Topics starting with $ are not matched by wildcards on the
+first level.
+"""
+
+__all__ = ["Node", "TopicTrie", "filter_matches", "iter_match", "valid_filter"]
+
+
+def valid_filter(topic_filter):
+    """
+    :param topic_filter: topic filter
+    :return: True if + only stands for whole levels and # only for the last level
+    """
+    if not isinstance(topic_filter, str) or topic_filter == "":
+        return False
+    parts = topic_filter.split("/")
+    return all(
+        ("#" not in p and "+" not in p) or p == "+" or (p == "#" and i == len(parts) - 1)
+        for i, p in enumerate(parts)
+    )
+
+
+def filter_matches(topic_filter, topic):
+    """
+    :param topic_filter: topic filter, may contain + and # wildcards
+    :param topic: concrete topic
+    :return: True if topic_filter matches topic
+    """
+    parts = topic_filter.split("/")
+    lst = topic.split("/")
+    normal = not topic.startswith("$")
+    for i, part in enumerate(parts):
+        if part == "#":
+            return normal or i > 0
+        if i >= len(lst):
+            return False
+        if part == "+":
+            if not (normal or i > 0):
+                return False
+        elif part != lst[i]:
+            return False
+    return len(parts) == len(lst)
+
+
+class Node(object):
+    __slots__ = "children", "values"
+
+    def __init__(self):
+        # topic level -> Node
+        self.children = {}
+        # values of the filter ending at this node, None if there is none
+        self.values = None
+
+
+def iter_match(root, topic):
+    """
+    Walk a trie of Node along the levels of topic
+    :param root: root Node
+    :param topic: concrete topic
+    :return: generator of the values lists of all matching filters
+    """
+    lst = topic.split("/")
+    normal = not topic.startswith("$")
+
+    def rec(node, i=0):
+        if i == len(lst):
+            if node.values is not None:
+                yield node.values
+        else:
+            part = lst[i]
+            if part in node.children:
+                yield from rec(node.children[part], i + 1)
+            if "+" in node.children and (normal or i > 0):
+                yield from rec(node.children["+"], i + 1)
+        if "#" in node.children and (normal or i > 0):
+            values = node.children["#"].values
+            if values is not None:
+                yield values
+
+    return rec(root)
+
+
+class TopicTrie:
+    """
+    MQTT topic filters with the + and # wildcards mapped to values. match() walks the trie
+    along the levels of a topic, so the work per topic does not grow with the number of
+    filters. Results are cached per topic until a filter is added or removed.
+    """
+
+    Node = Node
+
+    def __init__(self, cache_size=1024):
+        self._root = self.Node()
+        # topic filter -> list of values
+        self._filters = {}
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def add(self, topic_filter, value):
+        """
+        :return: True if topic_filter had no values before
+        """
+        node = self._root
+        for sym in topic_filter.split("/"):
+            node = node.children.setdefault(sym, self.Node())
+        if node.values is None:
+            node.values = []
+        node.values.append(value)
+        values = self._filters.setdefault(topic_filter, [])
+        values.append(value)
+        self._cache.clear()
+        return len(values) == 1
+
+    def remove(self, topic_filter, value):
+        """
+        :return: True if topic_filter has no values left
+        """
+        values = self._filters.get(topic_filter)
+        if values is None or value not in values:
+            return False
+        values.remove(value)
+        path = [self._root]
+        for sym in topic_filter.split("/"):
+            path.append(path[-1].children[sym])
+        path[-1].values.remove(value)
+        if len(path[-1].values) == 0:
+            path[-1].values = None
+        # drop empty nodes from the leaf upwards
+        syms = topic_filter.split("/")
+        for i in range(len(syms), 0, -1):
+            node = path[i]
+            if node.values is None and len(node.children) == 0:
+                del path[i - 1].children[syms[i - 1]]
+            else:
+                break
+        self._cache.clear()
+        if len(values) == 0:
+            del self._filters[topic_filter]
+            return True
+        return False
+
+    def filters(self):
+        """
+        :return: all topic filters with at least one value
+        """
+        return list(self._filters)
+
+    def __len__(self):
+        return len(self._filters)
+
+    def match(self, topic):
+        """
+        :param topic: concrete topic of a message
+        :return: tuple of the values of all matching filters
+        """
+        result = self._cache.get(topic)
+        if result is None:
+            result = tuple(v for values in iter_match(self._root, topic) for v in values)
+            if self.cache_size > 0:
+                if len(self._cache) >= self.cache_size:
+                    del self._cache[next(iter(self._cache))]
+                self._cache[topic] = result
+        return result
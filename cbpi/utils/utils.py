@@ -1,11 +1,35 @@
 from cbpi.utils.encoder import ComplexEncoder
 
-__all__ = ["load_config", "json_dumps"]
+__all__ = ["load_config", "json_dumps", "json_encode", "msgpack_encode", "msgpack_decode"]
 
 import json
+import logging
 
+import numpy
 import yaml
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# datetimes and dataclasses go through ComplexEncoder.default like with the json module
+_ORJSON_OPTIONS = (
+    orjson.OPT_NON_STR_KEYS
+    | orjson.OPT_PASSTHROUGH_DATETIME
+    | orjson.OPT_PASSTHROUGH_DATACLASS
+    | orjson.OPT_SERIALIZE_NUMPY
+    if orjson is not None
+    else 0
+)
+_encoder = ComplexEncoder()
+logger = logging.getLogger(__name__)
+
 
 def load_config(fname):
 
@@ -18,5 +42,41 @@ def load_config(fname):
         pass
 
 
+def json_encode(obj):
+    """
+    Encode obj with orjson if it is installed, ComplexEncoder otherwise. Used for websocket and MQTT
+    messages only, HTTP responses keep json_dumps. With orjson NaN and Infinity become null and the
+    output has no whitespace.
+    :param obj: object to encode
+    :return: utf-8 encoded JSON as bytes
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_encoder.default, option=_ORJSON_OPTIONS)
+        except (orjson.JSONEncodeError, TypeError) as e:
+            # e.g. integers above 64 bit
+            logger.debug("orjson failed, falling back to json: %s" % e)
+    return json.dumps(obj, cls=ComplexEncoder).encode("utf-8")
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    return _encoder.default(obj)
+
+
+def msgpack_encode(obj):
+    """
+    MessagePack counterpart of json_encode, requires the optional msgpack package
+    :param obj: object to encode
+    :return: bytes
+    """
+    return msgpack.packb(obj, default=_msgpack_default, use_bin_type=True)
+
+
+def msgpack_decode(data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
 def json_dumps(obj):
     return json.dumps(obj, cls=ComplexEncoder)
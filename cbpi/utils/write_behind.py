@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ["WriteBehindQueue"]
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    Collects items on the event loop and hands them in batches to a blocking write function
+    which runs on a dedicated writer thread. A batch is written once max_items are queued
+    or interval seconds after the last batch. Batches are written one after another in the
+    order they were queued. While the writer is stuck at most max_pending items are kept,
+    newer ones are dropped.
+
+    The log targets write through it because a write to the SD card can block for a long
+    time, on the event loop it would stall every other task. Batching also turns one write
+    per sample into one write per sensor or one transaction per batch. Readers call
+    LogController.flush_writes first, queued items are not on disk yet.
+    """
+
+    def __init__(
+        self, write, max_items=1000, interval=5.0, name="write-behind", max_pending=None
+    ):
+        """
+        :param write: function taking a list of items, called on the writer thread
+        :param max_items: number of queued items which trigger a write
+        :param interval: max seconds an item waits in the queue
+        :param name: name of the writer thread
+        :param max_pending: max number of queued items, default 50 batches
+        """
+        self.write = write
+        self.max_items = max_items
+        self.max_pending = max_pending if max_pending is not None else 50 * max_items
+        self.interval = interval
+        self.name = name
+        self.items = []
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.batches = 0
+        self.written = 0
+        self.errors = 0
+        self.dropped = 0
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+        self._closed = False
+
+    def start(self) -> None:
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def put(self, item) -> None:
+        if len(self.items) >= self.max_pending:
+            if self.dropped == 0:
+                logger.warning("{}: queue full, dropping items".format(self.name))
+            self.dropped += 1
+            return
+        self.items.append(item)
+        if len(self.items) >= self.max_items and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Write all queued items now. Returns once the writer thread finished all batches
+        handed to it, also those of the timer.
+        """
+        if self._closed:
+            return
+        loop = asyncio.get_running_loop()
+        if len(self.items) == 0:
+            # the writer thread runs one batch after another, an empty job waits for them
+            await loop.run_in_executor(self.executor, lambda: None)
+            return
+        batch, self.items = self.items, []
+        try:
+            await loop.run_in_executor(self.executor, self.write, batch)
+            self.batches += 1
+            self.written += len(batch)
+        except Exception as e:
+            self.errors += 1
+            logger.error("{}: failed to write {} items: {}".format(self.name, len(batch), e))
+
+    async def close(self) -> None:
+        """
+        Stop the timer, write the remaining items and wait for the writer thread
+        """
+        # the timer task is not cancelled, a batch it handed to the writer thread is not lost
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        self.executor.shutdown(wait=True)
+        self._closed = True
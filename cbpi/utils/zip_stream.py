@@ -0,0 +1,132 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import zipfile
+
+__all__ = ["CHUNK_SIZE", "folder_files", "stream_zip"]
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ZipAborted(Exception):
+    pass
+
+
+class _ChunkWriter:
+    """
+    Write only file object for zipfile. Compressed data is collected into chunks which are
+    handed to the event loop through a bounded queue, the zip thread waits while it is full.
+    """
+
+    def __init__(self, loop, queue, aborted, chunk_size):
+        self.loop = loop
+        self.queue = queue
+        self.aborted = aborted
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            chunk = bytes(self.buffer)
+            self.buffer.clear()
+            self.put(chunk)
+
+    def put(self, chunk):
+        future = asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop)
+        while True:
+            try:
+                future.result(timeout=1)
+                return
+            except concurrent.futures.TimeoutError:
+                if self.aborted.is_set():
+                    future.cancel()
+                    raise ZipAborted()
+
+
+def folder_files(folder, exclude=()):
+    """
+    :param folder: folder to archive
+    :param exclude: file names to leave out
+    :return: list of (path, name in the archive) of all files below folder
+    """
+    result = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for f in sorted(files):
+            if f in exclude:
+                continue
+            path = os.path.join(root, f)
+            result.append((path, os.path.relpath(path, folder)))
+    return result
+
+
+def _write_zip(files, writer):
+    try:
+        with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for path, name in files:
+                try:
+                    archive.write(path, name)
+                except FileNotFoundError:
+                    # e.g. a log rotated away after it was listed
+                    logger.warning("File {} vanished while zipping".format(path))
+                except ZipAborted:
+                    raise
+                except Exception as e:
+                    logger.error("Error zipping file {}: {}".format(path, e))
+                    raise
+        writer.flush()
+    finally:
+        # end of stream marker, also after an error
+        if not writer.aborted.is_set():
+            writer.put(None)
+
+
+async def stream_zip(request, response, files, chunk_size=CHUNK_SIZE, max_chunks=4):
+    """
+    Compress files in a worker thread and send the archive while it is produced.
+    At most max_chunks chunks of chunk_size bytes are held in memory. The status is sent
+    before the first file is read, if the worker fails the connection is closed without
+    the end of the archive so the client sees a failed download.
+    :param request: web request
+    :param response: web.StreamResponse, not prepared yet
+    :param files: list of (path, name in the archive)
+    :return: the response
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max_chunks)
+    aborted = threading.Event()
+    writer = _ChunkWriter(loop, queue, aborted, chunk_size)
+    await response.prepare(request)
+    job = loop.run_in_executor(None, _write_zip, files, writer)
+    failed = False
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            await response.write(chunk)
+    finally:
+        aborted.set()
+        try:
+            await job
+        except ZipAborted:
+            logger.info("Zip download aborted by client")
+        except Exception as e:
+            failed = True
+            logger.error("Zip download failed: {}".format(e))
+    if failed:
+        if request.transport is not None:
+            request.transport.close()
+        return response
+    await response.write_eof()
+    return response
@@ -1,18 +1,313 @@
+import asyncio
 import logging
-import weakref
-from collections import defaultdict
+import time
+from collections import OrderedDict, defaultdict
 
 import aiohttp
 from aiohttp import web
-from cbpi.utils import json_dumps
+from cbpi.utils import json_encode, msgpack_decode, msgpack_encode, topic_trie
+from cbpi.utils.utils import msgpack
 from voluptuous import Schema
 
+# encoding -> (encoder, frame type)
+ENCODINGS = {"json": (json_encode, aiohttp.WSMsgType.TEXT)}
+if msgpack is not None:
+    ENCODINGS["msgpack"] = (msgpack_encode, aiohttp.WSMsgType.BINARY)
+
+# websocket subprotocol -> encoding, JSON is used if a client asks for none of them
+PROTOCOLS = tuple("cbpi.%s" % encoding for encoding in ENCODINGS)
+
+
+def get_compress(cbpi):
+    """
+    Compression is opt-in, every connection deflates each broadcast frame on its own.
+    :return: True if permessage-deflate is used when the client offers it, static config ws_compress
+    """
+    return str(cbpi.static_config.get("ws_compress", False)).lower() == "true"
+
+
+def get_encoding(request, ws):
+    """
+    Encoding of a prepared websocket, negotiated by subprotocol or the encoding query parameter
+    :return: key of ENCODINGS
+    """
+    if ws.ws_protocol is not None and ws.ws_protocol.startswith("cbpi."):
+        return ws.ws_protocol[len("cbpi.") :]
+    encoding = request.query.get("encoding", "json")
+    return encoding if encoding in ENCODINGS else "json"
+
+
+def decode(msg):
+    """
+    :param msg: received websocket message
+    :return: decoded text or binary message, None for other message types
+    """
+    if msg.type == aiohttp.WSMsgType.TEXT:
+        return msg.json()
+    if msg.type == aiohttp.WSMsgType.BINARY and msgpack is not None:
+        return msgpack_decode(msg.data)
+    return None
+
+
+class WebSocketClient:
+    """
+    Outbound queue of one websocket connection, drained by a single writer task.
+    When the queue is full a message replaces the queued one with the same topic (and id).
+    A message without such a slot is dropped and the client is resynced once its queue has
+    room again: it gets a resync message and the snapshots from on_resync. A client which
+    stays full for longer than max_lag seconds is disconnected.
+
+    Clients receive all messages until they subscribe. Subscriptions are topic patterns with
+    the + and # wildcards of the event bus. A message with an id is also matched as topic/id,
+    e.g. sensorstate/<sensor id> selects the state of a single sensor.
+
+    Clients in delta mode receive <update key>/patch messages with the changed fields of a
+    single item instead of the full list, see CBPiWebSocket.send_changes.
+    Clients with batching get sensorstate_batch messages instead of single sensorstate ones.
+    """
+
+    # cached subscription matches per client, reset when full
+    MATCH_CACHE_SIZE = 1024
+
+    def __init__(
+        self,
+        ws,
+        host=None,
+        port=None,
+        max_size=100,
+        max_lag=10.0,
+        encoding="json",
+        on_resync=None,
+    ):
+        self.ws = ws
+        self.encoding = encoding
+        self._encode, self.opcode = ENCODINGS[encoding]
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.max_lag = max_lag
+        # called with the client to queue the current state after messages were dropped
+        self.on_resync = on_resync
+        self.logger = logging.getLogger(__name__)
+        self._queue = OrderedDict()
+        # coalescing key -> queue key of the latest queued message with that key
+        self._slots = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.full_since = None
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.resync = False
+        self.resyncs = 0
+        self.filtered = 0
+        self.evicted = False
+        self.delta = False
+        self.batch = False
+        self.subscriptions = None
+        self._matches = {}
+
+    @staticmethod
+    def coalesce_key(data):
+        id = data.get("id")
+        if id is None and isinstance(data.get("data"), dict):
+            id = data["data"].get("id")
+        topic = data.get("topic")
+        if "revision" in data and isinstance(topic, str) and topic.endswith("/patch"):
+            # patches are never replaced, a client detects the gap of a dropped one
+            return (topic, id, data["revision"])
+        return (topic, id)
+
+    def subscribe(self, topics):
+        """
+        :param topics: list of topic patterns, invalid patterns are ignored
+        :return: all subscriptions
+        """
+        if self.subscriptions is None:
+            self.subscriptions = set()
+        for pattern in topics:
+            if topic_trie.valid_filter(pattern):
+                self.subscriptions.add(pattern)
+            else:
+                self.logger.warning("Invalid websocket subscription %s" % pattern)
+        self._matches.clear()
+        return sorted(self.subscriptions)
+
+    def unsubscribe(self, topics):
+        """
+        :param topics: list of topic patterns
+        :return: remaining subscriptions
+        """
+        if self.subscriptions is None:
+            self.subscriptions = set()
+        self.subscriptions.difference_update(topics)
+        self._matches.clear()
+        return sorted(self.subscriptions)
+
+    def wants(self, key):
+        """
+        :param key: coalescing key (topic, id) of a message
+        :return: True if the message matches a subscription
+        """
+        if self.subscriptions is None:
+            return True
+        # patch keys carry a revision, matches are cached per topic and id only
+        topic, id = key[0], key[1]
+        result = self._matches.get((topic, id))
+        if result is None:
+            topics = (topic,) if id is None else (topic, "%s/%s" % (topic, id))
+            result = any(
+                topic_trie.filter_matches(pattern, t)
+                for pattern in self.subscriptions
+                for t in topics
+            )
+            if len(self._matches) >= self.MATCH_CACHE_SIZE:
+                self._matches.clear()
+            self._matches[(topic, id)] = result
+        if result is False:
+            self.filtered += 1
+        return result
+
+    def encode(self, data):
+        return self._encode(data)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, data, frame=None, key=None):
+        """
+        :param data: message
+        :param frame: data already encoded to JSON, shared by all clients of a broadcast
+        :param key: coalescing key of data
+        """
+        if self.evicted:
+            return
+        if key is None:
+            key = self.coalesce_key(data)
+        if frame is None:
+            frame = self.encode(data)
+        if len(self._queue) >= self.max_size:
+            if self.full_since is None:
+                self.full_since = time.monotonic()
+            elif time.monotonic() - self.full_since > self.max_lag:
+                self.evict()
+                return
+            slot = self._slots.get(key)
+            if slot is None:
+                # the client missed a state, it is sent the current one once it has room
+                self.dropped += 1
+                self.resync = True
+                return
+            # newest state goes to the end so it is not sent before older messages of other topics
+            del self._queue[slot]
+            self.coalesced += 1
+        else:
+            # the client caught up at least partly, lag counts from the next time it is full
+            self.full_since = None
+        self._seq += 1
+        self._queue[self._seq] = (key, frame)
+        self._slots[key] = self._seq
+        self._wakeup.set()
+
+    async def _run(self):
+        try:
+            while not self.evicted:
+                if len(self._queue) == 0:
+                    self.full_since = None
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                seq, (key, frame) = self._queue.popitem(last=False)
+                if self._slots.get(key) == seq:
+                    del self._slots[key]
+                try:
+                    await self.ws.send_frame(frame, self.opcode)
+                    self.sent += 1
+                except ConnectionResetError:
+                    break
+                except Exception as e:
+                    self.logger.error("Error with client %s: %s" % (self.ws, str(e)))
+                if self.resync and len(self._queue) < self.max_size:
+                    self._resync()
+        except asyncio.CancelledError:
+            pass
+
+    def _resync(self):
+        self.resync = False
+        self.resyncs += 1
+        self.put(dict(topic="resync", data=dict(dropped=self.dropped)))
+        if self.on_resync is not None:
+            try:
+                self.on_resync(self)
+            except Exception as e:
+                self.logger.error("Error resyncing client %s: %s" % (self.ws, str(e)))
+
+    def evict(self):
+        self.evicted = True
+        self.logger.warning(
+            "Disconnecting slow websocket client - Host: %s Port: %s - %s messages queued"
+            % (self.host, self.port, len(self._queue))
+        )
+        self._queue.clear()
+        self._slots.clear()
+        if self._task is not None:
+            self._task.cancel()
+        asyncio.create_task(self._close())
+
+    async def _close(self):
+        try:
+            await asyncio.wait_for(
+                self.ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER), timeout=5
+            )
+        except Exception:
+            pass
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def to_dict(self):
+        return dict(
+            host=self.host,
+            port=self.port,
+            encoding=self.encoding,
+            compress=getattr(self.ws, "compress", False),
+            queued=len(self._queue),
+            max_size=self.max_size,
+            lag=time.monotonic() - self.full_since if self.full_since is not None else 0,
+            sent=self.sent,
+            coalesced=self.coalesced,
+            dropped=self.dropped,
+            resyncs=self.resyncs,
+            filtered=self.filtered,
+            delta=self.delta,
+            batch=self.batch,
+            subscriptions=sorted(self.subscriptions)
+            if self.subscriptions is not None
+            else None,
+        )
+
 
 class CBPiWebSocket:
     def __init__(self, cbpi) -> None:
         self.cbpi = cbpi
         self._callbacks = defaultdict(set)
-        self._clients = weakref.WeakSet()
+        self._clients = {}
+        # update key -> controller with revision and get_snapshot(), see BasicController
+        self._versioned = {}
+        self.queue_size = int(self.cbpi.static_config.get("ws_queue_size", 100))
+        self.max_lag = float(self.cbpi.static_config.get("ws_max_lag", 10))
+        self.compress = get_compress(self.cbpi)
+        # seconds sensor states are collected for clients with batching
+        self.batch_window = float(self.cbpi.static_config.get("ws_batch_window", 0.25))
+        # sensor id -> latest sensorstate in the current window
+        self._batch = {}
+        self._batch_handle = None
         self.logger = logging.getLogger(__name__)
         self.cbpi.app.add_routes([web.get("/ws", self.websocket_handler)])
         self.cbpi.bus.register_object(self)
@@ -25,28 +320,117 @@ class CBPiWebSocket:
         self.logger.debug("PUSH %s " % data)
         self.send(data)
 
-    def send(self, data, sorting=False):
+    def send(self, data, sorting=False, delta=None):
+        """
+        :param data: message
+        :param sorting: sort the list in data["data"] by name
+        :param delta: None for all clients, True or False for the clients with or without delta mode
+        """
         self.logger.debug("broadcast to ws clients. Data: %s" % data)
-        for ws in self._clients:
+        if sorting:
+            try:
+                data["data"].sort(key=lambda x: x.get("name").upper())
+            except:
+                pass
+        key = WebSocketClient.coalesce_key(data)
+        batched = data.get("topic") == "sensorstate"
+        if batched and any(c.batch for c in self._clients.values()):
+            self._batch[key[1]] = data
+            if self._batch_handle is None:
+                self._batch_handle = asyncio.get_running_loop().call_later(
+                    self.batch_window, self._send_batch
+                )
+        clients = [
+            c
+            for c in self._clients.values()
+            if (delta is None or c.delta is delta)
+            and not (batched and c.batch)
+            and c.wants(key)
+        ]
+        self._broadcast(clients, data, key)
 
-            async def send_data(ws, data):
-                try:
-                    if sorting:
-                        try:
-                            data["data"].sort(key=lambda x: x.get("name").upper())
-                        except:
-                            pass
-                    await ws.send_json(data=data, dumps=json_dumps)
-                except Exception as e:
-                    self.logger.error("Error with client %s: %s" % (ws, str(e)))
+    @staticmethod
+    def _broadcast(clients, data, key):
+        # encoded once per encoding, the same frame is queued for every client
+        frames = {}
+        for client in clients:
+            frame = frames.get(client.encoding)
+            if frame is None:
+                frame = frames[client.encoding] = client.encode(data)
+            client.put(data, frame, key)
+
+    def _send_batch(self):
+        self._batch_handle = None
+        pending, self._batch = self._batch, {}
+        # clients with the same sensor subscriptions share one encoded frame
+        groups = {}
+        for client in self._clients.values():
+            if client.batch:
+                ids = tuple(id for id in pending if client.wants(("sensorstate", id)))
+                if len(ids) > 0:
+                    groups.setdefault(ids, []).append(client)
+        for ids, clients in groups.items():
+            data = dict(
+                topic="sensorstate_batch",
+                data=[
+                    {k: v for k, v in pending[id].items() if k != "topic"} for id in ids
+                ],
+            )
+            self._broadcast(clients, data, WebSocketClient.coalesce_key(data))
+
+    def add_versioned(self, controller):
+        """
+        Register a controller whose updates are sent as patches to clients in delta mode
+        :param controller: object with update_key, revision, sorting and get_snapshot()
+        """
+        self._versioned[controller.update_key] = controller
 
-            self.cbpi.app.loop.create_task(send_data(ws, data))
+    def send_changes(self, controller, changes):
+        """
+        Clients in delta mode get one patch message per changed item, all other clients the full list
+        :param controller: controller registered with add_versioned
+        :param changes: list of (id, changed fields or None if the item was removed, revision)
+        """
+        if len(changes) == 0:
+            return
+        if any(c.delta is False for c in self._clients.values()):
+            self.send(controller.get_snapshot(), controller.sorting, delta=False)
+        for id, fields, revision in changes:
+            self.send(
+                dict(
+                    topic="%s/patch" % controller.update_key,
+                    id=id,
+                    revision=revision,
+                    data=fields,
+                ),
+                delta=True,
+            )
+
+    def send_snapshots(self, client, topics=None):
+        for key, controller in self._versioned.items():
+            if topics is None or key in topics:
+                data = controller.get_snapshot()
+                if controller.sorting:
+                    try:
+                        data["data"].sort(key=lambda x: x.get("name").upper())
+                    except:
+                        pass
+                key = WebSocketClient.coalesce_key(data)
+                if client.wants(key):
+                    client.put(data, key=key)
+
+    def get_clients(self):
+        """
+        Outbound queue state of all connected clients
+        :return: list of dict
+        """
+        return [client.to_dict() for client in self._clients.values()]
 
     async def websocket_handler(self, request):
 
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(protocols=PROTOCOLS, compress=self.compress)
         await ws.prepare(request)
-        self._clients.add(ws)
+        host, port = None, None
         try:
             peername = request.transport.get_extra_info("peername")
             if peername is not None:
@@ -54,20 +438,35 @@ class CBPiWebSocket:
                 host = peername[0]
                 port = peername[1]
             else:
-                host, port = "Unknowen"
-            self.logger.info(
-                "Client Connected - Host: %s Port: %s  - client count: %s "
-                % (host, port, len(self._clients))
-            )
+                host, port = "Unknowen", None
         except Exception as e:
             pass
+        client = WebSocketClient(
+            ws,
+            host,
+            port,
+            max_size=self.queue_size,
+            max_lag=self.max_lag,
+            encoding=get_encoding(request, ws),
+            on_resync=self.send_snapshots,
+        )
+        self._clients[ws] = client
+        self.logger.info(
+            "Client Connected - Host: %s Port: %s  - client count: %s "
+            % (host, port, len(self._clients))
+        )
 
         try:
-            await ws.send_json(data=dict(topic="connection/success"))
+            await ws.send_frame(
+                client.encode(dict(topic="connection/success")), client.opcode
+            )
+            client.start()
             async for msg in ws:
-                if msg.type == aiohttp.WSMsgType.TEXT:
+                if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
 
-                    msg_obj = msg.json()
+                    msg_obj = decode(msg)
+                    if msg_obj is None:
+                        continue
                     schema = Schema({"topic": str, "data": dict})
                     schema(msg_obj)
 
@@ -75,6 +474,39 @@ class CBPiWebSocket:
                     data = msg_obj.get("data")
                     if topic == "close":
                         await ws.close()
+                    elif topic in ("subscribe", "unsubscribe"):
+                        topics = (data or {}).get("topics", [])
+                        if isinstance(topics, str):
+                            topics = [topics]
+                        if topic == "subscribe":
+                            subscriptions = client.subscribe(topics)
+                        else:
+                            subscriptions = client.unsubscribe(topics)
+                        client.put(
+                            dict(
+                                topic="subscriptions",
+                                data=dict(topics=subscriptions),
+                            )
+                        )
+                    elif topic == "delta":
+                        client.delta = (data or {}).get("enabled", True) is True
+                        if client.delta:
+                            self.send_snapshots(client)
+                    elif topic == "batch":
+                        client.batch = (data or {}).get("enabled", True) is True
+                        client.put(
+                            dict(
+                                topic="batch",
+                                data=dict(
+                                    enabled=client.batch, window=self.batch_window
+                                ),
+                            )
+                        )
+                    elif topic == "resync":
+                        topics = (data or {}).get("topics")
+                        if isinstance(topics, str):
+                            topics = [topics]
+                        self.send_snapshots(client, topics)
                     else:
                         if data is not None:
                             await self.cbpi.bus.fire(topic=topic, **data)
@@ -89,7 +521,8 @@ class CBPiWebSocket:
             self.logger.error("%s - Received Data %s" % (str(e), msg.data))
 
         finally:
-            self._clients.discard(ws)
+            self._clients.pop(ws, None)
+            await client.stop()
 
         self.logger.info("Web Socket Close")
 
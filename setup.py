@@ -84,6 +84,10 @@ setup(name='cbpi4',
           'numpy==2.3.5',
           'pandas==2.3.3'] + board_reqs + (
           ['systemd-python'] if localsystem == "Linux" else [] ),
+      extras_require={
+          # binary websocket encoding, negotiated with the cbpi.msgpack subprotocol
+          'msgpack': ['msgpack>=1.0'],
+      },
 
         dependency_links=[
         'https://testpypi.python.org/pypi',
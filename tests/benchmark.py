@@ -0,0 +1,186 @@
+"""
+Timings of the hot paths, not collected by pytest because wall clock ratios depend on the
+load of the machine. Run all benchmarks or the named ones with
+
+    python -m tests.benchmark [name ...]
+"""
+import asyncio
+import logging
+import sys
+import time
+import types
+import zlib
+
+from cbpi.api.dataclasses import Actor, Props
+from cbpi.controller.job_controller import JobController
+from cbpi.eventbus import CBPiEventBus
+from cbpi.websocket import ENCODINGS
+from tests.timing import per_call
+
+
+def eventbus_dispatch():
+    """
+    Handler lookup of CBPiEventBus.fire with the dispatch cache and with a trie walk per event
+    """
+    bus = CBPiEventBus(None, None)
+    for i in range(50):
+        for topic in ("sensor/%s/data" % i, "actor/%s/update" % i, "kettle/%s/update" % i):
+            async def h(**kwargs):
+                pass
+            bus.register(topic, h)
+    for topic in ("#", "sensor/+/data", "actor/#", "kettle/+/update"):
+        async def h(**kwargs):
+            pass
+        bus.register(topic, h)
+
+    topics = ["sensor/%s/data" % (i % 50) for i in range(20000)]
+    trie_walk = per_call(
+        lambda topic: tuple(c for content in bus.iter_match(topic) for c in content), topics
+    )
+    cached = per_call(bus.match, topics)
+    print("trie walk %.2f us, cached %.2f us per event" % (trie_walk * 1e6, cached * 1e6))
+
+
+def ws_encoding():
+    """
+    Bytes and CPU time per websocket frame of each encoding, with and without permessage-deflate
+    """
+    props = dict(
+        Sensor="s1", Kettle="k1", Temp=66, Timer=60, Notification="", AutoMode="Yes"
+    )
+    payloads = dict(
+        actorupdate=dict(
+            topic="actorupdate",
+            data=[
+                Actor(
+                    id="actor%02d" % i,
+                    name="Actor %d" % i,
+                    props=Props(dict(GPIO=i)),
+                    type="GPIOPWMActor",
+                ).to_dict()
+                for i in range(30)
+            ],
+        ),
+        mash_profile_update=dict(
+            topic="mash_profile_update",
+            data=dict(
+                basic=dict(name="Pale Ale", author="cbpi", batch=12),
+                steps=[
+                    dict(
+                        id="step%02d" % i,
+                        name="Rast %d" % i,
+                        type="MashStep",
+                        status="I",
+                        state_text="",
+                        props=props,
+                    )
+                    for i in range(8)
+                ],
+            ),
+        ),
+        fermenterstepupdate=dict(
+            topic="fermenterstepupdate",
+            data=[
+                dict(
+                    id="step%02d" % i,
+                    name="Step %d" % i,
+                    type="FermenterStep",
+                    status="I",
+                    endtime=0,
+                    state_text="",
+                    props=dict(Temp=18, TimerD=7, TimerH=0, TimerM=0),
+                )
+                for i in range(10)
+            ],
+        ),
+    )
+
+    def deflate(frame):
+        # permessage-deflate without context takeover, aiohttp does this per client
+        compressor = zlib.compressobj(wbits=-15)
+        return compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    print()
+    for name, data in payloads.items():
+        for encoding, (encode, opcode) in ENCODINGS.items():
+            for compress in (False, True):
+                frame_of = (lambda d: deflate(encode(d))) if compress else encode
+                print(
+                    "  %s %s%s: %d bytes, %.2f us per frame"
+                    % (
+                        name,
+                        encoding,
+                        " deflate" if compress else "",
+                        len(frame_of(data)),
+                        per_call(frame_of, [data] * 500) * 1e6,
+                    )
+                )
+
+
+def _busy(n):
+    # module level, the query pool pickles the function
+    return sum(i * i for i in range(n))
+
+
+def query_pool():
+    """
+    Longest event loop stall while a cpu bound query runs inline and in the query pool
+    """
+
+    async def stall(query):
+        gaps = []
+
+        async def ticker():
+            last = time.monotonic()
+            while True:
+                await asyncio.sleep(0.001)
+                now = time.monotonic()
+                gaps.append(now - last)
+                last = now
+
+        task = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0.01)
+        start = time.monotonic()
+        await query()
+        duration = time.monotonic() - start
+        await asyncio.sleep(0.01)  # let the ticker see the last gap
+        task.cancel()
+        return duration, max(gaps)
+
+    async def run():
+        job = JobController(types.SimpleNamespace(static_config={}))
+        job.query_slots = asyncio.Semaphore(job.query_workers)
+        n = 2000000
+        await job.run_query(_busy, 10)  # start the worker process
+
+        async def inline():
+            _busy(n)
+
+        async def pooled():
+            await job.run_query(_busy, n)
+
+        results = [await stall(inline), await stall(pooled)]
+        await job.shutdown_query_executor(None)
+        return results
+
+    (inline, inline_stall), (pooled, pooled_stall) = asyncio.run(run())
+    print(
+        "inline %.0f ms, loop stalled %.0f ms; pool %.0f ms, loop stalled %.0f ms"
+        % (inline * 1e3, inline_stall * 1e3, pooled * 1e3, pooled_stall * 1e3)
+    )
+
+
+BENCHMARKS = dict(
+    eventbus_dispatch=eventbus_dispatch, ws_encoding=ws_encoding, query_pool=query_pool
+)
+
+
+def main(names):
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in names or BENCHMARKS:
+        print("%s: " % name, end="")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,7 +1,9 @@
 import logging
 from unittest import mock
 from aiohttp.test_utils import unittest_run_loop
+from cbpi.api.dataclasses import Actor
 from tests.cbpi_config_fixture import CraftBeerPiTestCase
+from tests.timing import per_call
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 
@@ -81,3 +83,55 @@ class ActorTestCase(CraftBeerPiTestCase):
     async def test_actor_action(self):
         resp = await self.client.post(path="/actor/1/action", json=dict(name="myAction", parameter=dict(name="Manuel")))
         assert resp.status == 200
+
+    async def test_id_index(self):
+        actors = self.cbpi.actor
+        saved = actors.data
+        try:
+            template = saved[0]
+            actors.data = saved + [Actor(id=str(i), name=str(i), type=template.type) for i in range(3)]
+            item = actors.find_by_id("1")
+            assert item is not None
+            assert actors.get_index_by_id("1") == actors.data.index(item)
+            assert actors.find_by_id(template.id) is template
+            assert actors.find_by_id("unknown") is None
+
+            # moved in place without add/update/delete
+            actors.data.reverse()
+            assert actors.find_by_id("1") is item
+            assert actors.data[actors.get_index_by_id("1")] is item
+
+            # replaced in place by an item with a new id
+            i = actors.get_index_by_id("2")
+            actors.data[i] = Actor(id="new", name="new", type=template.type)
+            assert actors.get_index_by_id("new") == i
+            assert actors.find_by_id("2") is None
+
+            # appended to the same list, also with the length unchanged
+            actors.data.append(Actor(id="appended", name="appended", type=template.type))
+            assert actors.find_by_id("appended") is actors.data[-1]
+            actors.data.pop(0)
+            actors.data.append(Actor(id="last", name="last", type=template.type))
+            assert actors.find_by_id("last") is actors.data[-1]
+        finally:
+            actors.data = saved
+
+    async def test_id_index_benchmark(self):
+        actors = self.cbpi.actor
+        saved = actors.data
+        template = saved[0]
+
+        def linear(id):
+            return next((item for item in actors.data if item.id == id), None)
+
+        result = {}
+        try:
+            for size in (10, 100, 1000):
+                actors.data = [Actor(id=str(i), name=str(i), type=template.type) for i in range(size)]
+                ids = [str(i % size) for i in range(20000)]
+                result[size] = (per_call(actors.find_by_id, ids), per_call(linear, ids[:2000]))
+        finally:
+            actors.data = saved
+        # flat for the index, growing with the number of items for the scan
+        assert result[1000][0] < result[10][0] * 5
+        assert result[1000][0] < result[1000][1]
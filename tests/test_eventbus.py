@@ -0,0 +1,136 @@
+import asyncio
+
+from cbpi.eventbus import CBPiEventBus
+from tests.cbpi_config_fixture import CraftBeerPiTestCase
+
+
+class EventBusTestCase(CraftBeerPiTestCase):
+
+    async def test_dispatch_cache(self):
+        bus = CBPiEventBus(None, None, cache_size=4)
+        received = []
+
+        async def sensor(topic, **kwargs):
+            received.append(("sensor", topic))
+
+        async def everything(topic, **kwargs):
+            received.append(("everything", topic))
+
+        async def once(topic, **kwargs):
+            received.append(("once", topic))
+
+        bus.register("sensor/+/data", sensor)
+        await bus.fire("sensor/1/data")
+        await asyncio.sleep(0)
+        assert received == [("sensor", "sensor/1/data")]
+        assert [c.method for c in bus.match("sensor/1/data")] == [sensor]
+
+        # a new wildcard listener invalidates the cached topic
+        bus.register("#", everything)
+        assert "sensor/1/data" not in bus._dispatch_cache
+        assert [c.method for c in bus.match("sensor/1/data")] == [sensor, everything]
+
+        # handlers which are called once are removed from the cache
+        bus.register("sensor/1/data", once, once=True)
+        received.clear()
+        await bus.fire("sensor/1/data")
+        await bus.fire("sensor/1/data")
+        await asyncio.sleep(0)
+        assert received.count(("once", "sensor/1/data")) == 1
+
+        bus.unregister(sensor)
+        assert [c.method for c in bus.match("sensor/1/data")] == [everything]
+
+        # topics with $ are not matched by first level wildcards
+        assert bus.match("$SYS/test") == ()
+
+        # the cache is bounded
+        for i in range(10):
+            bus.match("actor/%s/update" % i)
+        assert len(bus._dispatch_cache) <= 4
+
+    async def test_dispatch_cache_hits(self):
+        bus = CBPiEventBus(None, None, cache_size=100)
+
+        for i in range(50):
+            for topic in ("sensor/%s/data" % i, "actor/%s/update" % i, "kettle/%s/update" % i):
+                async def h(**kwargs):
+                    pass
+                bus.register(topic, h)
+        for topic in ("#", "sensor/+/data", "actor/#", "kettle/+/update"):
+            async def h(**kwargs):
+                pass
+            bus.register(topic, h)
+
+        topics = ["sensor/%s/data" % (i % 50) for i in range(1000)]
+        for topic in topics:
+            assert bus.match(topic) == tuple(c for content in bus.iter_match(topic) for c in content)
+        # the trie is only walked once per topic
+        assert bus.get_stats()["dispatch_cache"] == dict(size=50, max_size=100, hits=950, misses=50)
+
+        # a registration drops the cached topics below it
+        async def late(**kwargs):
+            pass
+        bus.register("sensor/1/data", late)
+        assert len(bus.match("sensor/1/data")) == 4
+        assert bus.cache_misses == 51
+        bus.match("sensor/2/data")
+        assert bus.cache_hits == 951
+
+    async def test_stats(self):
+        bus = CBPiEventBus(None, None)
+
+        async def fast(topic, **kwargs):
+            pass
+
+        async def slow(topic, future, **kwargs):
+            await asyncio.sleep(0.2)
+            future.set_result(True)
+
+        bus.register("kettle/+/update", fast)
+        bus.register("kettle/1/update", slow)
+        result = await bus.fire("kettle/1/update", timeout=0.05)
+        assert result.timeout is True
+        await bus.fire("kettle/2/update", timeout=None)
+        await asyncio.sleep(0.3)
+
+        stats = bus.get_stats()
+        assert stats["topics"]["kettle/1/update"] == dict(fires=1, avg_fanout=2, max_fanout=2, timeouts=1)
+        assert stats["topics"]["kettle/2/update"]["fires"] == 1
+        fast_stats = stats["handlers"]["%s.fast" % __name__]
+        slow_stats = stats["handlers"]["%s.slow" % __name__]
+        assert fast_stats["calls"] == 2
+        assert sum(fast_stats["histogram"]) == 2
+        assert slow_stats["timeouts"] == 1
+        assert slow_stats["max"] >= 0.2
+        assert slow_stats["histogram"][-2] == 1
+
+        # per topic stats are bounded
+        bus = CBPiEventBus(None, None, stats_size=4)
+        for i in range(10):
+            await bus.fire("sensordata/%s" % i, timeout=None)
+        assert list(bus.get_stats()["topics"]) == ["sensordata/%s" % i for i in range(6, 10)]
+
+        resp = await self.client.get(path="/system/events/stats")
+        assert resp.status == 200
+        assert "handlers" in await resp.json()
+
+    async def test_coalesce(self):
+        bus = CBPiEventBus(None, None)
+        received = []
+
+        async def state(topic, value, **kwargs):
+            received.append((topic, value))
+            await asyncio.sleep(0.05)
+
+        bus.register("sensor/+/data", state, coalesce=True)
+        await bus.fire("sensor/1/data", timeout=None, value=0)
+        await asyncio.sleep(0.01)
+        # the handler is busy, only the latest event per topic is kept
+        for i in range(1, 100):
+            await bus.fire("sensor/1/data", timeout=None, value=i)
+            await bus.fire("sensor/2/data", timeout=None, value=i)
+        await asyncio.sleep(0.3)
+
+        assert received == [("sensor/1/data", 0), ("sensor/1/data", 99), ("sensor/2/data", 99)]
+        assert bus.get_stats()["handlers"]["%s.state" % __name__]["dropped"] == 196
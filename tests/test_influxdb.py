@@ -0,0 +1,171 @@
+import asyncio
+import os
+import shutil
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from cbpi.extension.SensorLogTarget_InfluxDB import (
+    InfluxDBShipper,
+    epoch_seconds,
+    format_line,
+)
+from tests.cbpi_config_fixture import CraftBeerPiTestCase
+
+
+class InfluxDBTestCase(CraftBeerPiTestCase):
+
+    async def test_shipper(self):
+        received = []
+        status = [503]
+
+        async def write(request):
+            if status[0] == 204:
+                received.extend((await request.text()).split("\n"))
+            return web.Response(status=status[0])
+
+        app = web.Application()
+        app.router.add_post("/write", write)
+        server = TestServer(app)
+        await server.start_server()
+
+        spool = os.path.join(".", "tests", "logs", "influxdb_spool")
+        shutil.rmtree(spool, ignore_errors=True)
+        shipper = InfluxDBShipper(
+            lambda: (str(server.make_url("/write")), {}),
+            spool,
+            batch_size=2,
+            max_age=0.05,
+            backoff=0.05,
+            max_backoff=0.1,
+        )
+        shipper.start()
+
+        # InfluxDB is down, the batch goes to the spool
+        shipper.put("sensor,itemID=a value=1 1")
+        shipper.put("sensor,itemID=a value=2 2")
+        await asyncio.sleep(0.3)
+        assert received == []
+        assert shipper.failures > 0
+        assert len(os.listdir(spool)) == 1
+
+        # InfluxDB is back, the spool is replayed before new lines
+        status[0] = 204
+        shipper.put("sensor,itemID=a value=3 3")
+        for i in range(40):
+            if len(received) == 3:
+                break
+            await asyncio.sleep(0.05)
+        assert received == [
+            "sensor,itemID=a value=1 1",
+            "sensor,itemID=a value=2 2",
+            "sensor,itemID=a value=3 3",
+        ]
+        assert shipper.failures == 0
+        assert os.listdir(spool) == []
+
+        # lines queued on shutdown are kept for the next start
+        shipper.put("sensor,itemID=a value=4 4")
+        await shipper.close()
+        assert len(InfluxDBShipper(None, spool).spool) == 1
+
+        await server.close()
+        shutil.rmtree(spool, ignore_errors=True)
+
+    async def test_rejected_lines(self):
+        received = []
+
+        async def write(request):
+            lines = (await request.text()).split("\n")
+            if any("bad" in line for line in lines):
+                return web.Response(status=400, text="unable to parse")
+            received.extend(lines)
+            return web.Response(status=204)
+
+        app = web.Application()
+        app.router.add_post("/write", write)
+        server = TestServer(app)
+        await server.start_server()
+
+        spool = os.path.join(".", "tests", "logs", "influxdb_spool")
+        shutil.rmtree(spool, ignore_errors=True)
+        shipper = InfluxDBShipper(lambda: (str(server.make_url("/write")), {}), spool)
+        shipper.start()
+        lines = ["sensor,itemID=a value=%d %d" % (i, i) for i in range(5)]
+        lines.insert(2, "sensor,itemID=a value=bad 2")
+        # a spooled batch with one bad line
+        shipper._spool(lines)
+        await shipper.ship()
+        # only the bad line is dropped
+        assert received == [line for line in lines if "bad" not in line]
+        assert shipper.dropped == 1
+        assert shipper.sent == 5
+        assert os.listdir(spool) == []
+        await shipper.close()
+        await server.close()
+        shutil.rmtree(spool, ignore_errors=True)
+
+    async def test_partly_sent(self):
+        received = []
+        down = [True]
+
+        async def write(request):
+            lines = (await request.text()).split("\n")
+            if any("bad" in line for line in lines):
+                return web.Response(status=400, text="unable to parse")
+            if down[0] and any("value=3" in line for line in lines):
+                return web.Response(status=503)
+            received.extend(lines)
+            return web.Response(status=204)
+
+        app = web.Application()
+        app.router.add_post("/write", write)
+        server = TestServer(app)
+        await server.start_server()
+
+        spool = os.path.join(".", "tests", "logs", "influxdb_spool")
+        shutil.rmtree(spool, ignore_errors=True)
+        shipper = InfluxDBShipper(
+            lambda: (str(server.make_url("/write")), {}), spool, backoff=0, max_backoff=0
+        )
+        shipper.start()
+        lines = ["sensor,itemID=a value=%d %d" % (i, i) for i in range(6)]
+        lines[2] = "sensor,itemID=a value=bad 2"
+
+        # the first half is sent after the bad line is found, the second half fails
+        shipper._spool(lines)
+        await shipper.ship()
+        assert received == lines[:2]
+        assert shipper.dropped == 1
+        assert len(shipper.spool) == 1
+        with open(shipper.spool[0]) as file:
+            assert file.read().split("\n") == lines[3:]
+
+        # queued lines, only the unsent half is spooled
+        down[0] = False
+        await shipper.ship()
+        assert received == lines[:2] + lines[3:]
+        down[0] = True
+        received.clear()
+        for line in lines:
+            shipper.put(line)
+        await shipper.ship()
+        assert received == lines[:2]
+        with open(shipper.spool[0]) as file:
+            assert file.read().split("\n") == lines[3:]
+
+        await shipper.close()
+        await server.close()
+        shutil.rmtree(spool, ignore_errors=True)
+
+    async def test_epoch_seconds(self):
+        now = int(time.time())
+        assert epoch_seconds(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))) == now
+
+    async def test_format_line(self):
+        assert format_line("measurement", "Mash Tun", "a,1", "21.5", 10) == (
+            "measurement,source=Mash\\ Tun,itemID=a\\,1 value=21.5 10"
+        )
+        assert format_line("measurement", "s", "a", 21, 10) == "measurement,source=s,itemID=a value=21.0 10"
+        for value in ("on", None, "nan", float("inf")):
+            assert format_line("measurement", "s", "a", value, 10) is None
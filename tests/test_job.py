@@ -0,0 +1,93 @@
+import asyncio
+import math
+import time
+
+import pytest
+from aiohttp import web
+from cbpi.api.exceptions import CBPiException
+from tests.cbpi_config_fixture import CraftBeerPiTestCase
+
+
+class ClosingTransport:
+
+    def __init__(self):
+        self.closing = False
+
+    def is_closing(self):
+        return self.closing
+
+
+class DisconnectingRequest:
+
+    def __init__(self):
+        self.transport = ClosingTransport()
+
+
+class JobTestCase(CraftBeerPiTestCase):
+
+    async def test_run_query(self):
+        job = self.cbpi.job
+        assert await job.run_query(math.sqrt, 16) == 4
+        assert job.query_pending == 0
+
+        with pytest.raises(CBPiException):
+            await job.run_query(time.sleep, 1, timeout=0.2)
+        # the worker is still busy with the query which timed out
+        assert job.query_pending == 1
+        assert job.query_slots.locked()
+        waiting = asyncio.ensure_future(job.run_query(math.sqrt, 16))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        assert job.query_pending == 2
+        assert await waiting == 4
+        assert job.query_pending == 0
+        assert not job.query_slots.locked()
+
+    async def test_query_queue_full(self):
+        job = self.cbpi.job
+        job.query_queue_size = 0
+        running = asyncio.ensure_future(job.run_query(time.sleep, 0.5))
+        await asyncio.sleep(0)
+        with pytest.raises(web.HTTPServiceUnavailable) as e:
+            await job.run_query(math.sqrt, 16)
+        assert e.value.headers["Retry-After"] == str(job.query_retry_after)
+        assert job.query_pending == 1
+
+        resp = await self.client.post(path="/log/rollup", json=["sensor"])
+        assert resp.status == 503
+        assert resp.headers["Retry-After"] == str(job.query_retry_after)
+
+        await running
+        assert job.query_pending == 0
+
+    async def test_query_cancelled(self):
+        job = self.cbpi.job
+        running = asyncio.ensure_future(job.run_query(time.sleep, 0.5))
+        await asyncio.sleep(0)
+
+        # cancelled while waiting for the slot, never handed to a worker
+        waiting = asyncio.ensure_future(job.run_query(math.sqrt, 16))
+        await asyncio.sleep(0)
+        assert job.query_pending == 2
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert job.query_pending == 1
+
+        # client disconnects while the query waits, its result is not awaited
+        request = DisconnectingRequest()
+        waiting = asyncio.ensure_future(job.run_query(time.sleep, 0.5, request=request))
+        await asyncio.sleep(0)
+        assert job.query_pending == 2
+        request.transport.closing = True
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+        await running
+        # slots are released by the done callbacks of the workers
+        for i in range(40):
+            if job.query_pending == 0:
+                break
+            await asyncio.sleep(0.05)
+        assert job.query_pending == 0
+        assert not job.query_slots.locked()
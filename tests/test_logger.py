@@ -1,9 +1,24 @@
 import asyncio
 import glob
+import io
+import zipfile
+from unittest.mock import patch
+
+import aiohttp
 
 from aiohttp.test_utils import unittest_run_loop
 from tests.cbpi_config_fixture import CraftBeerPiTestCase
 import os
+import threading
+import time
+
+import numpy
+
+from cbpi.extension.SensorLogTarget_CSV import CSVLogFile
+from cbpi.utils import log_query, rollup, sqlite_log
+from cbpi.utils.binlog import RECORD_DTYPE, SegmentWriter, list_segments
+from cbpi.utils.rollup import RollupWriter
+from cbpi.utils.write_behind import WriteBehindQueue
 
 class LoggerTestCase(CraftBeerPiTestCase):
 
@@ -12,7 +27,7 @@ class LoggerTestCase(CraftBeerPiTestCase):
         os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
         log_name = "unconfigured_test_sensor_ID"
         #clear all logs
-        self.cbpi.log.clear_log(log_name)
+        await self.cbpi.log.clear_log(log_name)
         assert len(glob.glob(os.path.join(self.cbpi.log.logsFolderPath, f"sensor_{log_name}.log*"))) == 0
 
         # write log entries
@@ -29,7 +44,452 @@ class LoggerTestCase(CraftBeerPiTestCase):
 
         self.cbpi.log.clear_zip(log_name)
 
-        self.cbpi.log.clear_log(log_name)
+        await self.cbpi.log.clear_log(log_name)
+
+    async def test_csv_batch_writer(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "unconfigured_test_sensor_ID"
+        await self.cbpi.log.clear_log(log_name)
+        path = os.path.join(self.cbpi.log.logsFolderPath, f"sensor_{log_name}.log")
+
+        for i in range(3):
+            self.cbpi.log.log_data(log_name, 20 + i)
+        await self.cbpi.log.flush_writes()
+        with open(path) as file:
+            assert [line.split(",")[1] for line in file.read().splitlines()] == ["20", "21", "22"]
+
+        resp = await self.client.get(path="/log/%s/zip/stream" % log_name)
+        assert resp.status == 200
+        archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+        assert archive.namelist() == [f"sensor_{log_name}.log"]
+        assert archive.read(f"sensor_{log_name}.log").decode().count("\n") == 3
+
+        # an unreadable file fails the download instead of sending a truncated archive
+        with patch.object(zipfile.ZipFile, "write", side_effect=PermissionError("denied")):
+            resp = await self.client.get(path="/log/%s/zip/stream" % log_name)
+            assert resp.status == 200
+            with self.assertRaises(aiohttp.ClientPayloadError):
+                await resp.read()
+
+        # queued lines do not recreate a cleared log
+        self.cbpi.log.log_data(log_name, 23)
+        await self.cbpi.log.clear_log(log_name)
+        await self.cbpi.log.flush_writes()
+        assert not os.path.exists(path)
+
+        # a value logged while the clear waits for sqlite is written to a file that exists
+        self.cbpi.log.log_data(log_name, 24)
+        await self.cbpi.log.flush_writes()
+        removing = asyncio.Event()
+        release = threading.Event()
+        loop = asyncio.get_running_loop()
+
+        def remove(folder, id):
+            loop.call_soon_threadsafe(removing.set)
+            release.wait(5)
+
+        with patch.object(sqlite_log, "remove", remove):
+            clear = asyncio.ensure_future(self.cbpi.log.clear_log(log_name))
+            await removing.wait()
+            self.cbpi.log.log_data(log_name, 25)
+            await self.cbpi.log.flush_writes()
+            release.set()
+            await clear
+        self.cbpi.log.log_data(log_name, 26)
+        await self.cbpi.log.flush_writes()
+        with open(path) as file:
+            assert [line.split(",")[1] for line in file.read().splitlines()] == ["25", "26"]
+
+        # rotation as done by a RotatingFileHandler
+        await self.cbpi.log.clear_log(log_name)
+        log_file = CSVLogFile(path, max_bytes=50, backup_count=2)
+        log_file.write(["2024-01-01 10:00:%02d,%d" % (i, i) for i in range(6)])
+        log_file.close()
+        assert sorted(os.path.basename(f) for f in glob.glob(path + "*")) == [
+            f"sensor_{log_name}.log",
+            f"sensor_{log_name}.log.1",
+            f"sensor_{log_name}.log.2",
+        ]
+        assert all(os.path.getsize(f) < 50 for f in glob.glob(path + "*"))
+
+        await self.cbpi.log.clear_log(log_name)
+
+    async def test_write_behind_limit(self):
+        written = []
+        blocked = asyncio.Event()
+
+        def write(batch):
+            asyncio.run_coroutine_threadsafe(blocked.wait(), loop).result()
+            written.extend(batch)
+
+        loop = asyncio.get_running_loop()
+        queue = WriteBehindQueue(write, max_items=2, interval=60, max_pending=4)
+        queue.put(0)
+        flush = asyncio.ensure_future(queue.flush())
+        await asyncio.sleep(0.01)
+        # the writer is stuck, the queue is bounded
+        for i in range(1, 10):
+            queue.put(i)
+        assert queue.items == [1, 2, 3, 4]
+        assert queue.dropped == 5
+        blocked.set()
+        await flush
+        await queue.close()
+        assert written == [0, 1, 2, 3, 4]
+
+    async def test_binary_log_data(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "binary_test_sensor_ID"
+        await self.cbpi.log.clear_log(log_name)
+
+        writer = SegmentWriter(self.cbpi.log.logsFolderPath, log_name, max_bytes=48, backup_count=1)
+        now = int(time.time()) // 60 * 60
+        for i in range(4):
+            writer.append(now + i, 20 + i)
+        # a batch is split over segments
+        writer.write(numpy.array([(now + i, 20 + i) for i in range(4, 10)], dtype=RECORD_DTYPE))
+        writer.close()
+
+        # 3 records per segment, only the newest 2 segments are kept
+        assert len(list_segments(self.cbpi.log.logsFolderPath, log_name)) == 2
+
+        data = await self.cbpi.log.get_data(log_name, sample_rate='1s')
+        assert data[log_name] == [26.0, 27.0, 28.0, 29.0]
+
+        data = await self.cbpi.log.get_data2([log_name])
+        assert data[log_name]["value"] == [29.0]
+
+        await self.cbpi.log.clear_log(log_name)
+        assert len(list_segments(self.cbpi.log.logsFolderPath, log_name)) == 0
+
+    async def test_log_window(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "window_test_sensor_ID"
+        await self.cbpi.log.clear_log(log_name)
+
+        writer = SegmentWriter(self.cbpi.log.logsFolderPath, log_name, max_bytes=64, backup_count=5)
+        now = int(time.time()) // 60 * 60 - 600
+        for i in range(4):
+            writer.append(now - 2 * 86400 + i * 60, 10)
+        for i in range(4):
+            writer.append(now + i * 60, 20 + i)
+        writer.close()
+
+        segments = list_segments(self.cbpi.log.logsFolderPath, log_name)
+        assert len(segments) == 2
+        assert os.path.exists(segments[0] + ".idx")
+
+        data = await self.cbpi.log.get_data2([log_name], start=-3600)
+        assert data[log_name]["value"] == [20.0, 21.0, 22.0, 23.0]
+
+        data = await self.cbpi.log.get_data2([log_name], start=now + 60, end=now + 120)
+        assert data[log_name]["value"] == [21.0, 22.0]
+
+        resp = await self.client.get(path="/log/%s" % log_name, params=dict(start=-3600, limit=2))
+        assert resp.status == 200
+        data = await resp.json()
+        assert data[log_name] == [22.0, 23.0]
+
+        for start in ("yesterday", "nan", "inf", "-inf"):
+            resp = await self.client.get(path="/log/%s" % log_name, params=dict(start=start))
+            assert resp.status == 400
+        resp = await self.client.get(path="/log/%s" % log_name, params=dict(end="NaN"))
+        assert resp.status == 400
+
+        for limit in ("0", "-1", "two"):
+            resp = await self.client.get(path="/log/%s" % log_name, params=dict(limit=limit))
+            assert resp.status == 400
+
+        await self.cbpi.log.clear_log(log_name)
+
+    async def test_mixed_history(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "mixed_test_sensor_ID"
+        folder = self.cbpi.log.logsFolderPath
+        await self.cbpi.log.clear_log(log_name)
+
+        # csv history from before the binary log target was enabled
+        now = int(time.time()) // 60 * 60 - 3600
+        log_file = CSVLogFile(os.path.join(folder, f"sensor_{log_name}.log"), 10**6, 1)
+        log_file.write(
+            [
+                "%s,%d" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now + i * 60)), 10 + i)
+                for i in range(3)
+            ]
+        )
+        log_file.close()
+        writer = SegmentWriter(folder, log_name)
+        for i in range(3, 6):
+            writer.append(now + i * 60, 10 + i)
+        writer.close()
+
+        ts, values = log_query.read_raw(folder, log_name)
+        assert ts.tolist() == [now + i * 60 for i in range(6)]
+        assert values.tolist() == [10.0, 11.0, 12.0, 13.0, 14.0, 15.0]
+        assert log_query.first_timestamp(folder, log_name) == now
+
+        # window before the first segment
+        data = await self.cbpi.log.get_data2([log_name], start=now, end=now + 60)
+        assert data[log_name]["value"] == [10.0, 11.0]
+        # window across both stores
+        ts, values = log_query.read_raw(folder, log_name, now + 120, now + 180)
+        assert values.tolist() == [12.0, 13.0]
+
+        # sqlite log target enabled later
+        connection = sqlite_log.connect(sqlite_log.db_path(folder), create=True)
+        sqlite_log.insert(connection, [(log_name, now + i * 60, 10 + i) for i in range(6, 9)])
+        connection.close()
+        ts, values = log_query.read_raw(folder, log_name, now + 240)
+        assert values.tolist() == [14.0, 15.0, 16.0, 17.0, 18.0]
+        assert log_query.first_timestamp(folder, log_name) == now
+        assert log_query.sqlite_covers(folder, log_name, now + 360) is True
+        assert log_query.sqlite_covers(folder, log_name, now) is False
+        data = await self.cbpi.log.get_rollup([log_name], resolution=60, start=now)
+        assert data[log_name]["max"] == [10.0 + i for i in range(9)]
+
+        # the zip holds the samples of all stores in the format of the csv logs
+        resp = await self.client.get(path="/log/%s/zip/stream" % log_name)
+        assert resp.status == 200
+        archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+        assert archive.namelist() == [f"sensor_{log_name}.csv"]
+        assert archive.read(f"sensor_{log_name}.csv").decode().splitlines() == [
+            "%s,%.1f" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now + i * 60)), 10 + i)
+            for i in range(9)
+        ]
+
+        await self.cbpi.log.clear_log(log_name)
+        resp = await self.client.get(path="/log/%s/zip/stream" % log_name)
+        assert resp.status == 500
+        assert (await resp.json())["error"] == "No log data for sensor %s" % log_name
 
+    async def test_downsample(self):
 
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "downsample_test_sensor_ID"
+        await self.cbpi.log.clear_log(log_name)
+
+        writer = SegmentWriter(self.cbpi.log.logsFolderPath, log_name, max_bytes=100000, backup_count=5)
+        now = int(time.time()) // 60 * 60 - 3000 * 60
+        for i in range(3000):
+            # a single minute spike which is missed by taking every nth row
+            writer.append(now + i * 60, 90 if i == 1501 else 20 + (i % 7) * 0.1)
+        writer.close()
+
+        for mode in ("lttb", "minmax"):
+            data = await self.cbpi.log.get_data2([log_name], downsample=mode, width=100)
+            assert 90 <= len(data[log_name]["value"]) <= 102
+            assert max(data[log_name]["value"]) == 90.0
+
+        data = await self.cbpi.log.get_data2([log_name], downsample="nth", width=100)
+        assert len(data[log_name]["value"]) <= 100
+        assert max(data[log_name]["value"]) < 90.0
+
+        resp = await self.client.get(path="/log/%s" % log_name, params=dict(downsample="lttb", width=200))
+        assert resp.status == 200
+        data = await resp.json()
+        assert len(data[log_name]) == 200
+        assert len(data["time"]) == 200
+        assert max(data[log_name]) == 90.0
+
+        resp = await self.client.get(path="/log/%s" % log_name, params=dict(downsample="every"))
+        assert resp.status == 400
+
+        await self.cbpi.log.clear_log(log_name)
+
+    async def test_log_cache(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "cache_test_sensor_ID"
+        await self.cbpi.log.clear_log(log_name)
+
+        writer = SegmentWriter(self.cbpi.log.logsFolderPath, log_name, max_bytes=100000, backup_count=5)
+        now = int(time.time()) // 60 * 60 - 600
+        for i in range(4):
+            writer.append(now + i * 60, 20 + i)
+
+        data = await self.cbpi.log.get_data2([log_name], start=-3600)
+        assert data[log_name]["value"] == [20.0, 21.0, 22.0, 23.0]
+        hits = self.cbpi.log.cache.hits
+
+        data = await self.cbpi.log.get_data2([log_name], start=-3600)
+        assert data[log_name]["value"] == [20.0, 21.0, 22.0, 23.0]
+        assert self.cbpi.log.cache.hits == hits + 1
+
+        # new bucket is appended
+        writer.append(now + 4 * 60, 30)
+        self.cbpi.log.log_data(log_name, 30)
+        data = await self.cbpi.log.get_data2([log_name], start=-3600)
+        assert data[log_name]["value"] == [20.0, 21.0, 22.0, 23.0, 30.0]
+
+        # trailing bucket is replaced
+        writer.append(now + 4 * 60 + 10, 35)
+        self.cbpi.log.log_data(log_name, 35)
+        data = await self.cbpi.log.get_data2([log_name], start=-3600, limit=2)
+        assert data[log_name]["value"] == [23.0, 35.0]
+
+        data = await self.cbpi.log.get_data(log_name, start=-3600)
+        assert data[log_name] == [20.0, 21.0, 22.0, 23.0, 35.0]
+
+        # a window with a relative end slides over written data and is read again
+        data = await self.cbpi.log.get_data2([log_name], start=-3600, end=-300)
+        assert data[log_name]["value"] == [20.0, 21.0, 22.0, 23.0, 35.0]
+        assert not any(key[0] == log_name and key[3] == -300 for key in self.cbpi.log.cache.entries)
+        writer.close()
+
+        await self.cbpi.log.clear_log(log_name)
+        assert all(key[0] != log_name for key in self.cbpi.log.cache.entries)
+
+    async def test_log_cache_closed_window(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "cache_closed_test_sensor_ID"
+        await self.cbpi.log.clear_log(log_name)
+
+        writer = SegmentWriter(self.cbpi.log.logsFolderPath, log_name, max_bytes=100000, backup_count=5)
+        now = int(time.time())
+        end = now + 1
+        writer.append(now - 10, 20)
+
+        # read while the window is still open
+        series = await self.cbpi.log.get_series([log_name], "1s", now - 20, end)
+        assert series[log_name].value == [20.0]
+
+        # logged before the end of the window, after it was read
+        writer.append(end, 21)
+        await asyncio.sleep(end + 1.1 - time.time())
+        series = await self.cbpi.log.get_series([log_name], "1s", now - 20, end)
+        assert series[log_name].value[-1] == 21.0
+        assert series[log_name].read_at > end + 1
+        writer.close()
+
+        await self.cbpi.log.clear_log(log_name)
+
+    async def test_sqlite_log(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "sqlite_test_sensor_ID"
+        await self.cbpi.log.clear_log(log_name)
+
+        connection = sqlite_log.connect(sqlite_log.db_path(self.cbpi.log.logsFolderPath), create=True)
+        now = int(time.time()) // 3600 * 3600 - 7200
+        rows = [(log_name, now + i * 10, 20 + (i % 6)) for i in range(720)]
+        sqlite_log.insert(connection, rows)
+        connection.close()
+
+        # 60 s max per bucket is aggregated by sqlite
+        data = await self.cbpi.log.get_data2([log_name], start=now)
+        assert len(data[log_name]["value"]) == 120
+        assert set(data[log_name]["value"]) == {25.0}
+
+        # per sensor limit through a window function
+        data = await self.cbpi.log.get_rollup([log_name], resolution=900, start=now, limit=3)
+        assert data[log_name]["resolution"] == 900
+        assert data[log_name]["count"] == [90, 90, 90]
+        assert data[log_name]["min"] == [20.0, 20.0, 20.0]
+        assert data[log_name]["mean"] == [22.5, 22.5, 22.5]
+
+        await self.cbpi.log.clear_log(log_name)
+        assert sqlite_log.first_timestamp(self.cbpi.log.logsFolderPath, log_name) is None
+
+    async def test_rollup(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "rollup_test_sensor_ID"
+        await self.cbpi.log.clear_log(log_name)
+
+        writer = RollupWriter(self.cbpi.log.logsFolderPath, log_name)
+        self.cbpi.log.rollups[log_name] = writer
+        now = int(time.time()) // 3600 * 3600 - 2 * 3600
+        # two hours of 10 second samples
+        for i in range(720):
+            writer.add(now + i * 10, i % 6)
+
+        data = await self.cbpi.log.get_rollup([log_name], resolution=1800)
+        assert data[log_name]["resolution"] == 900
+        assert len(data[log_name]["time"]) == 8
+        assert data[log_name]["count"] == [90] * 8
+        assert data[log_name]["min"][0] == 0 and data[log_name]["max"][0] == 5
+        assert data[log_name]["mean"][0] == 2.5
+
+        data = await self.cbpi.log.get_data2([log_name], start=now + 3600)
+        assert len(data[log_name]["value"]) == 60
+        assert data[log_name]["value"][0] == 5
+
+        # a partial bucket persisted on shutdown is merged with its continuation
+        writer.close()
+        writer.add(now + 7200 - 5, 7)
+        data = await self.cbpi.log.get_rollup([log_name], resolution=3600, start=now + 3600)
+        assert data[log_name]["count"] == [361]
+        assert data[log_name]["max"] == [7]
+
+        resp = await self.client.post(path="/log/rollup", params=dict(resolution=3600), json=[log_name])
+        assert resp.status == 200
+        data = await resp.json()
+        assert data[log_name]["count"] == [360, 361]
+
+        await self.cbpi.log.clear_log(log_name)
+
+        # closed buckets are written by the writer thread of a queue
+        queue = WriteBehindQueue(rollup.write_batch, interval=60)
+        writer = RollupWriter(self.cbpi.log.logsFolderPath, log_name, tiers=(60,), queue=queue)
+        for i in range(3):
+            writer.add(now + i * 60, i)
+        path = rollup.rollup_path(self.cbpi.log.logsFolderPath, log_name, 60)
+        assert not os.path.exists(path)
+        await queue.flush()
+        assert rollup.read_rollup(self.cbpi.log.logsFolderPath, log_name, 60)["max"].tolist() == [0, 1]
+        await queue.close()
+        await self.cbpi.log.clear_log(log_name)
+
+        # no rollups without a local log target
+        with patch.object(self.cbpi.log, "local_logging", return_value=False):
+            self.cbpi.log.log_data(log_name, 1)
+        assert log_name not in self.cbpi.log.rollups
+
+        # tier files are bounded, the oldest buckets go first
+        writer = RollupWriter(self.cbpi.log.logsFolderPath, log_name, tiers=(60,), max_bytes=400)
+        for i in range(30):
+            writer.add(now + i * 60, i)
+        path = rollup.rollup_path(self.cbpi.log.logsFolderPath, log_name, 60)
+        assert os.path.getsize(path) <= 400
+        records = rollup.read_rollup(self.cbpi.log.logsFolderPath, log_name, 60)
+        assert records["max"][-1] == 28
+        assert records["ts"][0] > now
+        await self.cbpi.log.clear_log(log_name)
+
+    async def test_rollup_alignment(self):
+
+        os.makedirs(os.path.join(".", "tests", "logs"), exist_ok=True)
+        log_name = "alignment_test_sensor_ID"
+        folder = self.cbpi.log.logsFolderPath
+        await self.cbpi.log.clear_log(log_name)
+        tz = os.environ.get("TZ")
+        # half hour utc offset, local hours do not start at utc hours
+        os.environ["TZ"] = "Asia/Kolkata"
+        time.tzset()
+        try:
+            now = int(time.time()) // 3600 * 3600 - 3 * 3600
+            writer = SegmentWriter(folder, log_name, max_bytes=100000, backup_count=5)
+            rollups = RollupWriter(folder, log_name)
+            for i in range(180):
+                writer.append(now + i * 60, i)
+                rollups.add(now + i * 60, i)
+            writer.close()
+            rollups.close()
 
+            index, values = log_query.read_series(folder, [log_name], "3600s")[log_name]
+            rollup.remove_rollups(folder, log_name)
+            raw_index, raw_values = log_query.read_series(folder, [log_name], "3600s")[log_name]
+            assert index.tolist() == raw_index.tolist()
+            assert values.tolist() == raw_values.tolist() == [59.0, 119.0, 179.0]
+        finally:
+            if tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = tz
+            time.tzset()
+        await self.cbpi.log.clear_log(log_name)
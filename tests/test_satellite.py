@@ -0,0 +1,516 @@
+import asyncio
+import json
+import time
+from unittest.mock import patch
+
+import aiomqtt
+from cbpi.api.dataclasses import Props
+from cbpi.controller.satellite_controller import SatelliteController
+from cbpi.extension.mqtt_sensor import MQTTSensor
+from cbpi.utils.mqtt_dispatcher import MQTTDispatcher
+from cbpi.utils.mqtt_payload import compile_path, decode, extract
+from cbpi.utils.mqtt_publisher import MQTTPublisher
+from cbpi.utils.topic_trie import TopicTrie, filter_matches, valid_filter
+from tests.cbpi_config_fixture import CraftBeerPiTestCase
+from tests.timing import per_call
+
+
+class RecordingClient:
+
+    def __init__(self):
+        self.calls = []
+
+    async def subscribe(self, topic, qos=0):
+        self.calls.append(("subscribe", topic))
+
+    async def unsubscribe(self, topic):
+        self.calls.append(("unsubscribe", topic))
+
+
+def message(topic, payload=b""):
+    return aiomqtt.Message(topic, payload, 0, False, 0, None)
+
+
+class SatelliteTestCase(CraftBeerPiTestCase):
+
+    async def test_topic_trie(self):
+        trie = TopicTrie(cache_size=4)
+        assert trie.add("tele/+/SENSOR", "a") is True
+        assert trie.add("tele/#", "b") is True
+        assert trie.add("tele/+/SENSOR", "c") is False
+        assert trie.add("#", "d") is True
+        assert trie.match("tele/plug/SENSOR") == ("a", "c", "b", "d")
+        assert trie.match("tele/plug/STATE") == ("b", "d")
+        assert trie.match("tele") == ("b", "d")
+        assert trie.match("$SYS/broker/uptime") == ()
+
+        assert trie.remove("tele/+/SENSOR", "a") is False
+        assert trie.remove("tele/+/SENSOR", "x") is False
+        assert trie.remove("tele/+/SENSOR", "c") is True
+        assert trie.match("tele/plug/SENSOR") == ("b", "d")
+        assert sorted(trie.filters()) == ["#", "tele/#"]
+        trie.remove("tele/#", "b")
+        trie.remove("#", "d")
+        assert len(trie) == 0
+        assert trie._root.children == {}
+
+        # the same matching for single filters
+        assert filter_matches("tele/+/SENSOR", "tele/plug/SENSOR")
+        assert filter_matches("tele/#", "tele")
+        assert not filter_matches("#", "$SYS/broker/uptime")
+        assert not filter_matches("tele/+", "tele/plug/SENSOR")
+        assert valid_filter("tele/+/#")
+        assert not valid_filter("tele/#/SENSOR")
+        assert not valid_filter("tele/plug+")
+
+    async def test_dispatch(self):
+        satellite = SatelliteController(self.cbpi)
+        received = []
+
+        async def on_message(message):
+            received.append(str(message.topic))
+
+        satellite.subscribe("zigbee2mqtt/+/temperature", on_message)
+        await satellite.dispatch(message("zigbee2mqtt/fridge/temperature"))
+        await satellite.dispatch(message("zigbee2mqtt/fridge/humidity"))
+        await satellite.dispatch(message("tasmota/plug/STATE"))
+        await satellite.dispatcher.join()
+        assert received == ["zigbee2mqtt/fridge/temperature"]
+
+        # broker subscriptions follow the registered filters while connected
+        satellite.client = RecordingClient()
+        satellite.connected = True
+
+        async def other(message):
+            pass
+
+        satellite.subscribe("tele/sonoff/SENSOR", on_message)
+        satellite.subscribe("tele/sonoff/SENSOR", other)
+        satellite.unsubscribe("tele/sonoff/SENSOR", on_message)
+        satellite.unsubscribe("tele/sonoff/SENSOR", other)
+        satellite.unsubscribe("zigbee2mqtt/+/temperature", on_message)
+        await asyncio.sleep(0.01)
+        assert satellite.client.calls == [
+            ("subscribe", "tele/sonoff/SENSOR"),
+            ("unsubscribe", "tele/sonoff/SENSOR"),
+            ("unsubscribe", "zigbee2mqtt/+/temperature"),
+        ]
+
+    async def test_dispatch_benchmark(self):
+        satellite = SatelliteController(self.cbpi)
+
+        async def on_message(message):
+            pass
+
+        for i in range(200):
+            satellite.subscribe("cbpi/sensor/%s/value" % i, on_message)
+        topics = ["tasmota/plug%s/SENSOR" % (i % 50) for i in range(1000)]
+
+        linear = per_call(
+            lambda topic: [
+                aiomqtt.Topic(topic).matches(topic_filter)
+                for topic_filter in satellite.topic_filters.filters()
+            ],
+            topics,
+        )
+        trie = per_call(satellite.topic_filters.match, topics)
+        assert trie < linear
+
+    async def test_concurrent_dispatch(self):
+        satellite = SatelliteController(self.cbpi)
+        order = []
+
+        async def update_sensors(message):
+            await asyncio.sleep(0.2)
+            order.append(str(message.topic))
+
+        async def actor_off(message):
+            order.append(str(message.topic))
+
+        satellite.subscribe("test/updatesensor", update_sensors)
+        satellite.subscribe("test/actor/+/off", actor_off)
+        await satellite.dispatch(message("test/updatesensor"))
+        await satellite.dispatch(message("test/actor/1/off"))
+        await asyncio.sleep(0.05)
+        # the safety command does not wait for the slow handler
+        assert order == ["test/actor/1/off"]
+        await satellite.dispatcher.join()
+        assert order == ["test/actor/1/off", "test/updatesensor"]
+
+        stats = satellite.get_stats()["dispatch"]["handlers"]
+        update_stats = next(v for k, v in stats.items() if k.endswith("update_sensors"))
+        assert update_stats["max"] >= 0.2
+        assert update_stats["calls"] == 1
+
+        resp = await self.client.get(path="/system/mqtt/stats")
+        assert resp.status == 200
+
+    async def test_dispatch_order_and_concurrency(self):
+        dispatcher = MQTTDispatcher(max_concurrency=2, max_pending=4)
+        received = {}
+        running = []
+        max_running = []
+
+        async def handler(message):
+            running.append(message)
+            max_running.append(len(running))
+            await asyncio.sleep(0.01 * (3 - int(message.payload.decode()) % 3))
+            received.setdefault(str(message.topic), []).append(
+                int(message.payload.decode())
+            )
+            running.remove(message)
+
+        async def failing(message):
+            raise ValueError("broken payload")
+
+        for i in range(10):
+            for topic in ("a", "b", "c"):
+                await dispatcher.dispatch(
+                    [handler, failing], message(topic, str(i).encode())
+                )
+            # bounded, dispatch waited for free capacity
+            assert len(dispatcher) <= 4
+        await dispatcher.join()
+
+        assert received == {topic: list(range(10)) for topic in ("a", "b", "c")}
+        assert max(max_running) == 2
+        stats = dispatcher.get_stats()["handlers"]
+        handler_stats = next(v for k, v in stats.items() if k.endswith("handler"))
+        failing_stats = next(v for k, v in stats.items() if k.endswith("failing"))
+        assert handler_stats["calls"] == 30
+        assert failing_stats["errors"] == 30
+        assert len(dispatcher) == 0
+
+    async def test_actor_command_order(self):
+        satellite = SatelliteController(self.cbpi)
+        done = []
+
+        async def on(id):
+            await asyncio.sleep(0.05)
+            done.append(("on", id))
+
+        async def off(id):
+            done.append(("off", id))
+
+        with patch.object(self.cbpi.actor, "on", on), patch.object(self.cbpi.actor, "off", off):
+            await satellite.dispatch(message("cbpi/actor/a1/on"))
+            await satellite.dispatch(message("cbpi/actor/a1/off"))
+            await satellite.dispatch(message("cbpi/actor/a2/off"))
+            await satellite.dispatcher.join()
+        # commands of one actor keep their order, other actors do not wait
+        assert done == [("off", "a2"), ("on", "a1"), ("off", "a1")]
+
+    async def test_publisher(self):
+        sent = []
+        blocked = asyncio.Event()
+
+        async def send(topic, payload, qos, retain):
+            await blocked.wait()
+            sent.append((topic, payload, qos, retain))
+            return True
+
+        publisher = MQTTPublisher(
+            send, max_size=3, qos=1, topic_qos={"cbpi/sensordata/#": 0}
+        )
+        publisher.start()
+        publisher.put("cbpi/actor/1/on", "1")
+        await asyncio.sleep(0.01)
+        # the first publish is in flight, the rest is coalesced by topic
+        for value in range(5):
+            publisher.put("cbpi/sensordata/s1", '{"value": %s}' % value, retain=True)
+        publisher.put("cbpi/sensordata/s2", '{"value": 1}', retain=True)
+        publisher.put("cbpi/kettleupdate/k1", "{}", qos=2)
+        publisher.put("cbpi/fermenterupdate/f1", "{}")
+        assert len(publisher) == 3
+        assert publisher.coalesced == 4
+        assert publisher.dropped == 1
+
+        blocked.set()
+        await asyncio.sleep(0.01)
+        assert sent == [
+            ("cbpi/actor/1/on", b"1", 1, False),
+            ("cbpi/sensordata/s2", b'{"value": 1}', 0, True),
+            ("cbpi/kettleupdate/k1", b"{}", 2, False),
+            ("cbpi/fermenterupdate/f1", b"{}", 1, False),
+        ]
+
+        # unchanged retained state is not sent again
+        sent.clear()
+        for i in range(10):
+            publisher.put("cbpi/sensordata/s2", '{"value": 1}', retain=True)
+        publisher.put("cbpi/sensordata/s2", '{"value": 2}', retain=True)
+        publisher.put("cbpi/sensordata/s2", '{"value": 1}', retain=True)
+        await publisher.close()
+        assert sent == []
+        assert publisher.get_stats()["deduplicated"] == 11
+        assert publisher.get_stats()["published"] == 4
+
+    async def test_topic_qos(self):
+        async def send(topic, payload, qos, retain):
+            return True
+
+        publisher = MQTTPublisher(
+            send,
+            qos=1,
+            topic_qos={
+                "cbpi/#": 2,
+                "cbpi/+/s1": 1,
+                "cbpi/sensordata/+": 0,
+                "cbpi/sensordata/s2": 2,
+            },
+        )
+        assert publisher.get_qos("cbpi/sensordata/s1") == 0
+        assert publisher.get_qos("cbpi/sensordata/s2") == 2
+        assert publisher.get_qos("cbpi/actorupdate/s1") == 1
+        assert publisher.get_qos("cbpi/actorupdate/a1") == 2
+        assert publisher.get_qos("other") == 1
+        publisher.set_qos("cbpi/sensordata/+", 1)
+        assert publisher.get_qos("cbpi/sensordata/s1") == 1
+
+    async def test_push_update(self):
+        satellite = SatelliteController(self.cbpi)
+        satellite.push("cbpi/sensordata/s1", dict(id="s1", value=1.5), retain=True)
+        assert len(satellite.publisher) == 1
+        # not connected, nothing is sent
+        assert await satellite._send("cbpi/sensordata/s1", b"", 0, True) is False
+
+
+class FakeBroker:
+    """
+    In-process stand-in for a broker, one connected client at a time
+    """
+
+    def __init__(self):
+        self.running = True
+        self.client = None
+        self.subscriptions = []
+        self.published = []
+        self.retained = {}
+
+    def stop(self, persistence=True):
+        self.running = False
+        if not persistence:
+            self.retained.clear()
+        if self.client is not None:
+            self.client.incoming.put_nowait(None)
+
+    def start(self):
+        self.running = True
+
+    def deliver(self, topic, payload=b""):
+        self.client.incoming.put_nowait(message(topic, payload))
+
+
+class FakeClient:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.incoming = None
+
+    async def __aenter__(self):
+        if not self.broker.running:
+            raise aiomqtt.MqttError("Connection refused")
+        self.incoming = asyncio.Queue()
+        self.broker.client = self
+        return self
+
+    async def __aexit__(self, *args):
+        self.broker.client = None
+
+    async def subscribe(self, topics, qos=0):
+        self.broker.subscriptions.append(topics)
+
+    async def publish(self, topic, payload, qos=0, retain=False):
+        if not self.broker.running:
+            raise aiomqtt.MqttError("Disconnected")
+        self.broker.published.append((topic, payload))
+        if retain:
+            self.broker.retained[topic] = payload
+
+    @property
+    async def messages(self):
+        while True:
+            msg = await self.incoming.get()
+            if msg is None:
+                raise aiomqtt.MqttError("Connection lost")
+            yield msg
+
+
+class SupervisorTestCase(CraftBeerPiTestCase):
+
+    async def wait_for(self, condition, timeout=2):
+        start = time.monotonic()
+        while not condition():
+            assert time.monotonic() - start < timeout
+            await asyncio.sleep(0.01)
+
+    async def test_reconnect(self):
+        broker = FakeBroker()
+        satellite = SatelliteController(self.cbpi)
+        satellite.client = FakeClient(broker)
+        satellite.min_backoff = 0.02
+        satellite.max_backoff = 0.08
+        received = []
+
+        async def on_message(message):
+            received.append(str(message.topic))
+
+        satellite.subscribe("tele/+/SENSOR", on_message)
+        satellite.publisher.retry_interval = 0.05
+        satellite.publisher.start()
+        broker.stop()
+        task = asyncio.create_task(satellite.listen())
+
+        # broker is down on start, publishes are buffered
+        for value in range(5):
+            satellite.push("cbpi/sensordata/s1", dict(value=value), retain=True)
+        satellite.push("cbpi/actorupdate/a1", dict(state=True))
+        await asyncio.sleep(0.2)
+        stats = satellite.get_stats()
+        assert stats["connection"]["connected"] is False
+        assert stats["connection"]["backoff"] == 0.08
+        assert stats["connection"]["last_error"] == "Connection refused"
+        assert stats["publish"]["queued"] == 2
+        assert broker.published == []
+
+        broker.start()
+        await self.wait_for(lambda: len(broker.published) == 2)
+        assert list(broker.retained) == ["cbpi/sensordata/s1"]
+        assert json.loads(broker.retained["cbpi/sensordata/s1"]) == dict(value=4)
+        assert ("tele/+/SENSOR", 0) in broker.subscriptions[-1]
+        broker.deliver("tele/plug/SENSOR")
+        await self.wait_for(lambda: received == ["tele/plug/SENSOR"])
+
+        # broker restart
+        broker.stop()
+        await self.wait_for(lambda: satellite.connected is False)
+        satellite.push("cbpi/sensordata/s1", dict(value=5), retain=True)
+        broker.start()
+        await self.wait_for(lambda: satellite.connected is True)
+        await self.wait_for(
+            lambda: json.loads(broker.retained["cbpi/sensordata/s1"]) == dict(value=5)
+        )
+        assert len(broker.subscriptions) == 2
+        broker.deliver("tele/plug/SENSOR")
+        await self.wait_for(lambda: len(received) == 2)
+
+        # restart without persistence, unchanged retained state is sent again
+        broker.stop(persistence=False)
+        await self.wait_for(lambda: satellite.connected is False)
+        satellite.push("cbpi/sensordata/s1", dict(value=5), retain=True)
+        broker.start()
+        await self.wait_for(lambda: "cbpi/sensordata/s1" in broker.retained)
+        assert json.loads(broker.retained["cbpi/sensordata/s1"]) == dict(value=5)
+
+        stats = satellite.get_stats()["connection"]
+        assert stats["connects"] == 3
+        assert stats["disconnects"] == 2
+        assert stats["backoff"] == satellite.min_backoff
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await satellite.publisher.close()
+
+    async def test_handler_error_keeps_listening(self):
+        broker = FakeBroker()
+        satellite = SatelliteController(self.cbpi)
+        satellite.client = FakeClient(broker)
+        received = []
+
+        async def broken(message):
+            raise RuntimeError("bad payload")
+
+        async def on_message(message):
+            received.append(message.payload)
+
+        satellite.subscribe("tele/plug/SENSOR", broken)
+        satellite.subscribe("tele/plug/SENSOR", on_message)
+        task = asyncio.create_task(satellite.listen())
+        await self.wait_for(lambda: satellite.connected)
+        broker.deliver("tele/plug/SENSOR", b"1")
+        broker.deliver("tele/plug/SENSOR", b"2")
+        await self.wait_for(lambda: received == [b"1", b"2"])
+        assert satellite.connected is True
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+class PayloadDecoderTestCase(CraftBeerPiTestCase):
+
+    async def test_fan_out(self):
+        satellite = SatelliteController(self.cbpi)
+        values = {}
+        topic = "tele/plug/SENSOR"
+
+        def collect(name):
+            async def callback(value):
+                values[name] = value
+
+            return callback
+
+        callbacks = {
+            "ENERGY.Power": collect("power"),
+            "ENERGY.Voltage": collect("voltage"),
+            "AM2301.Temperature": collect("temperature"),
+            "Readings.1": collect("second"),
+            "Missing.Key": collect("missing"),
+            "": collect("raw"),
+        }
+        for path, callback in callbacks.items():
+            satellite.payloads.subscribe(topic, path, callback)
+        assert len(satellite.topic_filters.match(topic)) == 1
+
+        payload = json.dumps(
+            dict(
+                ENERGY=dict(Power=230, Voltage=231.5),
+                AM2301=dict(Temperature=19.5),
+                Readings=[1, 2, 3],
+            )
+        ).encode()
+        with patch("cbpi.utils.mqtt_payload.decode", wraps=decode) as decoder:
+            await satellite.dispatch(message(topic, payload))
+            await satellite.dispatcher.join()
+            assert decoder.call_count == 1
+        assert values["power"] == 230
+        assert values["voltage"] == 231.5
+        assert values["temperature"] == 19.5
+        assert values["second"] == 2
+        assert values["missing"] is None
+        assert values["raw"]["Readings"] == [1, 2, 3]
+        assert satellite.get_stats()["payloads"][topic] == dict(
+            messages=1, paths=6, callbacks=6
+        )
+
+        for path, callback in callbacks.items():
+            satellite.payloads.unsubscribe(topic, path, callback)
+        assert satellite.topic_filters.match(topic) == ()
+        assert satellite.payloads.routes == {}
+
+        # plain payloads
+        assert extract(decode(b"21.5"), compile_path("")) == 21.5
+        assert extract(decode(b"ON"), compile_path(None)) == "ON"
+        assert extract(decode(b"[1, 2]"), compile_path("a")) is None
+
+    async def test_mqtt_sensor(self):
+        self.cbpi.satellite = SatelliteController(self.cbpi)
+        try:
+            temperature = MQTTSensor(
+                self.cbpi,
+                "t1",
+                Props(dict(Topic="zigbee2mqtt/fridge", PayloadDictionary="temperature")),
+            )
+            humidity = MQTTSensor(
+                self.cbpi,
+                "h1",
+                Props(dict(Topic="zigbee2mqtt/fridge", PayloadDictionary="humidity")),
+            )
+            await self.cbpi.satellite.dispatch(
+                message("zigbee2mqtt/fridge", b'{"temperature": 4.5, "humidity": 61}')
+            )
+            await self.cbpi.satellite.dispatcher.join()
+            assert temperature.value == 4.5
+            assert humidity.value == 61
+            await temperature.on_stop()
+            await humidity.on_stop()
+            assert self.cbpi.satellite.topic_filters.match("zigbee2mqtt/fridge") == ()
+        finally:
+            self.cbpi.satellite = None
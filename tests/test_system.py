@@ -1,3 +1,6 @@
+import io
+import zipfile
+
 from aiohttp.test_utils import unittest_run_loop
 from tests.cbpi_config_fixture import CraftBeerPiTestCase
 
@@ -12,3 +15,10 @@ class IndexTestCase(CraftBeerPiTestCase):
         resp = await self.client.post(path="/system/shutdown")
         assert resp.status == 200
 
+    async def test_backup(self):
+        resp = await self.client.get(path="/system/backup")
+        assert resp.status == 200
+        assert resp.headers["Content-Type"] == "application/zip"
+        archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+        assert archive.testzip() is None
+        assert "config.json" in archive.namelist()
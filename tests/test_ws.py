@@ -1,5 +1,17 @@
+import asyncio
+import datetime
+import json
+import unittest
+from unittest.mock import patch
+
 import aiohttp
+import numpy
 from aiohttp.test_utils import unittest_run_loop
+from cbpi.api.dataclasses import Actor, Props
+from cbpi.controller.satellite_controller import SatelliteController
+from cbpi.utils import json_dumps, json_encode, msgpack_decode, msgpack_encode
+from cbpi.utils.utils import msgpack
+from cbpi.websocket import WebSocketClient
 from tests.cbpi_config_fixture import CraftBeerPiTestCase
 
 # class WebSocketTestCase(CraftBeerPiTestCase):
@@ -44,3 +56,395 @@ from tests.cbpi_config_fixture import CraftBeerPiTestCase
 #                 else:
 #                     raise Exception()
 
+
+
+class SlowWebSocket:
+
+    def __init__(self):
+        self.sent = []
+        self.blocked = asyncio.Event()
+        self.closed = False
+
+    async def send_frame(self, data, opcode):
+        await self.blocked.wait()
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=None):
+        self.closed = True
+
+
+class WebSocketClientTestCase(CraftBeerPiTestCase):
+
+    async def test_backpressure(self):
+        ws = SlowWebSocket()
+        resynced = []
+        client = WebSocketClient(ws, max_size=3, max_lag=10, on_resync=resynced.append)
+        client.start()
+        client.put(dict(topic="step/start", data={}))
+        await asyncio.sleep(0.01)
+        # the writer is stuck on the first message, the queue fills up
+        client.put(dict(topic="sensorstate", id="c", value=0))
+        for i in range(10):
+            client.put(dict(topic="sensorstate", id="a", value=i))
+            client.put(dict(topic="sensorstate", id="b", value=i))
+        assert len(client) == 3
+        assert client.coalesced == 18
+
+        # nothing to coalesce with, the client is resynced once it has room
+        client.put(dict(topic="kettleupdate", data=[]))
+        assert len(client) == 3
+        assert client.dropped == 1
+        assert client.resync is True
+        assert client.to_dict()["lag"] > 0
+
+        ws.blocked.set()
+        await asyncio.sleep(0.01)
+        assert [(m["topic"], m.get("id"), m.get("value")) for m in ws.sent] == [
+            ("step/start", None, None),
+            ("sensorstate", "c", 0),
+            ("sensorstate", "a", 9),
+            ("sensorstate", "b", 9),
+            ("resync", None, None),
+        ]
+        assert ws.sent[-1]["data"] == dict(dropped=1)
+        assert resynced == [client]
+        assert client.to_dict()["resyncs"] == 1
+        assert len(client) == 0
+        assert client.to_dict()["lag"] == 0
+        await client.stop()
+
+    async def test_coalesce_snapshots(self):
+        ws = SlowWebSocket()
+        client = WebSocketClient(ws, max_size=1, max_lag=10)
+        client.put(dict(topic="actorupdate", revision=0, data=[]))
+        client.put(dict(topic="actorupdate", revision=1, data=[]))
+        assert [k for k, frame in client._queue.values()] == [("actorupdate", None)]
+        assert json.loads(next(iter(client._queue.values()))[1])["revision"] == 1
+        assert client.dropped == 0
+        # patches keep their revision and are never replaced
+        assert WebSocketClient.coalesce_key(
+            dict(topic="actorupdate/patch", id="a", revision=2, data={})
+        ) == ("actorupdate/patch", "a", 2)
+
+    async def test_evict_slow_client(self):
+        ws = SlowWebSocket()
+        client = WebSocketClient(ws, max_size=2, max_lag=0.1)
+        client.start()
+        for i in range(3):
+            client.put(dict(topic="sensorstate", id="a", value=i))
+            await asyncio.sleep(0.01)
+        assert client.to_dict()["queued"] == 2
+        client.put(dict(topic="sensorstate", id="a", value=3))
+        assert client.evicted is False
+        await asyncio.sleep(0.15)
+        client.put(dict(topic="sensorstate", id="a", value=4))
+        await asyncio.sleep(0.01)
+        assert client.evicted is True
+        assert ws.closed is True
+        assert len(client) == 0
+
+    async def test_slow_client_catching_up(self):
+        ws = SlowWebSocket()
+        client = WebSocketClient(ws, max_size=2, max_lag=0.1)
+        client.put(dict(topic="sensorstate", id="a", value=0))
+        client.put(dict(topic="sensorstate", id="b", value=0))
+        client.put(dict(topic="sensorstate", id="a", value=1))
+        assert client.full_since is not None
+        for i in range(3):
+            await asyncio.sleep(0.06)
+            # one message sent, the queue is full again right after
+            client._queue.popitem(last=False)
+            client.put(dict(topic="sensorstate", id="c", value=i))
+            assert client.full_since is None
+            client.put(dict(topic="sensorstate", id="c", value=i))
+        assert client.evicted is False
+        assert client.to_dict()["lag"] < 0.1
+
+    async def test_clients_endpoint(self):
+        async with self.client.ws_connect("/ws") as ws:
+            msg = await ws.receive_json()
+            assert msg["topic"] == "connection/success"
+            self.cbpi.ws.send(dict(topic="test/ws", data=dict(a=1)))
+            msg = await ws.receive_json(timeout=1)
+            assert msg["topic"] == "test/ws"
+            resp = await self.client.get(path="/system/ws/clients")
+            assert resp.status == 200
+            clients = await resp.json()
+            assert len(clients) == 1
+            assert clients[0]["queued"] == 0
+            assert clients[0]["sent"] >= 1
+
+    async def test_encode_once(self):
+        encoded = []
+
+        def counting_encode(client, data):
+            encoded.append(data)
+            return json_encode(data)
+
+        sockets = [await self.client.ws_connect("/ws") for i in range(3)]
+        for ws in sockets:
+            await ws.receive_json()
+        with patch.object(WebSocketClient, "encode", counting_encode):
+            self.cbpi.ws.send(
+                dict(topic="actorupdate", data=[dict(name="b"), dict(name="A")]),
+                sorting=True,
+            )
+        for ws in sockets:
+            msg = await ws.receive_json(timeout=1)
+            assert [a["name"] for a in msg["data"]] == ["A", "b"]
+            await ws.close()
+        assert len(encoded) == 1
+
+    async def test_json_encode(self):
+        data = dict(
+            time=datetime.datetime(2024, 1, 2, 3, 4, 5),
+            value=numpy.float64(1.5),
+            name="Würze",
+            items={1: [1, 2.5, None]},
+            big=2**70,
+        )
+        assert json.loads(json_encode(data)) == dict(
+            time="2024-01-02 03:04:05",
+            value=1.5,
+            name="Würze",
+            items={"1": [1, 2.5, None]},
+            big=2**70,
+        )
+        assert json.loads(json_dumps(data)) == json.loads(json_encode(data))
+
+    async def test_json_dumps(self):
+        # HTTP responses are encoded by the json module, with or without orjson installed
+        data = dict(value=float("nan"), items={1: [1, 2.5, None]})
+        assert json_dumps(data) == '{"value": NaN, "items": {"1": [1, 2.5, null]}}'
+
+    async def test_subscribe(self):
+        kiosk = await self.client.ws_connect("/ws")
+        dashboard = await self.client.ws_connect("/ws")
+        for ws in (kiosk, dashboard):
+            await ws.receive_json()
+        await kiosk.send_json(
+            dict(topic="subscribe", data=dict(topics=["sensorstate/s1", "step/#", "a/#/b"]))
+        )
+        msg = await kiosk.receive_json(timeout=1)
+        assert msg == dict(
+            topic="subscriptions", data=dict(topics=["sensorstate/s1", "step/#"])
+        )
+
+        messages = [
+            dict(topic="sensorstate", id="s1", value=1),
+            dict(topic="sensorstate", id="s2", value=2),
+            dict(topic="kettleupdate", data=[]),
+            dict(topic="step/1/done", data=dict(id="1")),
+        ]
+        for data in messages:
+            self.cbpi.ws.send(data)
+        received = [await kiosk.receive_json(timeout=1) for i in range(2)]
+        assert received == [messages[0], messages[3]]
+        received = [await dashboard.receive_json(timeout=1) for i in range(4)]
+        assert received == messages
+
+        await kiosk.send_json(dict(topic="unsubscribe", data=dict(topics="step/#")))
+        msg = await kiosk.receive_json(timeout=1)
+        assert msg["data"]["topics"] == ["sensorstate/s1"]
+        self.cbpi.ws.send(messages[3])
+        self.cbpi.ws.send(messages[0])
+        assert await kiosk.receive_json(timeout=1) == messages[0]
+
+        resp = await self.client.get(path="/system/ws/clients")
+        clients = {c["subscriptions"] is None: c for c in await resp.json()}
+        assert clients[False]["filtered"] == 3
+        assert clients[True]["filtered"] == 0
+        await kiosk.close()
+        await dashboard.close()
+
+    async def test_delta(self):
+        async def receive(ws, topic):
+            while True:
+                msg = await ws.receive_json(timeout=1)
+                if msg["topic"] == topic:
+                    return msg
+
+        actors = self.cbpi.actor
+        actor_id = actors.data[0].id
+        legacy = await self.client.ws_connect("/ws")
+        delta = await self.client.ws_connect("/ws")
+        await delta.send_json(dict(topic="delta", data=dict(enabled=True)))
+        snapshot = await receive(delta, "actorupdate")
+        assert snapshot["revision"] == actors.revision
+        assert snapshot["data"][0]["id"] == actor_id
+
+        await actors.timeractor_update(actor_id, 5)
+        patch = await receive(delta, "actorupdate/patch")
+        assert patch == dict(
+            topic="actorupdate/patch",
+            id=actor_id,
+            revision=snapshot["revision"] + 1,
+            data=dict(timer=5),
+        )
+        full = await receive(legacy, "actorupdate")
+        assert full["data"][0]["timer"] == 5
+        assert len(json.dumps(patch)) < len(json.dumps(full))
+
+        # unchanged items are not sent again
+        await actors.timeractor_update(actor_id, 5)
+        await delta.send_json(dict(topic="resync", data=dict(topics=["actorupdate"])))
+        msg = await delta.receive_json(timeout=1)
+        assert msg["topic"] == "actorupdate"
+        assert msg["revision"] == patch["revision"]
+        await legacy.close()
+        await delta.close()
+
+    async def test_send_changes(self):
+        ws = SlowWebSocket()
+        legacy = WebSocketClient(ws, max_size=10)
+        delta = WebSocketClient(SlowWebSocket(), max_size=10)
+        delta.delta = True
+        delta.subscribe(["actorupdate/#"])
+        self.cbpi.ws._clients[ws] = legacy
+        self.cbpi.ws._clients[delta.ws] = delta
+        try:
+            # nothing changed, nothing is sent
+            self.cbpi.ws.send_changes(self.cbpi.actor, [])
+            assert len(legacy) == 0 and len(delta) == 0
+            for revision in range(5):
+                self.cbpi.ws.send_changes(self.cbpi.actor, [("a1", dict(timer=revision), revision)])
+            assert [key for key, frame in legacy._queue.values()] == [("actorupdate", None)] * 5
+            assert len(delta) == 5
+            # subscription matches are cached per topic and id, not per revision
+            assert list(delta._matches) == [("actorupdate/patch", "a1")]
+        finally:
+            del self.cbpi.ws._clients[ws]
+            del self.cbpi.ws._clients[delta.ws]
+
+    async def test_diff(self):
+        actors = self.cbpi.actor
+        actors.diff()
+        revision = actors.revision
+        actors.data.append(Actor(id="tmp", name="Tmp"))
+        changes = actors.diff()
+        assert [(id, rev) for id, fields, rev in changes] == [("tmp", revision + 1)]
+        assert changes[0][1]["name"] == "Tmp"
+        actors.data.pop()
+        assert actors.diff() == [("tmp", None, revision + 2)]
+        assert actors.diff() == []
+
+    async def test_diff_retained(self):
+        actors = self.cbpi.actor
+        satellite = SatelliteController(self.cbpi)
+        actors.diff()
+        actors.data.append(Actor(id="tmp", name="Tmp"))
+        try:
+            with patch.object(self.cbpi, "satellite", satellite):
+                await actors.push_udpate()
+        finally:
+            actors.data.pop()
+            actors.diff()
+        # unchanged items are not published again, late subscribers get the retained state
+        assert list(satellite.publisher._queue) == ["cbpi/actorupdate/tmp"]
+        assert satellite.publisher._queue["cbpi/actorupdate/tmp"][2] is True
+
+    async def test_sensorstate_batch(self):
+        single = await self.client.ws_connect("/ws")
+        batch = await self.client.ws_connect("/ws")
+        for ws in (single, batch):
+            await ws.receive_json()
+        await batch.send_json(dict(topic="batch", data=dict(enabled=True)))
+        msg = await batch.receive_json(timeout=1)
+        assert msg == dict(
+            topic="batch", data=dict(enabled=True, window=self.cbpi.ws.batch_window)
+        )
+
+        for id, value in (("s1", 1), ("s2", 2), ("s1", 3), ("s1", 4)):
+            self.cbpi.ws.send(dict(topic="sensorstate", id=id, value=value, inrange=True))
+        self.cbpi.ws.send(dict(topic="kettleupdate", data=[]))
+
+        received = [await single.receive_json(timeout=1) for i in range(5)]
+        assert [m["topic"] for m in received] == ["sensorstate"] * 4 + ["kettleupdate"]
+        msg = await batch.receive_json(timeout=1)
+        assert msg["topic"] == "kettleupdate"
+        msg = await batch.receive_json(timeout=1)
+        assert msg == dict(
+            topic="sensorstate_batch",
+            data=[dict(id="s1", value=4, inrange=True), dict(id="s2", value=2, inrange=True)],
+        )
+        await single.close()
+        await batch.close()
+
+    @unittest.skipIf(msgpack is None, "msgpack not installed")
+    async def test_msgpack(self):
+        # permessage-deflate is only negotiated with ws_compress
+        async with self.client.ws_connect("/ws", compress=15) as ws:
+            await ws.receive(timeout=1)
+            resp = await self.client.get(path="/system/ws/clients")
+            assert not (await resp.json())[0]["compress"]
+
+        self.cbpi.ws.compress = True
+        async with self.client.ws_connect(
+            "/ws", protocols=("cbpi.msgpack",), compress=15
+        ) as ws:
+            msg = await ws.receive(timeout=1)
+            assert msg.type == aiohttp.WSMsgType.BINARY
+            assert msgpack_decode(msg.data) == dict(topic="connection/success")
+            await ws.send_bytes(
+                msgpack_encode(dict(topic="subscribe", data=dict(topics=["test/#"])))
+            )
+            msg = await ws.receive(timeout=1)
+            assert msgpack_decode(msg.data)["data"]["topics"] == ["test/#"]
+            self.cbpi.ws.send(dict(topic="test/1", data=dict(value=numpy.float64(1.5))))
+            msg = await ws.receive(timeout=1)
+            assert msgpack_decode(msg.data) == dict(topic="test/1", data=dict(value=1.5))
+
+            resp = await self.client.get(path="/system/ws/clients")
+            client = (await resp.json())[0]
+            assert client["encoding"] == "msgpack"
+            assert client["compress"] == 15
+
+        # query parameter, JSON stays the default
+        async with self.client.ws_connect("/ws?encoding=msgpack") as ws:
+            msg = await ws.receive(timeout=1)
+            assert msg.type == aiohttp.WSMsgType.BINARY
+        async with self.client.ws_connect("/ws") as ws:
+            msg = await ws.receive(timeout=1)
+            assert msg.type == aiohttp.WSMsgType.TEXT
+
+    @unittest.skipIf(msgpack is None, "msgpack not installed")
+    async def test_encoding_frames(self):
+        data = dict(
+            topic="actorupdate",
+            data=[
+                Actor(
+                    id="actor%02d" % i,
+                    name="Actor %d" % i,
+                    props=Props(dict(GPIO=i)),
+                    type="GPIOPWMActor",
+                ).to_dict()
+                for i in range(30)
+            ],
+        )
+        self.cbpi.ws.compress = True
+        async with self.client.ws_connect("/ws") as text, self.client.ws_connect(
+            "/ws", protocols=("cbpi.msgpack",)
+        ) as binary, self.client.ws_connect(
+            "/ws", protocols=("cbpi.msgpack",), compress=15
+        ) as deflated:
+            assert text.protocol is None
+            assert binary.protocol == "cbpi.msgpack"
+            assert deflated.protocol == "cbpi.msgpack"
+            assert not binary.compress and deflated.compress == 15
+            for ws in (text, binary, deflated):
+                await ws.receive(timeout=1)
+
+            self.cbpi.ws.send(data)
+            text_frame = await text.receive(timeout=1)
+            binary_frame = await binary.receive(timeout=1)
+            deflated_frame = await deflated.receive(timeout=1)
+
+        assert text_frame.type == aiohttp.WSMsgType.TEXT
+        assert text_frame.data == json_encode(data).decode("utf-8")
+        assert binary_frame.type == aiohttp.WSMsgType.BINARY
+        assert binary_frame.data == msgpack_encode(data)
+        # inflated by the client, the payload is the same as without permessage-deflate
+        assert deflated_frame.type == aiohttp.WSMsgType.BINARY
+        assert deflated_frame.data == binary_frame.data
+        assert msgpack_decode(binary_frame.data) == json.loads(text_frame.data)
+        assert len(binary_frame.data) < len(text_frame.data.encode("utf-8"))
@@ -0,0 +1,13 @@
+import time
+
+
+def per_call(func, items):
+    """
+    :param func: function called with every item
+    :param items: arguments
+    :return: average wall time of a call in seconds
+    """
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - start) / len(items)